@@ -0,0 +1,195 @@
+import base64
+import hashlib
+import json
+import time
+
+from signature_service import SignatureService
+
+BATCH_PREFIX = "merkle:"  # never appears in a base64 signature
+ROOT_TAG = "MERKLE_ROOT"
+
+
+def _leaf_hash(data):
+    return hashlib.sha256("\x00" + data).digest()
+
+
+def _node_hash(left, right):
+    return hashlib.sha256("\x01" + left + right).digest()
+
+
+def merkle_paths(leaves):
+    """Builds a Merkle tree over leaves. A node without a sibling is carried
+    up to the next level unchanged.
+
+    Args:
+        leaves (list[string]): leaf hashes
+
+    Returns:
+        (string, list[list[(bool, string)]]): root and, per leaf, its
+            inclusion path as (sibling is on the left, sibling hash) pairs
+    """
+    paths = [[] for _ in leaves]
+    level = [(h, [i]) for i, h in enumerate(leaves)]  # (hash, leaf indices)
+    while len(level) > 1:
+        next_level = []
+        for j in xrange(0, len(level) - 1, 2):
+            (left, left_leaves), (right, right_leaves) = level[j], level[j + 1]
+            for i in left_leaves:
+                paths[i].append((False, right))
+            for i in right_leaves:
+                paths[i].append((True, left))
+            next_level.append(
+                (_node_hash(left, right), left_leaves + right_leaves))
+        if len(level) % 2 == 1:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0][0], paths
+
+
+def merkle_root(leaf, path):
+    """Recomputes the root from a leaf hash and its inclusion path."""
+    node = leaf
+    for sibling_on_left, sibling in path:
+        if sibling_on_left:
+            node = _node_hash(sibling, node)
+        else:
+            node = _node_hash(node, sibling)
+    return node
+
+
+class MerkleBatchSignatureService(SignatureService):
+    def __init__(self, signature_service, window, max_batch_size):
+        """Signs outbound messages in batches: the messages passed to
+        sign_later within window seconds are the leaves of a Merkle tree,
+        only the root is signed, and each message carries the root signature
+        plus its inclusion path.
+
+        validate accepts batched and plain signatures. Root signatures are
+        checked with the wrapped service, so when that is a
+        CachingSignatureService each root is only verified once however many
+        messages of the batch arrive.
+
+        Args:
+            signature_service (SignatureService): signs / validates roots
+            window (float): seconds to wait for more messages
+            max_batch_size (int): flush as soon as this many are waiting
+        """
+        self._signature_service = signature_service
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._pending = []  # (message, callback, time queued)
+        self.batches = 0
+        self.batched_messages = 0
+        self.queued_time = 0.0  # total seconds messages spent waiting
+
+    def sign(self, msg):
+        return self._signature_service.sign(msg)
+
+    def sign_later(self, message, callback):
+        self._pending.append((message, callback, time.time()))
+        if len(self._pending) >= self._max_batch_size:
+            self.flush()
+
+    def poll(self):
+        """Flushes the batch once its oldest message has waited window
+        seconds. Call from the event loop."""
+        if self._pending and time.time() - self._pending[0][2] >= self._window:
+            self.flush()
+
+    def flush(self):
+        """Signs every waiting message and hands each to its callback."""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        now = time.time()
+        root, paths = merkle_paths(
+            [_leaf_hash(message.data) for message, _, _ in pending])
+        root_signature = self._signature_service.sign(ROOT_TAG + root)
+        for (message, _, queued), path in zip(pending, paths):
+            self.queued_time += now - queued
+            message.set_signature(signature=BATCH_PREFIX + json.dumps({
+                "root_signature": root_signature,
+                "path": [(left, base64.b64encode(h)) for left, h in path]}))
+        self.batches += 1
+        self.batched_messages += len(pending)
+
+        for message, callback, _ in pending:
+            callback(message)
+
+    def validate(self, msg, sender, signature):
+        if signature is None or not signature.startswith(BATCH_PREFIX):
+            return self._signature_service.validate(msg, sender, signature)
+
+        try:
+            batch = json.loads(signature[len(BATCH_PREFIX):])
+            path = [(left, base64.b64decode(h)) for left, h in batch["path"]]
+            root_signature = batch["root_signature"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        root = merkle_root(_leaf_hash(msg), path)
+        return self._signature_service.validate(
+            ROOT_TAG + root, sender, root_signature)
+
+    def metrics(self):
+        return {
+            "batches": self.batches,
+            "batched_messages": self.batched_messages,
+            "mean_batch_size": (
+                float(self.batched_messages) / self.batches
+                if self.batches else 0.0),
+            "mean_queued_time": (
+                self.queued_time / self.batched_messages
+                if self.batched_messages else 0.0),
+        }
+
+
+if __name__ == '__main__':
+    from Crypto.PublicKey import RSA
+    from signature_service import CachingSignatureService
+    from signature_service import RSASignatureService
+
+    class _Message(object):
+        def __init__(self, data):
+            self.data = data
+            self.signature = None
+
+        def set_signature(self, signature_service=None, signature=None):
+            self.signature = signature
+
+    # Messages arrive at a fixed rate; each is sent when its batch is signed.
+    RATE = 1000  # messages / second
+    COUNT = 1000
+    rsa = RSASignatureService(0, key=RSA.generate(2048))
+    for window in [0.0, 0.001, 0.005, 0.02, 0.05]:
+        ss = MerkleBatchSignatureService(
+            CachingSignatureService(rsa, 10000), window,
+            max_batch_size=COUNT if window > 0 else 1)
+        latencies = []
+        sent = []
+
+        def send(message, created):
+            latencies.append(time.time() - created)
+            sent.append(message)
+
+        start = time.time()
+        for i in xrange(COUNT):
+            while time.time() < start + float(i) / RATE:
+                ss.poll()
+            created = time.time()
+            ss.sign_later(_Message(str(i) * 64),
+                          lambda message, created=created: send(message, created))
+        while len(sent) < COUNT:
+            ss.poll()
+        elapsed = time.time() - start
+
+        assert all(ss.validate(m.data, 0, m.signature) for m in sent)
+        assert not ss.validate("forged", 0, sent[0].signature)
+        latencies.sort()
+        metrics = ss.metrics()
+        print ("window {:>5.0f}ms: {:>4} root signatures/s, batch {:>5.1f}, "
+               "added latency p50 {:.1f}ms p99 {:.1f}ms, {:.0f} msgs/s").format(
+            window * 1000, int(metrics["batches"] / elapsed),
+            metrics["mean_batch_size"],
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, COUNT / elapsed)
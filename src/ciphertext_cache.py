@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+# Rough per-entry cost of the dict entry, tuples and charm element wrappers,
+# on top of the serialized sizes
+ENTRY_OVERHEAD = 512
+
+
+class CiphertextCache(object):
+    def __init__(self, max_bytes):
+        """LRU of deserialized threshold ciphertexts, so a hot user's logins
+        skip SQLite and deserialize1. Bounded by an estimate of the memory
+        the entries use rather than by their count.
+
+        Not thread safe: used only by the thread that owns the SecretsDB.
+
+        Args:
+            max_bytes (int)
+        """
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Move to the most recently used end
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Args:
+            key (string)
+            value (object)
+            size (int): serialized size of value in bytes
+        """
+        self.invalidate(key)
+        size += len(key) + ENTRY_OVERHEAD
+        if size > self._max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self._max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self._max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+if __name__ == '__main__':
+    import random
+
+    # Zipf-like login pattern: a few hot users log in most of the time
+    users = 100000
+    cache = CiphertextCache(1 << 20)
+    for _ in xrange(200000):
+        key = str(int(random.paretovariate(0.4)) % users)
+        if cache.get(key) is None:
+            cache.put(key, object(), 4 * 128)
+    print cache.metrics()
@@ -3,26 +3,60 @@ import asyncore
 import message
 import socket
 import threading
+import time
+from collections import OrderedDict
 from state_machine import ClientGetStateMachine, ClientPutStateMachine
 from state_machine import LameClientGetStateMachine, LameClientPutStateMachine
 from messaging_service import MessagingService, Address
 from message import LoginRequest
 from message import LoginResponse
+from message import LoginConfirm
 from message import EnrollRequest
 from message import EnrollResponse
 from signature_service import get_signature_service
+from signature_service import CachingSignatureService
+from batch_signature_service import MerkleBatchSignatureService
 from pake2plus.pake2plus import password_to_secret_A
 from pake2plus.pake2plus import SPAKE2PLUS_A
+from pake2plus.pake2plus import SPAKEError
+from pake2plus.secret_cache import SecretCache
 from utils import CONSTANTS
+from utils import set_constants
 from timer import Timer
 from lamedb import LameSecretsDB
+from db_executor import DBExecutor
+from threshold_signature_service import ThresholdSignatureService
+from pake_service import PakeService
+
+
+def make_secret_cache():
+    if CONSTANTS.SECRET_CACHE_SIZE > 0:
+        return SecretCache(CONSTANTS.SECRET_CACHE_SIZE)
+    return None
 
 
 class ApplicationClient(object):
     def __init__(self, server_ports, client_id):
         self._state_machines = {}
+        # When each state machine started, oldest first, see
+        # _expire_requests
+        self._started = OrderedDict()
 
+        # Servers' keys are parsed once by the signature service; the cache
+        # also skips signatures (and Merkle roots) that were already checked
         self._signature_service = get_signature_service()(client_id)
+        if CONSTANTS.SIGNATURE_CACHE_SIZE > 0:
+            self._signature_service = CachingSignatureService(
+                self._signature_service, CONSTANTS.SIGNATURE_CACHE_SIZE)
+        if CONSTANTS.SIGNATURE_BATCH_WINDOW > 0:
+            # Replicas sign responses in Merkle batches
+            self._signature_service = MerkleBatchSignatureService(
+                self._signature_service, CONSTANTS.SIGNATURE_BATCH_WINDOW,
+                CONSTANTS.SIGNATURE_BATCH_SIZE)
+        self._threshold_signature_service = None
+        if CONSTANTS.THRESHOLD_SIGNATURES:
+            self._threshold_signature_service = ThresholdSignatureService(
+                'thsig8_2.keys')
         self._id = client_id
 
         ADDRESSES = [Address(port - 8001, port, 'localhost', True) for
@@ -30,14 +64,37 @@ class ApplicationClient(object):
         ADDRESSES += [Address(100, 8001 + CONSTANTS.N, 'localhost', False)]
         self._messaging_service = MessagingService(ADDRESSES, self)
 
-        self._datastore = LameSecretsDB()
-        asyncore.loop()
+        self._datastore = DBExecutor(lambda: LameSecretsDB(
+            commit_interval=CONSTANTS.DB_COMMIT_INTERVAL,
+            commit_rows=CONSTANTS.DB_COMMIT_ROWS))
+        self._secret_cache = make_secret_cache()
+        self._pake_service = PakeService(CONSTANTS.PAKE_BATCH_SIZE)
+
+        self._completed = 0  # state machines that got their quorum
+        self._late_responses = 0  # responses dropped after the quorum
+        self._invalid_responses = 0
+        self._cpu_start = time.clock()
+
+        # Handle every message that is ready in one poll before flushing, so
+        # that a backlog of logins shares one batched PAKE computation.
+        while asyncore.socket_map:
+            asyncore.loop(timeout=0.01, count=1)
+            self._pake_service.flush()
+            self._expire_requests()
 
 
     @property
     def datastore(self):
         return self._datastore
 
+    @property
+    def secret_cache(self):
+        return self._secret_cache
+
+    @property
+    def pake_service(self):
+        return self._pake_service
+
     @property
     def id(self):
         return self._id
@@ -58,47 +115,109 @@ class ApplicationClient(object):
     def signature_service(self):
         return self._signature_service
 
+    @property
+    def threshold_signature_service(self):
+        return self._threshold_signature_service
+
     @property
     def messaging_service(self):
         return self._messaging_service
 
-    def handle_message(self, msg):
-        #if not msg.verify_signatures(self._signature_service):
-        #    print "Welp, fuck"
-        #    return
+    def _handle_response(self, msg, key):
+        """Verifies and dispatches a server's response, unless its state
+        machine already has a quorum: then it is dropped unverified. With
+        threshold signatures only the certificate the state machine combines
+        from f + 1 shares is verified, once per quorum, instead of every
+        response's signature."""
+        state_machine = self._state_machines.get(key)
+        if state_machine is None or state_machine.done:
+            self._late_responses += 1
+            return
+
+        if (self._threshold_signature_service is None and
+                not msg.verify_signatures(self._signature_service)):
+            print "Invalid signature on {}".format(msg)
+            self._invalid_responses += 1
+            return
+
+        state_machine.handle_message(msg)
+        if state_machine.done:
+            self._completed += 1
+            if self._completed % 100 == 0:
+                self._report()
+
+    def _report(self):
+        cpu_time = time.clock() - self._cpu_start
+        print ("{} requests, {:.2f}ms client CPU each, {} late and {} "
+               "invalid responses dropped").format(
+            self._completed, cpu_time * 1000 / self._completed,
+            self._late_responses, self._invalid_responses)
+
+    @staticmethod
+    def _request_key(request):
+        """Key of the state machine for a LoginRequest / LoginConfirm or
+        EnrollRequest"""
+        if isinstance(request, message.EnrollRequest):
+            return (request.timestamp, "ENROLL")
+        return (request.username, request.timestamp, "LOGIN")
+
+    def _start(self, request, state_machine_class):
+        key = self._request_key(request)
+        self._started[key] = time.time()
+        self._state_machines[key] = state_machine_class(request, self)
+
+    def _handle_login_confirm(self, msg):
+        state_machine = self._state_machines.get(self._request_key(msg))
+        if state_machine is not None:  # else finished or expired
+            state_machine.handle_message(msg)
 
+    def finish_request(self, request):
+        """Called by a state machine once it expects no more messages, so
+        that it, and the PAKE of a login, can be dropped.
+
+        Args:
+            request (LoginRequest | EnrollRequest)
+        """
+        key = self._request_key(request)
+        self._state_machines.pop(key, None)
+        self._started.pop(key, None)
+
+    def _expire_requests(self):
+        """Drops the state machines still waiting for the servers or the
+        user after REQUEST_TIMEOUT seconds, e.g. logins with a wrong
+        password, which the user never confirms"""
+        deadline = time.time() - CONSTANTS.REQUEST_TIMEOUT
+        while self._started:
+            key, started = next(self._started.iteritems())
+            if started > deadline:
+                return
+            del self._started[key]
+            del self._state_machines[key]
+
+    def handle_message(self, msg):
         if CONSTANTS.LAME_CLIENT:
             if isinstance(msg, message.LoginRequest):
-                key = (msg.username, msg.timestamp, "LOGIN")
-                state_machine = self._state_machines[key] = \
-                    LameClientGetStateMachine(msg, self)
+                self._start(msg, LameClientGetStateMachine)
             elif isinstance(msg, message.EnrollRequest):
-                key = (msg.timestamp, "ENROLL")
-                state_machine = self._state_machines[key] = \
-                    LameClientPutStateMachine(msg, self)
+                self._start(msg, LameClientPutStateMachine)
+            elif isinstance(msg, message.LoginConfirm):
+                self._handle_login_confirm(msg)
             else:
                 raise ValueError("Unhandled message: {}".format(msg))
             return
 
 
         if isinstance(msg, message.LoginRequest):
-            key = (msg.username, msg.timestamp, "LOGIN")
-            state_machine = self._state_machines[key] = \
-                    ClientGetStateMachine(msg, self)
+            self._start(msg, ClientGetStateMachine)
         elif isinstance(msg, message.EnrollRequest):
-            key = (msg.timestamp, "ENROLL")
-            state_machine = self._state_machines[key] = \
-                    ClientPutStateMachine(msg, self)
+            self._start(msg, ClientPutStateMachine)
         elif isinstance(msg, message.GetResponseMessage):
-            key = (msg.get_msg.key, msg.get_msg.timestamp, "LOGIN")
-            state_machine = self._state_machines[key]
-            assert state_machine
-            state_machine.handle_message(msg)
+            self._handle_response(
+                msg, (msg.get_msg.key, msg.get_msg.timestamp, "LOGIN"))
         elif isinstance(msg, message.PutCompleteMessage):
-            key = (msg.put_msg.timestamp, "ENROLL")
-            state_machine = self._state_machines[key]
-            assert state_machine
-            state_machine.handle_message(msg)
+            self._handle_response(msg, (msg.put_msg.timestamp, "ENROLL"))
+        elif isinstance(msg, message.LoginConfirm):
+            self._handle_login_confirm(msg)
         else:
             raise ValueError("Unhandled message: {}".format(msg))
 
@@ -106,7 +225,9 @@ class ApplicationClient(object):
 class User(object):
     def __init__(self, client_id):
         self._callbacks = {}
+        self._pakes = {}  # (username, timestamp) -> SPAKE2PLUS_A
         self._client_id = client_id
+        self._secret_cache = make_secret_cache()
         ADDRESSES = [Address(client_id, client_id + 8001, 'localhost', True)]
         self._messaging_service = MessagingService(ADDRESSES, self)
 
@@ -141,12 +262,14 @@ class User(object):
 
         # Assign request an id, put it in the msg
         #self._callbacks[transaction_id] = callback
-        secretA = password_to_secret_A(password)
+        secretA = password_to_secret_A(
+            password, kdf=CONSTANTS.PASSWORD_KDF, cache=self._secret_cache)
         SA = SPAKE2PLUS_A(secretA)
         u = SA.start()
 
         l = LoginRequest(username, u, self.id)
         self._callbacks[(username, l.timestamp)] = callback
+        self._pakes[(username, l.timestamp)] = SA
         self._messaging_service.send(l, self._client_id)
 
     def enroll(self, username, password, callback):
@@ -154,24 +277,61 @@ class User(object):
         self._callbacks[(username, e.timestamp)] = callback
         self._messaging_service.send(e, self._client_id)
 
+    def _finish_login(self, msg):
+        """Returns the session key, or None if the server rejected the login
+        or its confirmation MAC shows that it derived a different key (wrong
+        password)."""
+        SA = self._pakes.pop((msg.username, msg.timestamp))
+        if msg.failed:
+            return None
+        try:
+            key = SA.finish(msg.v)
+        except (SPAKEError, ValueError):
+            return None
+        if not SA.verify_confirmation(msg.confirmation):
+            return None
+
+        confirm = LoginConfirm(
+            msg.username, SA.confirmation(), self.id, msg.timestamp)
+        self._messaging_service.send(confirm, self._client_id)
+        return key
+
     def handle_message(self, msg):
-        if isinstance(msg, LoginResponse) or isinstance(msg, EnrollResponse):
-            self._callbacks[(msg.username, msg.timestamp)](msg)
+        if isinstance(msg, LoginResponse):
+            key = self._finish_login(msg)
+            self._callbacks.pop((msg.username, msg.timestamp))(msg, key)
+        elif isinstance(msg, EnrollResponse):
+            self._callbacks.pop((msg.username, msg.timestamp))(msg)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("user", type=int)
+    parser.add_argument("--login", action="store_true",
+                        help="log in the enrolled users instead of enrolling")
+    parser.add_argument("--wrong-password", action="store_true",
+                        help="log in with the wrong password, to time "
+                        "rejected logins")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE", help="override a CONSTANTS value")
     args = parser.parse_args()
+    set_constants(args.set)
     if args.user == 8:
         user = User(100)
         num_calls = 200
-        login = False
+        login = args.login or args.wrong_password
+        password = "bdon"
+        if args.wrong_password:
+            password = "not bdon"
 
         name = CONSTANTS.SIGNATURE_SERVICE + '-' + str(CONSTANTS.N) + '-' + str(CONSTANTS.f) + '-' + str(num_calls)
+        if CONSTANTS.REPLICA_AUTHENTICATION == "mac":
+            name += '-mac'
         if CONSTANTS.LAME_CLIENT:
             name = 'lame' + '-' + str(num_calls)
-        if login:
+        if args.wrong_password:
+            name += '-login-failed'
+        elif login:
             name += '-login'
         else:
             name += '-enroll'
@@ -179,7 +339,7 @@ if __name__ == "__main__":
         timer = Timer(num_calls, name)
         for i in xrange(num_calls):
             if login:
-                user.login(str(i), "bdon", timer.call)
+                user.login(str(i), password, timer.call)
             else:
                 user.enroll(str(i), "bdon", timer.call)
     elif args.user == 7:
@@ -0,0 +1,50 @@
+import asyncore
+import os
+import Queue
+import traceback
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Read end of a pipe in the asyncore map: a worker thread writes a byte
+    to it after queueing a completion, which wakes up the event loop."""
+    def __init__(self, fd, completions):
+        asyncore.file_dispatcher.__init__(self, fd)
+        self._completions = completions
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self._completions.drain()
+
+
+class CompletionQueue(object):
+    def __init__(self):
+        """Hands callbacks from worker threads to the asyncore event loop,
+        which runs them on its own thread."""
+        self._completions = Queue.Queue()
+        read_fd, self._wake_fd = os.pipe()
+        self._waker = _Waker(read_fd, self)
+        os.close(read_fd)  # file_dispatcher keeps its own dup
+
+    def put(self, callback, *args):
+        """Called from a worker thread: callback(*args) will run on the event
+        loop thread."""
+        self._completions.put((callback, args))
+        os.write(self._wake_fd, "x")
+
+    def drain(self):
+        """Runs the queued callbacks. Called by the event loop when woken
+        up."""
+        while True:
+            try:
+                callback, args = self._completions.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                callback(*args)
+            except Exception:
+                # Logged like asyncore logs a failing handler, but the waker
+                # stays open: closing it would stop every later completion
+                traceback.print_exc()
@@ -0,0 +1,506 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from lamedb import LameSecretsDB
+from secrets_store import SQLiteStore
+from secrets_store import STORAGE_ENGINES
+
+# The lame_secrets table as it was before schema.py: no primary key
+LEGACY_TABLE = "CREATE TABLE lame_secrets (key TEXT, value BLOB)"
+VALUE_SIZE = 64  # pi_0 and c
+
+
+def fill(filename, users, legacy=False):
+    """Returns a get function for a database of users users."""
+    if legacy:
+        conn = sqlite3.connect(filename)
+        conn.execute(LEGACY_TABLE)
+    else:
+        store = SQLiteStore(filename, "lame_secrets")
+        conn = store.connection
+    value = sqlite3.Binary(os.urandom(VALUE_SIZE))
+    with conn:
+        conn.executemany(
+            "INSERT INTO lame_secrets VALUES (?,?)",
+            ((str(i), value) for i in xrange(users)))
+
+    if not legacy:
+        return store.get
+    # SQLiteStore would migrate the legacy table, so query it directly
+    return lambda key: conn.execute(
+        "SELECT * FROM lame_secrets WHERE key=?", (key,)).fetchone()
+
+
+def get_latencies(get, users, gets):
+    keys = [str(random.randrange(users)) for _ in xrange(gets)]
+    latencies = []
+    for key in keys:
+        start = time.time()
+        get(key)
+        latencies.append(time.time() - start)
+    return sorted(latencies)
+
+
+def get_bench(directory, args):
+    for users in args.users:
+        runs = [("primary key", False, args.gets)]
+        if args.legacy_gets > 0:
+            runs.append(("no index", True, args.legacy_gets))
+        for name, legacy, gets in runs:
+            filename = os.path.join(directory, "{}-{}db".format(
+                users, "legacy" if legacy else "pk"))
+            start = time.time()
+            get = fill(filename, users, legacy)
+            fill_time = time.time() - start
+            latencies = get_latencies(get, users, gets)
+            print ("{:>9} users, {:<11}: get p50 {:>10.1f}us "
+                   "p99 {:>10.1f}us ({:.0f}s to fill)").format(
+                users, name, latencies[len(latencies) // 2] * 1e6,
+                latencies[int(len(latencies) * 0.99)] * 1e6, fill_time)
+            os.remove(filename)
+
+
+# (name, commit interval, commit rows, rollback journal instead of WAL)
+PUT_CONFIGS = [
+    ("commit per put, rollback journal", 0, 1, True),
+    ("commit per put, WAL", 0, 1, False),
+    ("group commit 5ms / 64", 0.005, 64, False),
+    ("group commit 20ms / 256", 0.02, 256, False),
+]
+
+
+def put_bench(directory, args):
+    """Enrolls as fast as an event loop that polls the committer between
+    puts allows."""
+    value = os.urandom(VALUE_SIZE)
+    for name, interval, rows, legacy in PUT_CONFIGS:
+        filename = os.path.join(directory, "putdb")
+        db = LameSecretsDB(filename, interval, rows)
+        if legacy:
+            if not isinstance(db.store, SQLiteStore):
+                continue
+            # The journal settings LameSecretsDB used to run with
+            db.store.connection.execute("PRAGMA journal_mode=DELETE")
+            db.store.connection.execute("PRAGMA synchronous=FULL")
+
+        acked = []
+        start = time.time()
+        for i in xrange(args.enrolls):
+            db.put(str(i), value, lambda error=None: acked.append(error))
+            db.poll()
+        db.committer.commit()
+        elapsed = time.time() - start
+        assert len(acked) == args.enrolls
+
+        latencies = sorted(db.committer.latencies)
+        print ("{:<32}: {:>6.0f} enrolls/s, {:>5} commits, commit latency "
+               "p50 {:>7.2f}ms p99 {:>7.2f}ms").format(
+            name, args.enrolls / elapsed, db.committer.commits,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000)
+        for suffix in ["", "-wal", "-shm", "-lmdb", "-lmdb-lock"]:
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+
+# Serialized sizes of a secrets row: U and V of the two ciphertexts
+SECRETS_ROW_SIZES = [65, 32, 65, 32]
+# client_id and timestamp of the put
+PUT_VERSION = ("100", "2017-05-01T12:00:00.000000")
+
+
+def store_bench(directory, args):
+    """Sequential put, random get and a 90% get / 10% put mix against every
+    storage engine."""
+    def row():
+        return tuple(
+            os.urandom(size) for size in SECRETS_ROW_SIZES) + PUT_VERSION
+
+    for engine, store_class in sorted(STORAGE_ENGINES.iteritems()):
+        try:
+            store = store_class(os.path.join(directory, engine), "secrets")
+        except ValueError as e:  # e.g. py-lmdb missing
+            print "Skipping {}: {}".format(engine, e)
+            continue
+        keys = ["user{:09d}".format(i) for i in xrange(args.users)]
+
+        start = time.time()
+        for i, key in enumerate(keys):
+            store.put(key, row())
+            if i % 1000 == 999:
+                store.commit()
+        store.commit()
+        put_rate = args.users / (time.time() - start)
+
+        latencies = get_latencies(
+            lambda key: store.get("user{:09d}".format(int(key))),
+            args.users, args.ops)
+        get_rate = len(latencies) / sum(latencies)
+
+        start = time.time()
+        for i in xrange(args.ops):
+            key = random.choice(keys)
+            if random.random() < 0.9:
+                store.get(key)
+            else:
+                store.put(key, row())
+            if i % 100 == 99:
+                store.commit()
+        store.commit()
+        mixed_rate = args.ops / (time.time() - start)
+
+        print ("{:<7}: sequential put {:>7.0f}/s, random get {:>7.0f}/s "
+               "(p50 {:.1f}us p99 {:.1f}us), mixed {:>7.0f} ops/s").format(
+            engine, put_rate, get_rate,
+            latencies[len(latencies) // 2] * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6, mixed_rate)
+
+
+def catchup_bench(directory, args):
+    """Transfers args.entries secrets rows between two SecretsDBs the way
+    catch-up does, one page at a time, and times each side of it. In a
+    cluster the sides run on different servers, so the slower side bounds
+    the transfer rate."""
+    # Need charm, unlike the other benchmarks
+    from message import CatchUpResponseMessage, Message
+    from secrets_db import SecretsDB
+
+    source = SecretsDB(os.path.join(directory, "source"))
+    clients = 100
+    rows = []
+    for i in xrange(args.entries):
+        timestamp = "2017-05-01T12:{:02d}:{:02d}.{:06d}".format(
+            i // 60000000 % 60, i // 1000000 % 60, i % 1000000)
+        row = tuple(os.urandom(size) for size in SECRETS_ROW_SIZES)
+        rows.append(("put", "user{:09d}".format(i),
+                     row + (str(i % clients), timestamp)))
+        if len(rows) == 10000:
+            source.store.batch(rows)
+            rows = []
+    source.store.batch(rows)
+    source.store.commit()
+
+    destination = SecretsDB(os.path.join(directory, "destination"))
+    read = send = receive = store = 0.0
+    wire_bytes = 0
+    position = None
+    while True:
+        start = time.time()
+        entries, position = source.select({}, position, args.page_size)
+        read += time.time() - start
+        start = time.time()
+        data = CatchUpResponseMessage(entries, 0, position=position).to_json()
+        send += time.time() - start
+        wire_bytes += len(data)
+
+        start = time.time()
+        response = Message.from_json(json.loads(data))
+        receive += time.time() - start
+        start = time.time()
+        destination.apply(response.entries)
+        store += time.time() - start
+        if position is None:
+            break
+
+    assert len(destination.store.select({}, limit=args.entries + 1)) == \
+        args.entries
+    megabytes = wire_bytes / 2.0 ** 20
+    print "{} entries, {:.0f} MB in pages of {}".format(
+        args.entries, megabytes, args.page_size)
+    print ("sending side:   read {:.1f}s + encode {:.1f}s = "
+           "{:.0f} entries/s, {:.0f} MB/s").format(
+        read, send, args.entries / (read + send), megabytes / (read + send))
+    print ("receiving side: decode {:.1f}s + store {:.1f}s = "
+           "{:.0f} entries/s, {:.0f} MB/s").format(
+        receive, store, args.entries / (receive + store),
+        megabytes / (receive + store))
+
+
+class _Replica(object):
+    """What AntiEntropyStateMachine uses of a Server, with messages passed
+    in process"""
+    def __init__(self, uid, filename, replicas):
+        from db_executor import DBExecutor
+        from secrets_db import SecretsDB
+        from state_machine import AntiEntropyStateMachine
+        from stubs import StubSignatureService
+
+        self.id = uid
+        self.f = 1
+        self.replica_authenticator = StubSignatureService()
+        self.messaging_service = self
+        self.secrets_db = DBExecutor(
+            lambda: SecretsDB(filename, merkle_tree=True))
+        self.anti_entropy = AntiEntropyStateMachine(self)
+        self.bytes_sent = 0
+        self._replicas = replicas
+        replicas.append(self)
+
+    @property
+    def N(self):
+        return len(self._replicas)
+
+    def connected(self, destination):
+        return True
+
+    def send(self, msg, destination):
+        from message import Message
+
+        data = msg.to_json()
+        self.bytes_sent += len(data)
+        self._replicas[destination].anti_entropy.handle_message(
+            Message.from_json(json.loads(data)))
+
+    def read(self, operation):
+        """operation(db), waiting for the db thread"""
+        import asyncore
+
+        result = []
+        self.secrets_db.run(operation, result.append)
+        while not result:
+            asyncore.loop(timeout=0.1, count=1)
+        return result[0]
+
+
+def antientropy_bench(directory, args):
+    """What keeping a MerkleTree adds to a put, and how long an
+    anti-entropy round takes to repair a divergence between three replicas,
+    with f = 1."""
+    # Need charm, unlike the other benchmarks
+    import asyncore
+    from merkle_tree import MerkleTree
+
+    def row(i, timestamp):
+        return (tuple(os.urandom(size) for size in SECRETS_ROW_SIZES) +
+                (str(i % 100), timestamp))
+
+    stores = [STORAGE_ENGINES["sqlite"](
+        os.path.join(directory, str(uid)), "secrets") for uid in xrange(3)]
+    # Replica 1 is missing half of the diverging keys and has an older
+    # version of the other half, replicas 0 and 2 agree on the new versions
+    diverging = int(args.keys * args.divergence)
+    for start in xrange(0, args.keys, 10000):
+        puts = [[], [], []]
+        for i in xrange(start, min(start + 10000, args.keys)):
+            key = "user{:09d}".format(i)
+            puts[0].append(("put", key, row(i, "2017-05-02T12:00:00")))
+            puts[2].append(puts[0][-1])
+            if i % (args.keys // diverging) == 0:
+                if i // (args.keys // diverging) % 2:
+                    continue
+                puts[1].append(("put", key, row(i, "2017-05-01T12:00:00")))
+            else:
+                puts[1].append(puts[0][-1])
+        for store, operations in zip(stores, puts):
+            store.batch(operations)
+            store.commit()
+    del stores
+
+    tree = MerkleTree()
+    keys = ["user{:09d}".format(i) for i in xrange(args.keys)]
+    start = time.time()
+    for key in keys[:100000]:
+        tree.update(key, ("1", "2017-05-01T12:00:00"),
+                    ("1", "2017-05-02T12:00:00"))
+    update = (time.time() - start) / 100000
+
+    replicas = []
+    start = time.time()
+    _Replica(0, os.path.join(directory, "0"), replicas)
+    _Replica(1, os.path.join(directory, "1"), replicas)
+    _Replica(2, os.path.join(directory, "2"), replicas)
+    while not all(replica.anti_entropy.tree_ready for replica in replicas):
+        asyncore.loop(timeout=0.1, count=1)
+    print "{} keys: built the trees in {:.1f}s".format(
+        args.keys, time.time() - start)
+
+    def old_versions(db):
+        start = time.time()
+        for key in random.sample(keys, 10000):
+            db.versions([key])
+        return (time.time() - start) / 10000
+    print ("tree upkeep per put: {:.1f}us to update + {:.1f}us to read the "
+           "old version").format(
+        update * 1e6, replicas[1].read(old_versions) * 1e6)
+
+    start = time.time()
+    replicas[1].anti_entropy.start_round()
+    while replicas[1].anti_entropy.in_round:
+        asyncore.loop(timeout=0.1, count=1)
+    elapsed = time.time() - start
+    roots = [replica.read(lambda db: db.tree.root) for replica in replicas]
+    assert roots[0] == roots[1] == roots[2]
+    sent = sum(replica.bytes_sent for replica in replicas) / 2.0 ** 20
+    print ("repaired {} diverging keys ({:.1%}) in {:.1f}s, "
+           "{:.1f} MB sent").format(
+        diverging, args.divergence, elapsed, sent)
+
+
+def _serve_puts(store_class, filename, users, snapshotting, done, puts):
+    """Re-enrolls random users until done is set, counting puts while
+    snapshotting is set"""
+    store = store_class(filename, "secrets")
+    data = os.urandom(2 ** 16)
+    while not done.is_set():
+        offset = random.randrange(len(data) - sum(SECRETS_ROW_SIZES))
+        row = []
+        for size in SECRETS_ROW_SIZES:
+            row.append(data[offset:offset + size])
+            offset += size
+        store.put("user{:09d}".format(random.randrange(users)),
+                  tuple(row) + PUT_VERSION)
+        if snapshotting.is_set():
+            with puts.get_lock():
+                puts.value += 1
+        if random.random() < 0.01:
+            store.commit()
+    store.commit()
+
+
+def snapshot_bench(directory, args):
+    """Bootstraps a replica with args.users users: snapshots a database
+    while another process keeps putting, and loads the snapshot and a CSV
+    export of it, against loading with batched puts."""
+    import multiprocessing
+    import snapshot
+
+    store_class = STORAGE_ENGINES[args.engine]
+    data = os.urandom(2 ** 20)
+
+    def rows():
+        for i in xrange(args.users):
+            offset = i * 8 % (len(data) - sum(SECRETS_ROW_SIZES))
+            row = []
+            for size in SECRETS_ROW_SIZES:
+                row.append(data[offset:offset + size])
+                offset += size
+            yield "user{:09d}".format(i), tuple(row) + (
+                str(i % 100), "2017-05-01T12:00:00.{:06d}".format(i))
+
+    source = os.path.join(directory, "source")
+    store_class.bulk_load(source, "secrets", rows())
+
+    # The serving replica is another process, as it would be
+    snapshotting = multiprocessing.Event()
+    done = multiprocessing.Event()
+    puts = multiprocessing.Value("l", 0)
+    server = multiprocessing.Process(target=_serve_puts, args=(
+        store_class, source, args.users, snapshotting, done, puts))
+    server.start()
+    snapshotting.set()
+    time.sleep(5)
+    snapshotting.clear()
+    idle_rate = puts.value / 5.0
+    puts.value = 0
+
+    filename = os.path.join(directory, "snapshot")
+    snapshotting.set()
+    start = time.time()
+    count = snapshot.create_snapshot(source, "secrets", filename,
+                                     args.engine)
+    elapsed = time.time() - start
+    snapshotting.clear()
+    done.set()
+    server.join()
+    assert count == args.users
+    print ("{}, {} users: snapshot {:.1f}s, {:.0f} MB; {:.0f} puts/s "
+           "served meanwhile, {:.0f} without").format(
+        args.engine, args.users, elapsed,
+        os.path.getsize(filename) / 2.0 ** 20, puts.value / elapsed,
+        idle_rate)
+
+    start = time.time()
+    assert sum(1 for _ in snapshot.Snapshot(filename).rows()) == args.users
+    print "verify: {:.1f}s".format(time.time() - start)
+
+    start = time.time()
+    _, count = snapshot.load(filename, os.path.join(directory, "replica"),
+                             args.engine)
+    assert count == args.users
+    print "load snapshot: {:.1f}s".format(time.time() - start)
+
+    if args.baseline:
+        store = store_class(os.path.join(directory, "baseline"), "secrets")
+        batch = []
+        start = time.time()
+        for key, row in snapshot.Snapshot(filename).rows():
+            batch.append(("put", key, row))
+            if len(batch) == 10000:
+                store.batch(batch)
+                store.commit()
+                batch = []
+        store.batch(batch)
+        store.commit()
+        print "put snapshot rows in transactions of 10000: {:.1f}s".format(
+            time.time() - start)
+        del store
+
+    csv_filename = os.path.join(directory, "export.csv")
+    start = time.time()
+    snapshot.export_csv(snapshot.Snapshot(filename).rows(), "secrets",
+                        csv_filename)
+    export = time.time() - start
+    start = time.time()
+    _, count = snapshot.load(csv_filename, os.path.join(directory, "csv"),
+                             args.engine)
+    assert count == args.users
+    print "export CSV: {:.1f}s, {:.0f} MB; load CSV: {:.1f}s".format(
+        export, os.path.getsize(csv_filename) / 2.0 ** 20,
+        time.time() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the secrets databases. get and put use "
+                    "LameSecretsDB, which has the same storage path as "
+                    "SecretsDB without the threshold encryption.")
+    subparsers = parser.add_subparsers()
+    get_parser = subparsers.add_parser(
+        "get", help="get latency by number of users")
+    get_parser.add_argument("--users", type=int, nargs="+",
+                            default=[10000, 1000000, 10000000])
+    get_parser.add_argument("--gets", type=int, default=10000)
+    get_parser.add_argument("--legacy-gets", type=int, default=20,
+                            help="gets against the table without a primary "
+                                 "key (each is a full scan), 0 to skip")
+    get_parser.set_defaults(bench=get_bench)
+    put_parser = subparsers.add_parser(
+        "put", help="enrolls / s and commit latency by commit policy")
+    put_parser.add_argument("--enrolls", type=int, default=5000)
+    put_parser.set_defaults(bench=put_bench)
+    store_parser = subparsers.add_parser(
+        "store", help="get / put / mixed throughput by storage engine")
+    store_parser.add_argument("--users", type=int, default=1000000)
+    store_parser.add_argument("--ops", type=int, default=100000)
+    store_parser.set_defaults(bench=store_bench)
+    catchup_parser = subparsers.add_parser(
+        "catchup", help="catch-up transfer rate of each side")
+    catchup_parser.add_argument("--entries", type=int, default=1000000)
+    catchup_parser.add_argument("--page-size", type=int, default=250)
+    catchup_parser.set_defaults(bench=catchup_bench)
+    antientropy_parser = subparsers.add_parser(
+        "antientropy", help="Merkle tree upkeep per put and repair time")
+    antientropy_parser.add_argument("--keys", type=int, default=1000000)
+    antientropy_parser.add_argument("--divergence", type=float, default=0.01)
+    antientropy_parser.set_defaults(bench=antientropy_bench)
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="bulk load, snapshot and load a replica's database")
+    snapshot_parser.add_argument("--users", type=int, default=1000000)
+    snapshot_parser.add_argument("--engine", choices=sorted(STORAGE_ENGINES),
+                                 default="sqlite")
+    snapshot_parser.add_argument(
+        "--baseline", action="store_true",
+        help="also time loading the snapshot with batched puts")
+    snapshot_parser.set_defaults(bench=snapshot_bench)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        args.bench(directory, args)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,115 @@
+import sys
+import threading
+import traceback
+import Queue
+
+from completion_queue import CompletionQueue
+
+
+class DBExecutor(object):
+    def __init__(self, open_db):
+        """Runs SecretsDB / LameSecretsDB calls on a dedicated I/O thread so
+        that a slow disk does not stall the event loop. Results are handed
+        back through a completion queue that the event loop drains, and
+        callbacks run on the event loop thread.
+
+        The database is opened on the I/O thread, since sqlite3 connections
+        may only be used by the thread that made them. One thread does reads
+        and writes, so a get sees every earlier put.
+
+        If an operation fails, its callback gets the exception instead of
+        the result, e.g. a get of an unknown key calls callback(KeyError).
+
+        Args:
+            open_db (() -> SecretsDB or LameSecretsDB): its exceptions are
+                raised here
+        """
+        self._requests = Queue.Queue()
+        self._completions = CompletionQueue()
+        self._opened = threading.Event()
+        self._open_error = None  # sys.exc_info() if open_db raised
+        self._thread = threading.Thread(target=self._run, args=(open_db,))
+        self._thread.daemon = True
+        self._thread.start()
+        self._opened.wait()
+        if self._open_error is not None:
+            error_type, error, error_traceback = self._open_error
+            raise error_type, error, error_traceback
+
+    def get(self, key, callback):
+        """Calls callback(value) on the event loop thread."""
+        self._requests.put((lambda db: db.get(key), callback, False))
+
+    def put(self, key, value, callback=None, **columns):
+        """Calls callback(None) on the event loop thread once the put is
+        durable, or callback(error) if it failed. columns are passed on to
+        the database's put."""
+        self._requests.put((
+            lambda db: db.put(
+                key, value,
+                lambda error=None: self._complete(callback, error), **columns),
+            callback, True))
+
+    def select(self, timestamps, after, limit, callback):
+        """Calls callback((entries, position)), see SecretsDB.select."""
+        self._requests.put((
+            lambda db: db.select(timestamps, after, limit), callback, False))
+
+    def high_water(self, callback):
+        """Calls callback({client id: timestamp}), see
+        SecretsDB.high_water."""
+        self._requests.put((lambda db: db.high_water(), callback, False))
+
+    def apply(self, entries, callback=None):
+        """Stores a catch-up page, see SecretsDB.apply. callback(None) runs
+        on the event loop thread once it is durable, or callback(error) if
+        it failed."""
+        self._requests.put((
+            lambda db: db.apply(
+                entries, lambda error=None: self._complete(callback, error)),
+            callback, True))
+
+    def run(self, operation, callback=None):
+        """Calls callback(operation(db)) on the event loop thread, for
+        reads that need no method of their own."""
+        self._requests.put((operation, callback, False))
+
+    def timestamps(self, keys, callback):
+        """Calls callback({key: timestamp}) on the event loop thread, see
+        SecretsDB.timestamps."""
+        self._requests.put((lambda db: db.timestamps(keys), callback, False))
+
+    def _complete(self, callback, *args):
+        if callback is not None:
+            self._completions.put(callback, *args)
+
+    def _run(self, open_db):
+        try:
+            db = open_db()
+        except Exception:
+            self._open_error = sys.exc_info()
+            return
+        finally:
+            self._opened.set()
+        while True:
+            # Only wake up for the commit interval while puts are waiting
+            timeout = None
+            if db.committer.pending:
+                timeout = db.committer.interval
+            try:
+                operation, callback, write = self._requests.get(
+                    timeout=timeout)
+            except Queue.Empty:
+                db.poll()
+                continue
+
+            try:
+                result = operation(db)
+            except Exception as error:
+                traceback.print_exc()
+                self._complete(callback, error)
+            else:
+                # The committer calls back once a write is durable
+                if not write:
+                    self._complete(callback, result)
+            db.poll()
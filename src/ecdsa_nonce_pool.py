@@ -0,0 +1,110 @@
+import multiprocessing
+import time
+from Queue import Empty
+
+from ecdsa.numbertheory import inverse_mod
+from ecdsa.util import randrange, string_to_number, sigencode_string
+
+
+def _fill_pool(curve, queue, produced):
+    """Runs in a child process, so that the point multiplications don't hold
+    the signing process' GIL. Blocks whenever the pool is full."""
+    n = curve.order
+    G = curve.generator
+    while True:
+        k = randrange(n)
+        r = (k * G).x() % n
+        if r == 0:
+            continue
+        queue.put((inverse_mod(k, n), r))
+        with produced.get_lock():
+            produced.value += 1
+
+
+class ECDSANoncePool(object):
+    def __init__(self, curve, size):
+        """Bounded pool of precomputed ECDSA nonces. For a nonce k only
+        (k^-1 mod n, r = (k*G).x mod n) is kept, which is all that signing
+        needs, so a pooled signature costs a few modular multiplications.
+
+        Args:
+            curve (ecdsa.curves.Curve)
+            size (int): maximum number of precomputed nonces
+        """
+        self._curve = curve
+        self._queue = multiprocessing.Queue(size)
+        self._produced = multiprocessing.Value('L', 0)
+        self._consumed = 0
+        self._misses = 0  # signatures made while the pool was empty
+        self._start = time.time()
+        self._process = multiprocessing.Process(
+            target=_fill_pool, args=(curve, self._queue, self._produced))
+        self._process.daemon = True
+        self._process.start()
+
+    def sign(self, sk, msg):
+        """Signs msg like sk.sign(msg), using a pooled nonce if there is one.
+
+        Args:
+            sk (SigningKey)
+            msg (string)
+
+        Returns:
+            string: signature in sigencode_string format
+        """
+        try:
+            k_inv, r = self._queue.get_nowait()
+        except Empty:
+            self._misses += 1
+            return sk.sign(msg)
+        self._consumed += 1
+
+        n = self._curve.order
+        digest = sk.default_hashfunc(msg).digest()
+        assert len(digest) <= self._curve.baselen
+        e = string_to_number(digest)
+        s = (k_inv * (e + sk.privkey.secret_multiplier * r)) % n
+        if s == 0:
+            return sk.sign(msg)
+        return sigencode_string(r, s, n)
+
+    def metrics(self):
+        """Pool depth, nonces precomputed so far and per second, and how many
+        signatures used the pool vs. had to compute their own nonce."""
+        elapsed = time.time() - self._start
+        produced = self._produced.value
+        return {
+            "pool_depth": self._queue.qsize(),
+            "produced": produced,
+            "refill_rate": produced / elapsed if elapsed > 0 else 0.0,
+            "consumed": self._consumed,
+            "misses": self._misses,
+        }
+
+    def close(self):
+        self._process.terminate()
+
+
+if __name__ == '__main__':
+    from ecdsa import SigningKey
+
+    sk = SigningKey.generate()
+    vk = sk.get_verifying_key()
+    msgs = [str(i) * 64 for i in xrange(500)]
+
+    start = time.time()
+    for msg in msgs:
+        sk.sign(msg)
+    print "inline nonces: {:.0f} signs/s".format(
+        len(msgs) / (time.time() - start))
+
+    pool = ECDSANoncePool(sk.curve, len(msgs))
+    while pool.metrics()["pool_depth"] < len(msgs):
+        time.sleep(0.1)
+    start = time.time()
+    signatures = [pool.sign(sk, msg) for msg in msgs]
+    print "pooled nonces: {:.0f} signs/s".format(
+        len(msgs) / (time.time() - start))
+    assert all(vk.verify(sig, msg) for msg, sig in zip(msgs, signatures))
+    print pool.metrics()
+    pool.close()
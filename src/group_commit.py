@@ -0,0 +1,78 @@
+import time
+import traceback
+
+
+def configure_connection(conn):
+    """WAL lets readers proceed during a commit and, with synchronous=NORMAL,
+    makes a commit an append to the log instead of an fsync of the
+    database."""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+
+class GroupCommitter(object):
+    def __init__(self, conn, interval, max_rows):
+        """Commits the writes made on conn every interval seconds or every
+        max_rows writes, whichever comes first, instead of once per write.
+        Each write's callback runs once the commit covering it is done, or
+        gets the error if that commit failed.
+
+        Args:
+            conn (sqlite3.Connection or SecretsStore): has commit()
+            interval (float): seconds, 0 commits every write right away
+            max_rows (int)
+        """
+        self._conn = conn
+        self._interval = interval
+        self._max_rows = max_rows
+        self._pending = []  # (callback, time written)
+        self.commits = 0
+        self.rows = 0
+        self.latencies = []  # seconds from each write to its commit
+
+    def written(self, callback=None):
+        """Call after each write on conn.
+
+        Args:
+            callback (() -> None): runs once the write is committed, or
+                callback(error) if the commit failed
+        """
+        self._pending.append((callback, time.time()))
+        if self._interval <= 0 or len(self._pending) >= self._max_rows:
+            self.commit()
+
+    def poll(self):
+        """Commits if the oldest pending write has waited interval seconds.
+        Call periodically from the thread that writes."""
+        if (self._pending and
+                time.time() - self._pending[0][1] >= self._interval):
+            self.commit()
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def pending(self):
+        """Number of writes waiting for a commit"""
+        return len(self._pending)
+
+    def commit(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self._conn.commit()
+        except Exception as error:
+            traceback.print_exc()
+            for callback, _ in pending:
+                if callback is not None:
+                    callback(error)
+            return
+        now = time.time()
+        self.commits += 1
+        self.rows += len(pending)
+        for callback, written in pending:
+            self.latencies.append(now - written)
+            if callback is not None:
+                callback()
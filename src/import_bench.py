@@ -0,0 +1,49 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ["server", "client", "messaging_service"]
+
+IMPORT_SNIPPET = """
+import time
+start = time.time()
+import {}
+print time.time() - start
+"""
+
+
+def time_import(module, verify_params=False):
+    """Seconds taken to import module in a fresh interpreter."""
+    env = None
+    if verify_params:
+        env = dict(os.environ, SPAKE2PLUS_VERIFY_PARAMS="1")
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module)], env=env)
+    return float(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measures process start-up (import) time.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--verify-params", action="store_true",
+                        help="recompute precomputed PAKE constants")
+    parser.add_argument("--out", default="import-times")
+    args = parser.parse_args()
+
+    # Warm up so that .pyc compilation is not counted
+    for module in MODULES:
+        time_import(module)
+
+    results = {}
+    for module in MODULES:
+        times = sorted(time_import(module, args.verify_params)
+                       for _ in xrange(args.runs))
+        results[module] = times
+        print "{:<20} min {:.4f}s median {:.4f}s".format(
+            module, times[0], times[len(times) // 2])
+
+    with open(args.out, "w") as f:
+        f.write(json.dumps(results))
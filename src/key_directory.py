@@ -0,0 +1,101 @@
+import json
+from os import path
+
+CONFIG_DIR = "config"
+DIRECTORY_FILENAME = path.join(CONFIG_DIR, "keys.json")
+
+
+class KeyDirectory(object):
+    def __init__(self, filename=DIRECTORY_FILENAME):
+        """Public keys of every replica and client, read once from a single
+        file. Lookups never touch the disk.
+
+        The file is JSON: {scheme: {node_id: base64 public key}}.
+
+        Args:
+            filename (string)
+        """
+        if not path.isfile(filename):
+            raise IOError(
+                "No key directory at {}, run `python key_directory.py` "
+                "first".format(filename))
+        with open(filename) as f:
+            contents = json.loads(f.read())
+
+        self._keys = {}  # scheme -> {node_id: public key bytes}
+        for scheme, keys in contents.iteritems():
+            self._keys[scheme] = dict(
+                (int(node_id), key.decode('base64'))
+                for node_id, key in keys.iteritems())
+
+    def public_keys(self, scheme):
+        """Returns {node_id: public key bytes} for scheme."""
+        return self._keys.get(scheme, {})
+
+    def public_key(self, scheme, node_id):
+        """Returns public key bytes, or None if node_id is unknown."""
+        return self.public_keys(scheme).get(node_id)
+
+
+def private_key_filename(scheme, node_id):
+    return path.join(CONFIG_DIR, "{}_{}.key".format(node_id, scheme))
+
+
+_directory = None
+
+
+def get_key_directory():
+    """Process-wide KeyDirectory, shared by every signature service."""
+    global _directory
+    if _directory is None:
+        _directory = KeyDirectory()
+    return _directory
+
+
+def write_key_directory(keys, filename=DIRECTORY_FILENAME):
+    """
+    Args:
+        keys ({scheme: {node_id: public key bytes}})
+    """
+    contents = dict(
+        (scheme, dict((str(node_id), key.encode('base64'))
+                      for node_id, key in scheme_keys.iteritems()))
+        for scheme, scheme_keys in keys.iteritems())
+    with open(filename, "w") as f:
+        f.write(json.dumps(contents, sort_keys=True))
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    from signature_service import KEY_GENERATORS
+    from link_authentication import KEY_GENERATORS as LINK_KEY_GENERATORS
+    from utils import CONSTANTS
+
+    KEY_GENERATORS = dict(KEY_GENERATORS, **LINK_KEY_GENERATORS)
+
+    parser = argparse.ArgumentParser(
+        description="Generates a private key per node and the shared public "
+                    "key directory.")
+    parser.add_argument(
+        "--ids", type=int, nargs="+",
+        default=range(CONSTANTS.N) + [100, 101],
+        help="replica and client ids (default: all replicas and clients)")
+    parser.add_argument(
+        "--schemes", nargs="+", default=sorted(KEY_GENERATORS.keys()))
+    args = parser.parse_args()
+
+    if not path.isdir(CONFIG_DIR):
+        os.makedirs(CONFIG_DIR)
+
+    keys = {}
+    for scheme in args.schemes:
+        keys[scheme] = {}
+        for node_id in args.ids:
+            private_key, public_key = KEY_GENERATORS[scheme]()
+            with open(private_key_filename(scheme, node_id), "w") as f:
+                f.write(private_key)
+            keys[scheme][node_id] = public_key
+    write_key_directory(keys)
+    print "Wrote {} keys for {} nodes to {}".format(
+        len(args.schemes), len(args.ids), DIRECTORY_FILENAME)
@@ -1,43 +1,35 @@
-import sqlite3
+from group_commit import GroupCommitter
+from secrets_store import get_secrets_store
 
 
 class LameSecretsDB(object):
-    def __init__(self):
-        """Writes to db_filename somehow."""
-        self._conn = sqlite3.connect('databases/lamesecretsdb')
-        self._conn.text_factory = str
-        self._cursor = self._conn.cursor()
+    def __init__(self, db_filename='databases/lamesecretsdb',
+                 commit_interval=0, commit_rows=1):
+        """Writes to db_filename somehow. Puts are group committed as in
+        SecretsDB."""
+        self._store = get_secrets_store()(db_filename, "lame_secrets")
+        self._committer = GroupCommitter(
+            self._store, commit_interval, commit_rows)
 
     def get(self, key):
-        self._cursor.execute("SELECT * FROM lame_secrets WHERE key=?", (key,))
-        key, value = self._cursor.fetchone()
+        row = self._store.get(key)
+        if row is None:
+            raise KeyError(key)
+        value, = row
         return value
 
-    def put(self, key, value):
-        self._cursor.execute("INSERT INTO lame_secrets VALUES (?,?)", (key, value))
-        self._conn.commit()
+    def put(self, key, value, callback=None):
+        # A re-enroll replaces the user's secret
+        self._store.put(key, (value,))
+        self._committer.written(callback)
 
-    def select(self, timestamps):
-        """Selects all entries such that entry.timestamp >=
-        timestamps[entry.client] - window_size
+    def poll(self):
+        self._committer.poll()
 
-        Args:
-            timestamps ({client id: timestamp})
-        """
-        pass
+    @property
+    def committer(self):
+        return self._committer
 
-
-if __name__ == '__main__':
-    conn = sqlite3.connect('databases/lamesecretsdb')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE lame_secrets
-                 (key TEXT, value BLOB)''')
-    conn.commit()
-
-    db = LameSecretsDB()
-    db.put("brendon", "eats food")
-    print db.get("brendon")
-    db.put("kenneth", 1234)
-    print db.get("brendon")
-    print db.get("kenneth")
-    print db.get("not there")
\ No newline at end of file
+    @property
+    def store(self):
+        return self._store
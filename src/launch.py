@@ -2,6 +2,21 @@ from utils import CONSTANTS
 from fabric.api import local
 import time
 
+# Subsystems that are off by default, turned on for the replicas and the
+# application client
+SETTINGS = [
+    "THRESHOLD_SIGNATURES=True",
+    "SIGNATURE_CACHE_SIZE=10000",
+    "WRITE_AHEAD_LOG=True",
+    "ANTI_ENTROPY_INTERVAL=10",
+    "CATCH_UP_ON_START=True",
+    "CIPHERTEXT_CACHE_BYTES=16777216",  # 16 MiB
+]
+OPTIONS = " ".join("--set " + setting for setting in SETTINGS)
+
 for n in xrange(CONSTANTS.N):
-    local('python messaging_service.py {} 2> e{}.txt &'.format(n, n))
+    local('python messaging_service.py {} {} 2> e{}.txt &'.format(
+        n, OPTIONS, n))
     time.sleep(0.5)
+local('python client.py {} {} 2> e{}.txt &'.format(
+    CONSTANTS.N, OPTIONS, CONSTANTS.N))
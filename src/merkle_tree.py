@@ -0,0 +1,115 @@
+import hashlib
+
+
+def _bytes(string):
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return string
+
+
+class MerkleTree(object):
+    def __init__(self, fanout=16, depth=4):
+        """Hash tree over the put versions, (key, client_id, timestamp), in a
+        secrets table, for replicas to find where their tables differ
+        (anti-entropy). Versions rather than rows are hashed, since every
+        replica encrypts a secret with its own randomness.
+
+        Keys are spread over fanout ** depth buckets by their hash. A bucket's
+        hash is the XOR of the hashes of its versions and every node's is the
+        XOR of its children's, so a put changes the depth + 1 nodes on one
+        path in place, and the tree doesn't depend on the order of puts. XOR
+        hashes can be forged by a replica that wants to hide a difference,
+        which a faulty replica could do by not answering anyway.
+
+        Args:
+            fanout (int)
+            depth (int): levels below the root; the buckets are level depth
+        """
+        self._fanout = fanout
+        self._depth = depth
+        # levels[l][i] is node i of level l, as an int
+        self._levels = [[0] * fanout ** level for level in xrange(depth + 1)]
+
+    @property
+    def fanout(self):
+        return self._fanout
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def root(self):
+        return self.hashes(0, [0])[0]
+
+    def bucket(self, key):
+        return (int(hashlib.sha1(_bytes(key)).hexdigest()[:8], 16) %
+                len(self._levels[-1]))
+
+    @staticmethod
+    def _version_hash(key, version):
+        client_id, timestamp = version
+        return long(hashlib.sha1("\0".join(
+            [_bytes(key), _bytes(client_id), _bytes(timestamp)])).hexdigest(),
+            16)
+
+    def update(self, key, old, new):
+        """Replaces the version of key.
+
+        Args:
+            key (string)
+            old ((client_id, timestamp)): None if key wasn't stored
+            new ((client_id, timestamp)): None if key is deleted
+        """
+        delta = 0
+        if old is not None:
+            delta ^= self._version_hash(key, old)
+        if new is not None:
+            delta ^= self._version_hash(key, new)
+        if not delta:
+            return
+        index = self.bucket(key)
+        for level in reversed(self._levels):
+            level[index] ^= delta
+            index //= self._fanout
+
+    def check(self, level, indices):
+        """Raises ValueError unless indices are nodes of level, as they may
+        come from another replica"""
+        if (not isinstance(level, (int, long)) or
+                not 0 <= level <= self._depth):
+            raise ValueError("No level {} in the tree".format(level))
+        size = len(self._levels[level])
+        for index in indices:
+            if not isinstance(index, (int, long)) or not 0 <= index < size:
+                raise ValueError(
+                    "No node {} at level {}".format(index, level))
+
+    def hashes(self, level, indices):
+        """Returns {index: hash} of nodes at level, hashes as hex strings"""
+        self.check(level, indices)
+        nodes = self._levels[level]
+        return dict((index, "{:040x}".format(nodes[index]))
+                    for index in indices)
+
+    def children(self, level, indices):
+        """Indices of the children of the nodes indices of level, one level
+        down"""
+        self.check(level, indices)
+        if level == self._depth:
+            raise ValueError("Buckets have no children")
+        return [index * self._fanout + child for index in indices
+                for child in xrange(self._fanout)]
+
+
+if __name__ == '__main__':
+    import os
+    import time
+
+    tree = MerkleTree()
+    keys = [os.urandom(8).encode("hex") for _ in xrange(100000)]
+    start = time.time()
+    for key in keys:
+        tree.update(key, None, ("100", "2017-05-01T12:00:00.000000"))
+    elapsed = time.time() - start
+    print "update: {:.1f}us per put".format(elapsed / len(keys) * 1e6)
@@ -1,18 +1,43 @@
 import abc
+import base64
 import json
 from datetime import datetime
-from tpke import serialize, deserialize1
+try:
+    from tpke import serialize, deserialize1
+except ImportError:  # charm is only needed for decryption shares
+    serialize = deserialize1 = None
 
 class Message(object):
     __metaclass__ = abc.ABCMeta
 
     def set_signature(self, signature_service=None, signature=None):
-        #assert signature_service or signature
-        if signature is not None:
+        """Messages built with neither are signed later, by
+        SignatureService.sign_later."""
+        if signature is not None or signature_service is None:
             self._signature = signature
         else:
             self._signature = signature_service.sign(self.data)
 
+    def set_share(self, threshold_signature_service=None, share=None):
+        """Attaches a threshold signature share on certificate_data. Messages
+        sent without a ThresholdSignatureService carry no share."""
+        if share is not None or threshold_signature_service is None:
+            self._share = share
+        else:
+            self._share = threshold_signature_service.sign_share(
+                self.certificate_data)
+
+    @property
+    def share(self):
+        return self._share
+
+    @property
+    def certificate_data(self):
+        """Statement every server signs a share of. Unlike data, it does not
+        depend on the sender, so f + 1 shares combine into one certificate.
+        """
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def verify_signatures(self, signature_service):
         """Validates all of the necessary signatures.
@@ -54,6 +79,8 @@ class Message(object):
             return EnrollRequest.from_json(json_obj)
         elif json_obj["type"] == "LOGIN_RESPONSE":
             return LoginResponse.from_json(json_obj)
+        elif json_obj["type"] == "LOGIN_CONFIRM":
+            return LoginConfirm.from_json(json_obj)
         elif json_obj["type"] == "ENROLL_RESPONSE":
             return EnrollResponse.from_json(json_obj)
         elif json_obj["type"] == "GET":
@@ -72,6 +99,10 @@ class Message(object):
             return CatchUpRequestMessage.from_json(json_obj)
         elif json_obj["type"] == "CATCH_UP_RESPONSE":
             return CatchUpResponseMessage.from_json(json_obj)
+        elif json_obj["type"] == "ANTI_ENTROPY_REQUEST":
+            return AntiEntropyRequestMessage.from_json(json_obj)
+        elif json_obj["type"] == "ANTI_ENTROPY_RESPONSE":
+            return AntiEntropyResponseMessage.from_json(json_obj)
         assert False, "Unidentifiable type %s" % json_obj["type"]
 
 
@@ -169,10 +200,19 @@ class EnrollRequest(Message):
 
 
 class LoginResponse(Message):
-    def __init__(self, username, v, encrypted, timestamp=None):
+    def __init__(self, username, v, confirmation, timestamp=None):
+        """Server's SPAKE2+ message, plus its key confirmation MAC so the user
+        can tell whether the login succeeded without another round trip.
+
+        Args:
+            username (string)
+            v (string): SPAKE2PLUS_B start() message, empty if the login
+                was rejected
+            confirmation (string): SPAKE2PLUS_B confirmation()
+        """
         self._username = username
         self._v = v
-        self._encrypted = encrypted
+        self._confirmation = confirmation
         self._timestamp = timestamp
         if timestamp is None:
             self._timestamp = datetime.now().isoformat()
@@ -181,17 +221,25 @@ class LoginResponse(Message):
         return json.dumps(
             {"type": "LOGIN_RESPONSE",
              "username": self.username, "v": self.v.encode('base-64'),
-             "encrypted": self.encrypted,
+             "confirmation": self.confirmation.encode('base-64'),
              "timestamp": self.timestamp})
 
+    @classmethod
+    def failure(cls, username, timestamp):
+        """Tells the user the login was rejected"""
+        return cls(username, "", "", timestamp)
+
+    @property
+    def failed(self):
+        return not self._v
+
     @property
     def v(self):
         return self._v
 
     @property
-    def encrypted(self):
-        return self._encrypted
-
+    def confirmation(self):
+        return self._confirmation
 
     @property
     def timestamp(self):
@@ -206,7 +254,8 @@ class LoginResponse(Message):
         assert json_obj["type"] == "LOGIN_RESPONSE"
         return cls(
                 json_obj["username"], json_obj["v"].decode('base-64'),
-                json_obj["encrypted"], json_obj["timestamp"])
+                json_obj["confirmation"].decode('base-64'),
+                json_obj["timestamp"])
 
     def verify_signatures(self, signature_service=None):
         return True
@@ -216,17 +265,83 @@ class LoginResponse(Message):
     __repr__ = __str__
 
 
+class LoginConfirm(Message):
+    def __init__(self, username, confirmation, user_id, timestamp):
+        """User's key confirmation MAC, sent after checking the server's.
+        Lets the application client drop failed logins.
+
+        Args:
+            username (string)
+            confirmation (string): SPAKE2PLUS_A confirmation()
+            user_id (int)
+            timestamp (string): timestamp of the LoginRequest
+        """
+        self._username = username
+        self._confirmation = confirmation
+        self._user_id = user_id
+        self._timestamp = timestamp
+
+    def to_json(self):
+        return json.dumps(
+            {"type": "LOGIN_CONFIRM",
+             "username": self.username,
+             "confirmation": self.confirmation.encode('base-64'),
+             "user_id": self.user_id, "timestamp": self.timestamp})
+
+    @property
+    def confirmation(self):
+        return self._confirmation
+
+    @property
+    def user_id(self):
+        return self._user_id
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def username(self):
+        return self._username
+
+    @classmethod
+    def from_json(cls, json_obj):
+        assert json_obj["type"] == "LOGIN_CONFIRM"
+        return cls(
+                json_obj["username"],
+                json_obj["confirmation"].decode('base-64'),
+                json_obj["user_id"], json_obj["timestamp"])
+
+    def verify_signatures(self, signature_service=None):
+        return True
+
+    def __str__(self):
+        return "LoginConfirm ({})".format(self.username)
+    __repr__ = __str__
+
+
 class EnrollResponse(Message):
-    def __init__(self, username, timestamp=None):
+    def __init__(self, username, timestamp=None, failed=False):
+        """
+        Args:
+            username (string)
+            failed (bool): the secret could not be stored
+        """
         self._username = username
         self._timestamp = timestamp
         if timestamp is None:
             self._timestamp = datetime.now().isoformat()
+        self._failed = failed
 
     def to_json(self):
         return json.dumps(
             {"type": "ENROLL_RESPONSE",
-             "username": self.username, "timestamp": self.timestamp})
+             "username": self.username, "timestamp": self.timestamp,
+             "failed": self.failed})
+
+    @property
+    def failed(self):
+        return self._failed
 
     @property
     def timestamp(self):
@@ -239,7 +354,8 @@ class EnrollResponse(Message):
     @classmethod
     def from_json(cls, json_obj):
         assert json_obj["type"] == "ENROLL_RESPONSE"
-        return cls(json_obj["username"], json_obj["timestamp"])
+        return cls(json_obj["username"], json_obj["timestamp"],
+                   json_obj["failed"])
 
     def verify_signatures(self, signature_service=None):
         return True
@@ -250,20 +366,40 @@ class EnrollResponse(Message):
 
 
 class IntroMessage(Message):
-    def __init__(self, uuid):
+    def __init__(self, uuid, nonce=None, tag=None):
+        """First message on a new connection. With link MACs, both sides
+        send them to agree on the link's session key.
+
+        Args:
+            uuid (int): id of the sender
+            nonce (string): fresh per connection and side
+            tag (string): proves the sender holds its static key, see
+                MACService.handshake_tag
+        """
         self._id = uuid
+        self._nonce = nonce
+        self._tag = tag
 
     def to_json(self):
-        return json.dumps({"type": "INTRO", "id": self._id})
+        return json.dumps({"type": "INTRO", "id": self._id,
+                           "nonce": self._nonce, "tag": self._tag})
 
     @property
     def id(self):
         return self._id
 
+    @property
+    def nonce(self):
+        return self._nonce
+
+    @property
+    def tag(self):
+        return self._tag
+
     @classmethod
     def from_json(cls, json_obj):
         assert json_obj["type"] == "INTRO"
-        return cls(json_obj["id"])
+        return cls(json_obj["id"], json_obj.get("nonce"), json_obj.get("tag"))
 
     def verify_signatures(self, signature_service):
         raise NotImplementedError("no")
@@ -379,9 +515,12 @@ class DecryptionShareMessage(Message):
                         str(self._sender_id),
                         self._get_message.data, self._get_message._signature])
 
-    def verify_signatures(self, signature_service):
+    def verify_signatures(self, signature_service, replica_authenticator=None):
+        """The embedded GetMessage is always checked with signature_service;
+        the share itself with replica_authenticator if given."""
+        replica_authenticator = replica_authenticator or signature_service
         return (self._get_message.verify_signatures(signature_service) and
-                signature_service.validate(self.data, self._sender_id, self._signature))
+                replica_authenticator.validate(self.data, self._sender_id, self._signature))
 
     def to_json(self):
         return json.dumps({
@@ -409,19 +548,22 @@ class DecryptionShareMessage(Message):
 
 class GetResponseMessage(Message):
     def __init__(self, get_msg, secret, sender_id,
-                 signature_service=None, signature=None):
+                 signature_service=None, signature=None,
+                 threshold_signature_service=None, share=None):
         """Constructs
 
         Args:
             get_msg (string): get_msg that was got
-            secret (Secret)
+            secret (Secret): empty if the server has no secret under the key
             sender_id (int)
             signature_service (SignatureService)
+            threshold_signature_service (ThresholdSignatureService)
         """
         self._get_msg = get_msg
         self._secret = secret
         self._sender_id = sender_id
         self.set_signature(signature_service, signature)
+        self.set_share(threshold_signature_service, share)
 
     @property
     def key(self):
@@ -445,7 +587,15 @@ class GetResponseMessage(Message):
 
     @property
     def data(self):
-        return "".join([self._secret.encode('base-64'), str(self._sender_id)])
+        # Ties the signature to the GetMessage it answers
+        return "".join(["RESPONSE", self._get_msg.data,
+                        self._get_msg.timestamp,
+                        self._secret.encode('base-64'), str(self._sender_id)])
+
+    @property
+    def certificate_data(self):
+        return "".join(["RESPONSE", self._get_msg.data,
+                        self._get_msg.timestamp, self._secret.encode('base-64')])
 
     def verify_signatures(self, signature_service):
         return signature_service.validate(self.data, self._sender_id, self._signature)
@@ -454,7 +604,7 @@ class GetResponseMessage(Message):
         return json.dumps({
             "type": "RESPONSE", "get_msg": self.get_msg.to_json(),
             "secret": self._secret.encode('base-64'), "sender_id": self.sender_id,
-            "signature": self.signature})
+            "signature": self.signature, "share": self.share})
 
     @classmethod
     def from_json(cls, json_obj):
@@ -462,7 +612,7 @@ class GetResponseMessage(Message):
         return cls(
                 Message.from_json(json.loads(json_obj["get_msg"])),
                 json_obj["secret"].decode('base-64'), json_obj["sender_id"],
-                signature=json_obj["signature"])
+                signature=json_obj["signature"], share=json_obj["share"])
 
     def __str__(self):
         return "GetResponseMessage ({})".format(self.key)
@@ -577,9 +727,12 @@ class PutAcceptMessage(Message):
             [self._put_message.data, self._put_message._signature,
              str(self._sender_id)])
 
-    def verify_signatures(self, signature_service):
+    def verify_signatures(self, signature_service, replica_authenticator=None):
+        """The embedded PutMessage is always checked with signature_service;
+        the accept itself with replica_authenticator if given."""
+        replica_authenticator = replica_authenticator or signature_service
         return (self._put_message.verify_signatures(signature_service) and
-            signature_service.validate(self.data, self._sender_id, self._signature))
+            replica_authenticator.validate(self.data, self._sender_id, self._signature))
 
     def to_json(self):
         return json.dumps({
@@ -602,16 +755,19 @@ class PutAcceptMessage(Message):
 
 class PutCompleteMessage(Message):
     def __init__(self, put_msg, sender_id, signature_service=None,
-                 signature=None):
+                 signature=None, threshold_signature_service=None,
+                 share=None):
         """Send this when you receive 2f + 1 PutAcceptMessages
 
         Args:
             sender_id (int)
             signature_service (SignatureService)
+            threshold_signature_service (ThresholdSignatureService)
         """
         self._put_msg = put_msg
         self._sender_id = sender_id
         self.set_signature(signature_service, signature)
+        self.set_share(threshold_signature_service, share)
 
     @property
     def timestamp(self):
@@ -631,10 +787,17 @@ class PutCompleteMessage(Message):
 
     @property
     def data(self):
-        return str(self._sender_id)
+        # Ties the signature to the PutMessage it answers
+        return "".join(["PUT_COMPLETE", self._put_msg.data,
+                        self._put_msg.timestamp, str(self._sender_id)])
+
+    @property
+    def certificate_data(self):
+        return "".join(["PUT_COMPLETE", self._put_msg.data,
+                        self._put_msg.timestamp])
 
     def verify_signatures(self, signature_service):
-        signature_service.validate(
+        return signature_service.validate(
                 self.data, self._sender_id, self._signature)
 
     def to_json(self):
@@ -642,34 +805,51 @@ class PutCompleteMessage(Message):
             "type": "PUT_COMPLETE",
             "put_msg": self.put_msg.to_json(),
             "sender_id": self._sender_id,
-            "signature": self._signature})
+            "signature": self._signature,
+            "share": self.share})
 
     @classmethod
     def from_json(cls, json_obj):
         assert json_obj["type"] == "PUT_COMPLETE"
         return cls(
             Message.from_json(json.loads(json_obj["put_msg"])),
-            json_obj["sender_id"], signature=json_obj["signature"])
+            json_obj["sender_id"], signature=json_obj["signature"],
+            share=json_obj["share"])
 
     def __str__(self):
         return "PutCompleteMessage ({}, {})".format(self.key, self.sender_id)
     __repr__ = __str__
 
 
+def _encode_entries(entries):
+    """JSON of secrets rows, with their byte string columns in base 64"""
+    return json.dumps([[key, [base64.b64encode(column) for column in row]]
+                       for key, row in entries])
+
+
+def _decode_entries(entries_json):
+    return [(key, tuple(base64.b64decode(column) for column in row))
+            for key, row in json.loads(entries_json)]
+
+
 class CatchUpRequestMessage(Message):
-    def __init__(self, timestamps, sender_id, signature_service=None, signature=None):
+    def __init__(self, timestamps, sender_id, signature_service=None,
+                 signature=None, after=None):
         """Send this when you reboot and need to learn about new puts that you
-        didn't receive.
+        didn't receive. The first request asks for the first page of entries;
+        each CatchUpResponseMessage says where to continue.
 
         Args:
             timestamps ({client_id: timestamp}): the latest timestamps per
-                client that you know already know about
+                client that you already know about
             sender_id (int)
             signature_service (SignatureService)
+            after ((client_id, timestamp, key)): position of the last entry
+                received, None for the first page
         """
-
-        # TODO: WHAT TO DO WITH TIMESTAMPS??
+        self._timestamps = timestamps
         self._sender_id = sender_id
+        self._after = after
         self.set_signature(signature_service, signature)
 
     @property
@@ -680,10 +860,14 @@ class CatchUpRequestMessage(Message):
     def timestamps(self):
         return self._timestamps
 
+    @property
+    def after(self):
+        return self._after
+
     @property
     def data(self):
-        return "".join([])
-        return str(self.sender_id)
+        return "".join([json.dumps(sorted(self._timestamps.items())),
+                        json.dumps(self._after), str(self.sender_id)])
 
     def verify_signatures(self, signature_service):
         return signature_service.validate(self.data, self._sender_id, self._signature)
@@ -691,6 +875,8 @@ class CatchUpRequestMessage(Message):
     def to_json(self):
         return json.dumps({
             "type": "CATCH_UP_REQUEST",
+            "timestamps": self._timestamps,
+            "after": self._after,
             "sender_id": self._sender_id,
             "signature": self._signature})
 
@@ -698,33 +884,251 @@ class CatchUpRequestMessage(Message):
     def from_json(cls, json_obj):
         assert json_obj["type"] == "CATCH_UP_REQUEST"
         return cls(
-            None, json_obj["sender_id"], signature=json_obj["signature"])
+            json_obj["timestamps"], json_obj["sender_id"],
+            signature=json_obj["signature"], after=json_obj["after"])
+
+    def __str__(self):
+        return "CatchUpRequestMessage ({}, {})".format(
+            self.sender_id, self.after)
+    __repr__ = __str__
 
 
 class CatchUpResponseMessage(Message):
-    def __init__(self, entries, sender_id, signature_service):
-        """Responds to CatchUpRequestMessages with entries.
+    def __init__(self, entries, sender_id, signature_service=None,
+                 signature=None, position=None, entries_json=None):
+        """Responds to CatchUpRequestMessages with a page of entries.
 
         Args:
-            entries (list[Entry]): has user, encrypted secret, client_id,
-                timestamp
+            entries (list[(key, row)]): stored secrets rows, which end with
+                the client_id and timestamp of their put
             sender_id (int)
             signature_service (SignatureService)
+            position ((client_id, timestamp, key)): to ask for the next page
+                after, None if this is the last page
+            entries_json (string): entries as encoded for the message, if
+                already known
         """
+        self._entries = entries
+        self._sender_id = sender_id
+        self._position = position
+        self._entries_json = entries_json
+        if entries_json is None:
+            self._entries_json = _encode_entries(entries)
+        self.set_signature(signature_service, signature)
+
     @property
     def sender_id(self):
-        pass
+        return self._sender_id
 
     @property
     def entries(self):
-        pass
+        return self._entries
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def data(self):
+        return "".join([self._entries_json, json.dumps(self._position),
+                        str(self._sender_id)])
 
     def verify_signatures(self, signature_service):
-        pass
+        return signature_service.validate(self.data, self._sender_id, self._signature)
 
     def to_json(self):
-        pass
+        # The entries are a string in the message, like nested messages
+        return json.dumps({
+            "type": "CATCH_UP_RESPONSE",
+            "entries": self._entries_json,
+            "position": self._position,
+            "sender_id": self._sender_id,
+            "signature": self._signature})
 
     @classmethod
     def from_json(cls, json_obj):
-        pass
+        assert json_obj["type"] == "CATCH_UP_RESPONSE"
+        return cls(_decode_entries(json_obj["entries"]), json_obj["sender_id"],
+                   signature=json_obj["signature"],
+                   position=json_obj["position"],
+                   entries_json=json_obj["entries"])
+
+    def __str__(self):
+        return "CatchUpResponseMessage ({}, {} entries)".format(
+            self.sender_id, len(self.entries))
+    __repr__ = __str__
+
+
+class AntiEntropyRequestMessage(Message):
+    # What a request asks for
+    HASHES = "hashes"  # of tree nodes
+    VERSIONS = "versions"  # of the keys in tree buckets
+    ENTRIES = "entries"  # stored rows of keys
+
+    def __init__(self, kind, items, sender_id, signature_service=None,
+                 signature=None, level=None, after=None):
+        """Asks another server for part of its secrets table, to compare it
+        with this server's.
+
+        Args:
+            kind (string): HASHES, VERSIONS or ENTRIES
+            items (list): node indices at level for HASHES, bucket indices
+                for the first page of VERSIONS (None for the next pages),
+                keys for ENTRIES
+            sender_id (int)
+            signature_service (SignatureService)
+            level (int): tree level of the nodes, for HASHES
+            after (string): key to continue after, for VERSIONS
+        """
+        self._kind = kind
+        self._items = items
+        self._sender_id = sender_id
+        self._level = level
+        self._after = after
+        self.set_signature(signature_service, signature)
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def items(self):
+        return self._items
+
+    @property
+    def sender_id(self):
+        return self._sender_id
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def after(self):
+        return self._after
+
+    @property
+    def data(self):
+        return "".join([self._kind, json.dumps(self._items),
+                        json.dumps(self._level), json.dumps(self._after),
+                        str(self._sender_id)])
+
+    def verify_signatures(self, signature_service):
+        return signature_service.validate(self.data, self._sender_id, self._signature)
+
+    def to_json(self):
+        return json.dumps({
+            "type": "ANTI_ENTROPY_REQUEST",
+            "kind": self._kind,
+            "items": self._items,
+            "level": self._level,
+            "after": self._after,
+            "sender_id": self._sender_id,
+            "signature": self._signature})
+
+    @classmethod
+    def from_json(cls, json_obj):
+        assert json_obj["type"] == "ANTI_ENTROPY_REQUEST"
+        return cls(
+            json_obj["kind"], json_obj["items"], json_obj["sender_id"],
+            signature=json_obj["signature"], level=json_obj["level"],
+            after=json_obj["after"])
+
+    def __str__(self):
+        return "AntiEntropyRequestMessage ({}, {})".format(
+            self.kind, self.sender_id)
+    __repr__ = __str__
+
+
+class AntiEntropyResponseMessage(Message):
+    def __init__(self, kind, items, sender_id, signature_service=None,
+                 signature=None, level=None, position=None,
+                 items_json=None):
+        """Answers an AntiEntropyRequestMessage.
+
+        Args:
+            kind (string): kind of the request
+            items: {index: hash} of the nodes for HASHES, list[(key,
+                client_id, timestamp)] for VERSIONS, list[(key, row)] for
+                ENTRIES
+            sender_id (int)
+            signature_service (SignatureService)
+            level (int): of the nodes, for HASHES
+            position (string): key to ask for the next page of VERSIONS
+                after, None if this is the last page
+            items_json (string): items as encoded for the message, if
+                already known
+        """
+        self._kind = kind
+        self._items = items
+        self._sender_id = sender_id
+        self._level = level
+        self._position = position
+        self._items_json = items_json
+        if items_json is None:
+            if kind == AntiEntropyRequestMessage.ENTRIES:
+                self._items_json = _encode_entries(items)
+            elif kind == AntiEntropyRequestMessage.HASHES:
+                self._items_json = json.dumps(sorted(items.items()))
+            else:
+                self._items_json = json.dumps(items)
+        self.set_signature(signature_service, signature)
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def items(self):
+        return self._items
+
+    @property
+    def sender_id(self):
+        return self._sender_id
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def data(self):
+        return "".join([self._kind, self._items_json, json.dumps(self._level),
+                        json.dumps(self._position), str(self._sender_id)])
+
+    def verify_signatures(self, signature_service):
+        return signature_service.validate(self.data, self._sender_id, self._signature)
+
+    def to_json(self):
+        return json.dumps({
+            "type": "ANTI_ENTROPY_RESPONSE",
+            "kind": self._kind,
+            "items": self._items_json,
+            "level": self._level,
+            "position": self._position,
+            "sender_id": self._sender_id,
+            "signature": self._signature})
+
+    @classmethod
+    def from_json(cls, json_obj):
+        assert json_obj["type"] == "ANTI_ENTROPY_RESPONSE"
+        kind = json_obj["kind"]
+        if kind == AntiEntropyRequestMessage.ENTRIES:
+            items = _decode_entries(json_obj["items"])
+        elif kind == AntiEntropyRequestMessage.HASHES:
+            items = dict(json.loads(json_obj["items"]))
+        else:
+            items = [tuple(version)
+                     for version in json.loads(json_obj["items"])]
+        return cls(kind, items, json_obj["sender_id"],
+                   signature=json_obj["signature"], level=json_obj["level"],
+                   position=json_obj["position"],
+                   items_json=json_obj["items"])
+
+    def __str__(self):
+        return "AntiEntropyResponseMessage ({}, {})".format(
+            self.kind, self.sender_id)
+    __repr__ = __str__
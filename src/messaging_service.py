@@ -9,6 +9,7 @@ from server import Server
 from buffer import Buffer
 import struct
 from utils import CONSTANTS
+from utils import set_constants
 
 class Address(object):
     def __init__(self, uuid, port, hostname, server):
@@ -42,13 +43,16 @@ class Address(object):
 
 
 class MessagingService(asyncore.dispatcher):
-    def __init__(self, addresses, server):
+    def __init__(self, addresses, server, mac_service=None):
         """Binds to a port and listens for connections.
 
         Args:
             addresses (list[Address]): contains id, port, (server or client)
             server (Server): either a client or server
+            mac_service (MACService): if given, a link key is established
+                with every replica by a handshake of IntroMessages
         """
+        self._mac_service = mac_service
         # Setup and bind to a port
         asyncore.dispatcher.__init__(self)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -68,7 +72,8 @@ class MessagingService(asyncore.dispatcher):
                 print "Trying to connect to: {}:{}".format(
                         addr.hostname, addr.port)
                 self.add_socket(Socket(
-                        server, self, (addr.hostname, addr.port)), addr.id)
+                        server, self, (addr.hostname, addr.port),
+                        uuid=addr.id), addr.id)
 
     def send(self, message, destination_id):
         """Send message to destination
@@ -83,7 +88,7 @@ class MessagingService(asyncore.dispatcher):
                 if addr.id == destination_id:
                     self.add_socket(Socket(
                         self._server, self, (addr.hostname, addr.port),
-                        addr.id))
+                        uuid=addr.id), addr.id)
         length = len(message.to_json())
         print "Sending: {} to {}".format(message, destination_id)
         self._sockets[destination_id].send(
@@ -99,6 +104,19 @@ class MessagingService(asyncore.dispatcher):
             if server.id != self._server.id:
                 self.send(message, server.id)
 
+    def connected(self, destination_id):
+        """True if a connection to destination_id is up, and with link MACs,
+        its key established
+
+        Args:
+            destination_id (int)
+        """
+        s = self._sockets.get(destination_id)
+        if s is None or not s.connected:
+            return False
+        return (self._mac_service is None or
+                self._mac_service.established(destination_id))
+
     def handle_accept(self):
         """Opens a connection"""
         pair = self.accept()
@@ -115,6 +133,113 @@ class MessagingService(asyncore.dispatcher):
         """
         self._sockets[uuid] = s
 
+    def new_handshake(self, uuid=None):
+        """_LinkHandshake for a new connection, None without link MACs.
+
+        Args:
+            uuid (int): id of the peer, if we are the connecting side
+        """
+        if self._mac_service is None:
+            return None
+        return _LinkHandshake(self._mac_service, self._server.id, uuid)
+
+
+class _LinkHandshake(object):
+    def __init__(self, mac_service, server_id, peer_id=None):
+        """Agrees on the MAC key of one connection:
+
+            connecting -> accepting: id, nonce
+            accepting -> connecting: id, nonce, tag
+            connecting -> accepting: id, tag
+
+        Tags are over both ids and both nonces under the pair's static DH
+        secret (MACService.handshake_tag), and the key is derived from the
+        same transcript. Each side installs the key, and the accepting side
+        the connection, only once the other's tag checks out. So nobody
+        without the static secret can take over a replica's link or replace
+        its key, and a recorded handshake doesn't verify again, since the
+        other side's nonce is new. If two replicas dial each other at once,
+        MACService picks the same one of the two keys at both ends.
+
+        Args:
+            mac_service (MACService)
+            server_id (int)
+            peer_id (int): id of the accepting side, if we are the
+                connecting side
+        """
+        self._mac_service = mac_service
+        self._server_id = server_id
+        self._peer_id = peer_id
+        self._nonce = mac_service.new_nonce()
+        self._hello_id = None  # id in the hello, on the accepting side
+        self._transcript = None
+        self._done = False
+        self._established = None  # id of the peer once the key is in use
+
+    def hello(self):
+        """The connecting side's first IntroMessage"""
+        return IntroMessage(self._server_id, self._nonce)
+
+    def receive(self, intro):
+        """Takes the next IntroMessage of the handshake.
+
+        Returns:
+            (IntroMessage to answer with or None, id of the peer once the
+            connection is authenticated or None)
+        """
+        if self._done:
+            return None, None
+        if self._peer_id is not None:
+            # Connecting side: the accepting side's answer
+            if intro.id != self._peer_id or intro.nonce is None:
+                return None, None
+            transcript = "{}:{}:{}:{}".format(
+                self._server_id, self._peer_id, self._nonce, intro.nonce)
+            if not self._mac_service.check_handshake_tag(
+                    self._peer_id, "accepting", transcript, intro.tag):
+                print "Bad link handshake from {}".format(intro.id)
+                return None, None
+            self._done = True
+            self._transcript = transcript
+            self._established = self._peer_id
+            self._mac_service.establish(
+                self._peer_id, transcript, self._server_id)
+            return IntroMessage(self._server_id, tag=(
+                self._mac_service.handshake_tag(
+                    self._peer_id, "connecting", transcript))), self._peer_id
+
+        if self._transcript is None:
+            # Accepting side: the connecting side's hello
+            if not self._mac_service.knows(intro.id):
+                # A client, which has no link key
+                self._done = True
+                return None, intro.id
+            if intro.nonce is None:
+                return None, None
+            self._transcript = "{}:{}:{}:{}".format(
+                intro.id, self._server_id, intro.nonce, self._nonce)
+            self._hello_id = intro.id
+            return IntroMessage(self._server_id, self._nonce, (
+                self._mac_service.handshake_tag(
+                    intro.id, "accepting", self._transcript))), None
+
+        # Accepting side: the connecting side's tag
+        if (intro.id != self._hello_id or
+                not self._mac_service.check_handshake_tag(
+                    intro.id, "connecting", self._transcript, intro.tag)):
+            print "Bad link handshake from {}".format(intro.id)
+            return None, None
+        self._done = True
+        self._established = intro.id
+        self._mac_service.establish(intro.id, self._transcript, intro.id)
+        return None, intro.id
+
+    def close(self):
+        """Drops the connection's key, once the connection is closed"""
+        if self._established is not None:
+            self._mac_service.close(self._established, self._transcript)
+            self._established = None
+
 
 class Socket(asyncore.dispatcher_with_send):
     """Two-way connection between server and client / server
@@ -125,16 +250,20 @@ class Socket(asyncore.dispatcher_with_send):
         server (Server): Server who owns the MessagingService
         messaging_service (MessagingService): parent who owns this
     """
-    def __init__(self, server, messaging_service, addr=None, sock=None):
+    def __init__(self, server, messaging_service, addr=None, sock=None,
+                 uuid=None):
+        self._uuid = uuid  # id of the peer, if we are the connecting side
+        # Set before connecting, which may call handle_connect right away
+        self._server = server
+        self._messaging_service = messaging_service
+        self._buffer = Buffer()
+        self._handshake = messaging_service.new_handshake(uuid)
         if sock is not None:
             asyncore.dispatcher_with_send.__init__(self, sock)
         else:
             asyncore.dispatcher_with_send.__init__(self)
             self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
             self.connect(addr)
-        self._server = server
-        self._messaging_service = messaging_service
-        self._buffer = Buffer()
 
     def handle_read(self):
         """Receives data"""
@@ -147,29 +276,54 @@ class Socket(asyncore.dispatcher_with_send):
 
             print "Received ({})".format(msg)
             if isinstance(msg, IntroMessage):
-                self._messaging_service.add_socket(self, msg.id)
+                self._handle_intro(msg)
             else:
                 self._server.handle_message(msg)
 
+    def _handle_intro(self, msg):
+        if self._handshake is None:
+            self._messaging_service.add_socket(self, msg.id)
+            return
+        reply, uuid = self._handshake.receive(msg)
+        if reply is not None:
+            self._send_intro(reply)
+        if uuid is not None and self._uuid is None:
+            # The connecting side added this socket when it opened it
+            self._messaging_service.add_socket(self, uuid)
+
+    def _send_intro(self, intro):
+        intro = intro.to_json()
+        self.send(struct.pack('!I', len(intro)))
+        self.send(intro)
+
     def handle_connect(self):
-        length = len(IntroMessage(self._server.id).to_json())
-        self.send(struct.pack('!I', length))
-        self.send(IntroMessage(self._server.id).to_json())
+        if self._handshake is not None:
+            self._send_intro(self._handshake.hello())
+        else:
+            self._send_intro(IntroMessage(self._server.id))
 
     def handle_error(self):
         traceback.print_exc(sys.stderr)
         self.close()
 
+    def close(self):
+        if self._handshake is not None:
+            self._handshake.close()
+        asyncore.dispatcher_with_send.close(self)
+
 
 if __name__ == "__main__":
     import argparse
     import time
 
-    PORTS = xrange(8001, 8001 + CONSTANTS.N)
-    ADDRESSES = [Address(port - 8001, port, 'localhost', True) for
-                 port in PORTS]
     parser = argparse.ArgumentParser()
     parser.add_argument("port_index", type=int)
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE", help="override a CONSTANTS value")
     args = parser.parse_args()
+    set_constants(args.set)
+    PORTS = xrange(8001, 8001 + CONSTANTS.N)
+    ADDRESSES = [Address(port - 8001, port, 'localhost', True) for
+                 port in PORTS]
     if args.port_index <= CONSTANTS.N:
         server = Server(args.port_index)
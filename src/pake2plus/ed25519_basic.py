@@ -1,19 +1,19 @@
 import binascii, hashlib, itertools
+import field25519
+from field25519 import Q, inv, sqrt_ratio
 from groups import expand_arbitrary_element_seed
+from util import VERIFY_PARAMS
 
-Q = 2**255 - 19
 L = 2**252 + 27742317777372353535851937790883648493
 
-def inv(x):
-    return pow(x, Q-2, Q)
-
 d = -121665 * inv(121666)
-I = pow(2,(Q-1)//4,Q)
+I = field25519.SQRT_M1
 
 def xrecover(y):
-    xx = (y*y-1) * inv(d*y*y+1)
-    x = pow(xx,(Q+3)//8,Q)
-    if (x*x - xx) % Q != 0: x = (x*I) % Q
+    # x = sqrt((y^2-1)/(d*y^2+1)), without a separate inversion. If there is
+    # no root the result is not on the curve, which callers check for.
+    yy = y*y
+    _, x = sqrt_ratio(yy-1, d*yy+1)
     if x % 2 != 0: x = Q-x
     return x
 
@@ -30,7 +30,27 @@ def xform_affine_to_extended(pt):
 
 def xform_extended_to_affine(pt):
     (x, y, z, _) = pt
-    return ((x*inv(z))%Q, (y*inv(z))%Q)
+    zinv = inv(z)
+    return ((x*zinv)%Q, (y*zinv)%Q)
+
+def batch_inv(xs):
+    # Montgomery's trick: invert n field elements with a single inv() and
+    # 3*(n-1) multiplications. None of xs may be zero.
+    prefix = []
+    acc = 1
+    for x in xs:
+        prefix.append(acc)
+        acc = (acc * x) % Q
+    acc_inv = inv(acc)
+    out = [0] * len(xs)
+    for i in range(len(xs) - 1, -1, -1):
+        out[i] = (acc_inv * prefix[i]) % Q
+        acc_inv = (acc_inv * xs[i]) % Q
+    return out
+
+def xform_extended_to_affine_many(pts):
+    zinvs = batch_inv([z for (_, _, z, _) in pts])
+    return [((x*zinv)%Q, (y*zinv)%Q) for ((x, y, _, _), zinv) in zip(pts, zinvs)]
 
 def double_element(pt): # extended->extended
     # dbl-2008-hwcd
@@ -127,7 +147,7 @@ def isoncurve(P):
     y = P[1]
     return (-x*x + y*y - 1 - d*x*x*y*y) % Q == 0
 
-class NotOnCurve(Exception):
+class NotOnCurve(ValueError):
     pass
 
 def decodepoint(s):
@@ -210,7 +230,11 @@ class ElementOfUnknownGroup:
     def to_bytes(self):
         return encodepoint(xform_extended_to_affine(self.XYTZ))
     def __eq__(self, other):
-        return self.to_bytes() == other.to_bytes()
+        # compare projectively (X1/Z1 == X2/Z2, Y1/Z1 == Y2/Z2) instead of
+        # encoding, which would cost an inversion per side
+        (X1, Y1, Z1, _) = self.XYTZ
+        (X2, Y2, Z2, _) = other.XYTZ
+        return ((X1*Z2 - X2*Z1) % Q == 0 and (Y1*Z2 - Y2*Z1) % Q == 0)
     def __ne__(self, other):
         return not self == other
 
@@ -268,7 +292,31 @@ Zero = _ZeroElement(xform_affine_to_extended((0,1))) # the neutral (identity) el
 _zero_bytes = Zero.to_bytes()
 
 
+def elements_to_bytes(elements):
+    # same as [e.to_bytes() for e in elements], but normalizes all of the
+    # points with one shared field inversion
+    affine = xform_extended_to_affine_many([e.XYTZ for e in elements])
+    return [encodepoint(P) for P in affine]
+
+# arbitrary_element() outputs (affine x, y) for the seeds used by
+# params._Params, so that M and N don't need to be searched for at runtime.
+# With VERIFY_PARAMS set, each entry is recomputed on first use.
+PRECOMPUTED_ARBITRARY_ELEMENTS = {
+    b"M": (56797357330922913988458593931122727936228661521514257091994679493501599747208,
+           8204578689594358005372171711129318668375319275647443160930343040183052652309),
+    b"N": (19859997596809371560572533813761263760519810596029049894518304267365992636715,
+           30537998347346252243850043725805156294608304431216408003238882613177304895472),
+}
+
 def arbitrary_element(seed): # unknown DL
+    if seed in PRECOMPUTED_ARBITRARY_ELEMENTS:
+        P = Element(xform_affine_to_extended(PRECOMPUTED_ARBITRARY_ELEMENTS[seed]))
+        if VERIFY_PARAMS and compute_arbitrary_element(seed) != P:
+            raise ValueError("precomputed element for %r is wrong" % (seed,))
+        return P
+    return compute_arbitrary_element(seed)
+
+def compute_arbitrary_element(seed):
     # We don't strictly need the uniformity provided by hashing to an
     # oversized string (128 bits more than the field size), then reducing
     # down to Q. But it's comforting, and it's the same technique we use for
@@ -10,12 +10,15 @@ class _Ed25519Group:
         return ed25519_basic.bytes_to_scalar(b)
     def password_to_scalar(self, pw):
         return password_to_scalar(pw, self.scalar_size_bytes, self.order())
-    def password_to_secret(self, pw):
-        return password_to_secret(pw, self.scalar_size_bytes, self.order())
+    def password_to_secret(self, pw, kdf="hkdf"):
+        return password_to_secret(pw, self.scalar_size_bytes, self.order(),
+                                  kdf)
     def arbitrary_element(self, seed):
         return ed25519_basic.arbitrary_element(seed)
     def bytes_to_element(self, b):
         return ed25519_basic.bytes_to_element(b)
+    def elements_to_bytes(self, elements):
+        return ed25519_basic.elements_to_bytes(elements)
     def order(self):
         return ed25519_basic.L
 
@@ -0,0 +1,124 @@
+# Arithmetic in GF(2^255-19), the base field of Ed25519.
+#
+# Field elements are plain ints in [0, Q). Inversion and square roots use the
+# fixed addition chain from the Ed25519 reference implementation, so the
+# sequence of multiplications does not depend on the input.
+
+Q = 2**255 - 19
+SQRT_M1 = pow(2, (Q-1)//4, Q) # sqrt(-1)
+
+def add(a, b):
+    return (a + b) % Q
+
+def sub(a, b):
+    return (a - b) % Q
+
+def mul(a, b):
+    return (a * b) % Q
+
+def sqr(a):
+    return (a * a) % Q
+
+def _sqr_n(a, n):
+    for _ in range(n):
+        a = (a * a) % Q
+    return a
+
+def _pow2_250_1(z):
+    # returns (z^(2^250-1), z^11), shared by inv() and pow_2_252_3()
+    z2 = (z * z) % Q
+    z9 = (_sqr_n(z2, 2) * z) % Q
+    z11 = (z9 * z2) % Q
+    z2_5_0 = (((z11 * z11) % Q) * z9) % Q
+    z2_10_0 = (_sqr_n(z2_5_0, 5) * z2_5_0) % Q
+    z2_20_0 = (_sqr_n(z2_10_0, 10) * z2_10_0) % Q
+    z2_40_0 = (_sqr_n(z2_20_0, 20) * z2_20_0) % Q
+    z2_50_0 = (_sqr_n(z2_40_0, 10) * z2_10_0) % Q
+    z2_100_0 = (_sqr_n(z2_50_0, 50) * z2_50_0) % Q
+    z2_200_0 = (_sqr_n(z2_100_0, 100) * z2_100_0) % Q
+    z2_250_0 = (_sqr_n(z2_200_0, 50) * z2_50_0) % Q
+    return z2_250_0, z11
+
+def inv(z):
+    # z^(Q-2) = z^(2^255-21). inv(0) is 0.
+    z2_250_0, z11 = _pow2_250_1(z % Q)
+    return (_sqr_n(z2_250_0, 5) * z11) % Q
+
+def pow_2_252_3(z):
+    # z^((Q-5)/8) = z^(2^252-3)
+    z = z % Q
+    z2_250_0, _ = _pow2_250_1(z)
+    return (_sqr_n(z2_250_0, 2) * z) % Q
+
+def sqrt_ratio(u, v):
+    """Computes a square root of u/v with one exponentiation and no separate
+    inversion: x = u*v^3 * (u*v^7)^((Q-5)/8).
+
+    Returns:
+        (bool, int): whether u/v is a square, and the root. When u/v is not
+            a square the root is meaningless.
+    """
+    u = u % Q
+    v = v % Q
+    v3 = (v * v * v) % Q
+    v7 = (v3 * v3 * v) % Q
+    x = (u * v3 * pow_2_252_3(u * v7)) % Q
+    vxx = (v * x * x) % Q
+    if vxx == u:
+        return True, x
+    if vxx == (-u) % Q:
+        return True, (x * SQRT_M1) % Q
+    return False, x
+
+def is_negative(a):
+    return a & 1
+
+
+if __name__ == '__main__':
+    import os
+    import binascii
+    import timeit
+    import ed25519_basic
+
+    def rand():
+        return int(binascii.hexlify(os.urandom(32)), 16) % Q
+
+    a, b = rand(), rand()
+    assert (inv(a) * a) % Q == 1
+    assert inv(a) == pow(a, Q-2, Q)
+    ok, x = sqrt_ratio(a * a % Q, b * b % Q)
+    assert ok and (x * x * b * b - a * a) % Q == 0
+
+    P = ed25519_basic.Base.scalarmult(rand())
+    P_bytes = P.to_bytes()
+    y = ed25519_basic.decodepoint(P_bytes)[1]
+
+    def xrecover_pow(y):
+        xx = (y*y-1) * pow(ed25519_basic.d*y*y+1, Q-2, Q)
+        x = pow(xx, (Q+3)//8, Q)
+        if (x*x - xx) % Q != 0: x = (x*SQRT_M1) % Q
+        if x % 2 != 0: x = Q-x
+        return x
+    assert xrecover_pow(y) == ed25519_basic.xrecover(y)
+
+    benchmarks = [
+        ("add", lambda: add(a, b)),
+        ("sub", lambda: sub(a, b)),
+        ("mul", lambda: mul(a, b)),
+        ("sqr", lambda: sqr(a)),
+        ("inv (pow)", lambda: pow(a, Q-2, Q)),
+        ("inv (chain)", lambda: inv(a)),
+        ("sqrt_ratio", lambda: sqrt_ratio(a, b)),
+        ("xrecover (pow + inv)", lambda: xrecover_pow(y)),
+        ("xrecover", lambda: ed25519_basic.xrecover(y)),
+        ("encodepoint", lambda: P.to_bytes()),
+        ("decodepoint", lambda: ed25519_basic.decodepoint(P_bytes)),
+        ("batch_inv (x64) / 64",
+         lambda: ed25519_basic.batch_inv([a] * 64)),
+    ]
+    for name, f in benchmarks:
+        number = 100000 if name in ("add", "sub", "mul", "sqr") else 1000
+        per_call = timeit.timeit(f, number=number) / number
+        if name.startswith("batch_inv"):
+            per_call /= 64
+        print "{:<24} {:>10.2f} us".format(name, per_call * 1e6)
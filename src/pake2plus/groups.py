@@ -4,7 +4,7 @@ import sha3
 from hkdf import Hkdf
 from six import integer_types
 from util import (size_bits, size_bytes, unbiased_randrange,
-                   bytes_to_number, number_to_bytes)
+                   bytes_to_number, number_to_bytes, VERIFY_PARAMS)
 
 """Interface specification for a Group.
 
@@ -82,9 +82,27 @@ def expand_password_sha3(data, num_bytes):
     info = b"SPAKE2PLUS pw"
     return h.expand(info, num_bytes)
 
-def password_to_secret(pw, scalar_size_bytes, q):
+# Deliberately slow alternative to HKDF. Only affordable when logins go
+# through a SecretCache, since every cache miss pays the full cost.
+SLOW_KDF_SALT = b"SPAKE2PLUS slow pw"
+SLOW_KDF_ITERATIONS = 100000
+
+def expand_password_slow(data, num_bytes):
+    if hasattr(hashlib, "scrypt"):
+        return hashlib.scrypt(data, salt=SLOW_KDF_SALT, n=2**14, r=8, p=1,
+                              dklen=num_bytes)
+    return hashlib.pbkdf2_hmac("sha256", data, SLOW_KDF_SALT,
+                               SLOW_KDF_ITERATIONS, num_bytes)
+
+PASSWORD_KDFS = {
+    "hkdf": expand_password_sha3,
+    "slow": expand_password_slow,
+}
+
+def password_to_secret(pw, scalar_size_bytes, q, kdf="hkdf"):
     assert isinstance(pw, bytes)
-    oversized = expand_password_sha3(pw, 2 * (scalar_size_bytes+16))
+    expand = PASSWORD_KDFS[kdf]
+    oversized = expand(pw, 2 * (scalar_size_bytes+16))
     assert len(oversized) >= 2 * scalar_size_bytes
     pi_0 = bytes_to_number(oversized[:(scalar_size_bytes + 16)])
     pi_1 = bytes_to_number(oversized[(scalar_size_bytes+16):])
@@ -108,6 +126,17 @@ class _Element:
     def to_bytes(self):
         return self._group._element_to_bytes(self)
 
+# sha256 digests of the (p, q, g) parameters of the hard-coded groups below,
+# whose generator order was checked when they were pinned
+PINNED_PARAMS = set([
+    "5794d63360160f5bfea99bd1616af1ba5513c7e3a133181c640df5fb8c6a3da3", # I1024
+    "9139b9ef166e112dfed93e525b73fbd3ae1fea31df9e951acb9c501e4fc94f52", # I2048
+    "4ca7e11e0d76ec67ca9af6c1f3f4e1c7dbeb6ffe4bc31ef6d0a1ed714562490f", # I3072
+    ])
+
+def params_digest(p, q, g):
+    return hashlib.sha256(("%x:%x:%x" % (p, q, g)).encode("ascii")).hexdigest()
+
 class IntegerGroup:
     def __init__(self, p, q, g):
         self.q = q # the subgroup order, used for scalars
@@ -123,8 +152,12 @@ class IntegerGroup:
         self.element_size_bits = size_bits(self.p)
         self.element_size_bytes = size_bytes(self.p)
 
-        # double-check that the generator has the right order
-        assert pow(g, self.q, self.p) == 1
+        # double-check that the generator has the right order. This costs a
+        # few ms per group, so the pinned hard-coded groups only pay for it
+        # in verification mode. Caller-supplied parameters are always checked.
+        if VERIFY_PARAMS or params_digest(p, q, g) not in PINNED_PARAMS:
+            assert 1 < g < p
+            assert pow(g, self.q, self.p) == 1
 
     def order(self):
         return self.q
@@ -197,6 +230,9 @@ class IntegerGroup:
             raise ValueError("element is not in the right group")
         return e
 
+    def elements_to_bytes(self, elements):
+        return [self._element_to_bytes(e) for e in elements]
+
     def _scalarmult(self, e1, i):
         if not isinstance(e1, _Element):
             raise TypeError("E*N requires E be an element")
@@ -1,6 +1,6 @@
 ## FROM: https://github.com/warner/python-spake2/blob/master/src/spake2/spake2.py
 
-import os, json
+import os, json, hmac
 from binascii import hexlify, unhexlify
 from hashlib import sha256
 from params import _Params
@@ -27,6 +27,8 @@ class WrongGroupError(SPAKEError):
     pass
 class ReflectionThwarted(SPAKEError):
     """Someone tried to reflect our message back to us."""
+class ConfirmedTooEarly(SPAKEError):
+    """Confirmation MACs only exist once finish() has derived the key."""
 
 SideA = b"A"
 SideB = b"B"
@@ -39,6 +41,15 @@ def finalize_SPAKE2PLUS(X_msg, Y_msg, K_bytes, d_bytes, pi_0):
     key = sha256(transcript).digest()
     return key
 
+def confirmation_MACs(key, X_msg, Y_msg):
+    # Each side MACs the other side's message under its own confirmation
+    # key, so a side holding the wrong password is caught by the first
+    # confirmation it receives rather than by its first use of the key.
+    KcA = hmac.new(key, b"SPAKE2PLUS confirm A", sha256).digest()
+    KcB = hmac.new(key, b"SPAKE2PLUS confirm B", sha256).digest()
+    return (hmac.new(KcA, Y_msg, sha256).digest(),
+            hmac.new(KcB, X_msg, sha256).digest())
+
 class _SPAKE2_Base(object):
     "This class manages one side of a SPAKE2 key negotiation."
 
@@ -72,11 +83,13 @@ class _SPAKE2_Base(object):
         outbound_side_and_message = self.side + self.outbound_message
         return outbound_side_and_message
 
-    def compute_outbound_message(self):
+    def compute_outbound_element(self):
         #message_elem = self.xy_elem + (self.my_blinding() * self.pw_scalar)
         pi_0_blinding = self.my_blinding().scalarmult(self.pi_0_scalar)
-        message_elem = self.xy_elem.add(pi_0_blinding)
-        self.outbound_message = message_elem.to_bytes()
+        return self.xy_elem.add(pi_0_blinding)
+
+    def compute_outbound_message(self):
+        self.outbound_message = self.compute_outbound_element().to_bytes()
 
     def finish(self, inbound_side_and_message):
         if self._finished:
@@ -137,8 +150,27 @@ class _SPAKE2_Asymmetric(_SPAKE2_Base):
         return inbound_message
 
     def _finalize(self, K_bytes, d_bytes):
-        return finalize_SPAKE2PLUS(self.X_msg(), self.Y_msg(), K_bytes, d_bytes,
+        self.key = finalize_SPAKE2PLUS(self.X_msg(), self.Y_msg(), K_bytes, d_bytes,
                                 self.params.group.scalar_to_bytes(self.pi_0_scalar))
+        confirm_A, confirm_B = confirmation_MACs(
+            self.key, self.X_msg(), self.Y_msg())
+        if self.side == SideA:
+            self._confirmation, self._peer_confirmation = confirm_A, confirm_B
+        else:
+            self._confirmation, self._peer_confirmation = confirm_B, confirm_A
+        return self.key
+
+    def confirmation(self):
+        """MAC to send to the other side after finish()."""
+        if not hasattr(self, "_confirmation"):
+            raise ConfirmedTooEarly("call .finish() before .confirmation()")
+        return self._confirmation
+
+    def verify_confirmation(self, confirmation):
+        """Returns True iff the other side derived the same key."""
+        if not hasattr(self, "_peer_confirmation"):
+            raise ConfirmedTooEarly("call .finish() before .verify_confirmation()")
+        return hmac.compare_digest(confirmation, self._peer_confirmation)
 
     # def _serialize_to_dict(self):
     #     g = self.params.group
@@ -175,11 +207,16 @@ class _SPAKE2_Asymmetric(_SPAKE2_Base):
 
 # applications should use SPAKE2_A and SPAKE2_B, not raw _SPAKE2_Base()
 
-def password_to_secret_A(password, params=DefaultParams):
-    return params.group.password_to_secret(password)
+def password_to_secret_A(password, params=DefaultParams, kdf="hkdf",
+                         cache=None):
+    derive = lambda pw: params.group.password_to_secret(pw, kdf)
+    if cache is None:
+        return derive(password)
+    return cache.get(password, kdf, derive, params.group.order())
 
-def password_to_secret_B(password, params=DefaultParams):
-    pi_0, pi_1 = password_to_secret_A(password, params)
+def password_to_secret_B(password, params=DefaultParams, kdf="hkdf",
+                         cache=None):
+    pi_0, pi_1 = password_to_secret_A(password, params, kdf, cache)
     return (pi_0, params.group.Base.scalarmult(pi_1).to_bytes())
 
 class SPAKE2PLUS_A(_SPAKE2_Asymmetric):
@@ -221,6 +258,64 @@ class SPAKE2PLUS_B(_SPAKE2_Asymmetric):
         key = self._finalize(K_bytes, d_bytes)
         return key
 
+    @classmethod
+    def respond_many(klass, secrets_and_messages):
+        """Runs start() and finish() for many logins at once.
+
+        Equivalent to calling start() and finish() on a fresh instance per
+        login, except that every point that has to be encoded (outbound
+        message, inbound check, K and d) is normalized with a single shared
+        field inversion instead of two inversions per point.
+
+        Args:
+            secrets_and_messages (list[((pi_0, c), string)]): server secret
+                and the client's start() message for each login
+
+        Returns:
+            list[(string, SPAKE2PLUS_B)]: (start() message, finished
+                instance) per login, in order. The instance is None if the
+                client's message was rejected.
+        """
+        g = DefaultParams.group
+        sides = []
+        elements = []
+        for secret, inbound_side_and_message in secrets_and_messages:
+            side = klass(secret)
+            side._started = True
+            side._finished = True
+            side.xy_scalar = g.random_scalar(side.entropy_f)
+            side.xy_elem = g.Base.scalarmult(side.xy_scalar)
+            message_elem = side.compute_outbound_element()
+            try:
+                side.inbound_message = side._extract_message(
+                    inbound_side_and_message)
+                inbound_elem = g.bytes_to_element(side.inbound_message)
+            except (SPAKEError, ValueError):
+                sides.append((side, False))
+                elements.append(message_elem)
+                continue
+
+            pi_0_unblinding = side.my_unblinding().scalarmult(-side.pi_0_scalar)
+            side.unblinded_message = inbound_elem.add(pi_0_unblinding)
+            K_elem = side.unblinded_message.scalarmult(side.xy_scalar)
+            d_elem = side.c.scalarmult(side.xy_scalar)
+            sides.append((side, True))
+            elements.extend([message_elem, inbound_elem, K_elem, d_elem])
+
+        encoded = iter(g.elements_to_bytes(elements))
+        results = []
+        for side, accepted in sides:
+            side.outbound_message = next(encoded)
+            if accepted:
+                inbound_bytes, K_bytes, d_bytes = next(encoded), next(encoded), next(encoded)
+                if inbound_bytes == side.outbound_message:
+                    accepted = False
+                else:
+                    side._finalize(K_bytes, d_bytes)
+            results.append((side.side + side.outbound_message,
+                            side if accepted else None))
+        return results
+
     def my_blinding(self): return self.params.N
     def my_unblinding(self): return self.params.M
     def X_msg(self): return self.inbound_message
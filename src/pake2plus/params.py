@@ -6,10 +6,25 @@
 
 # The safe way to choose these is to hash a public string.
 
-class _Params:
+# M and N are derived on first use rather than at import time, so processes
+# that never run a PAKE don't pay for them.
+
+class _Params(object):
     def __init__(self, group, M=b"M", N=b"N", S=b"symmetric"):
         self.group = group
-        self.M = group.arbitrary_element(seed=M)
-        self.N = group.arbitrary_element(seed=N)
         self.M_str = M
         self.N_str = N
+        self._M = None
+        self._N = None
+
+    @property
+    def M(self):
+        if self._M is None:
+            self._M = self.group.arbitrary_element(seed=self.M_str)
+        return self._M
+
+    @property
+    def N(self):
+        if self._N is None:
+            self._N = self.group.arbitrary_element(seed=self.N_str)
+        return self._N
@@ -0,0 +1,150 @@
+import ctypes
+import ctypes.util
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+
+from util import number_to_bytes, bytes_to_number
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _mlock = _libc.mlock
+    _munlock = _libc.munlock
+except (OSError, AttributeError):
+    _mlock = _munlock = None
+
+
+class _LockedBuffer(object):
+    """Fixed size bytearray that is mlock()ed while alive (best effort) and
+    overwritten with zeros when wiped."""
+
+    def __init__(self, data):
+        self._buf = bytearray(data)
+        self._locked = False
+        if _mlock is not None and len(self._buf):
+            addr = ctypes.addressof(
+                (ctypes.c_char * len(self._buf)).from_buffer(self._buf))
+            # Fails silently past RLIMIT_MEMLOCK; the cache still works, the
+            # entries are just swappable.
+            self._locked = _mlock(ctypes.c_void_p(addr),
+                                  ctypes.c_size_t(len(self._buf))) == 0
+            self._addr = addr
+
+    @property
+    def locked(self):
+        return self._locked
+
+    def value(self):
+        return bytes(self._buf)
+
+    def wipe(self):
+        for i in xrange(len(self._buf)):
+            self._buf[i] = 0
+        if self._locked:
+            _munlock(ctypes.c_void_p(self._addr),
+                     ctypes.c_size_t(len(self._buf)))
+            self._locked = False
+
+
+class SecretCache(object):
+    """Bounded LRU cache of password -> (pi_0, pi_1).
+
+    Passwords are never stored: entries are keyed by an HMAC of the password
+    under a per-process random key, so the key set cannot be used as an
+    unsalted password hash table. The scalars are held in mlock()ed buffers
+    and zeroed on eviction and on clear(). Returned scalars are ordinary
+    Python ints and are not covered by the zeroization.
+
+    Args:
+        capacity (int): maximum number of cached passwords
+    """
+    def __init__(self, capacity):
+        assert capacity > 0
+        self._capacity = capacity
+        self._hmac_key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_key(self, password, kdf, order):
+        return hmac.new(self._hmac_key,
+                        kdf + b"\x00" + str(order) + b"\x00" + password,
+                        hashlib.sha256).digest()
+
+    def get(self, password, kdf, derive, order):
+        """Returns the cached secret for password, calling derive(password)
+        on a miss.
+
+        Args:
+            password (bytes)
+            kdf (string): name of the KDF, part of the cache key
+            derive (function): password -> (pi_0, pi_1)
+            order (int): order of the group the scalars pi_0 and pi_1 are
+                in, part of the cache key
+
+        Returns:
+            (long, long)
+        """
+        key = self._cache_key(password, kdf, order)
+        scalar_size = (order.bit_length() + 7) // 8
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                value = entry.value()
+                return (bytes_to_number(value[:scalar_size]),
+                        bytes_to_number(value[scalar_size:]))
+            self.misses += 1
+
+        pi_0, pi_1 = derive(password)
+        max_scalar = 2 ** (8 * scalar_size) - 1
+        entry = _LockedBuffer(number_to_bytes(pi_0, max_scalar) +
+                              number_to_bytes(pi_1, max_scalar))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                old.wipe()
+            self._entries[key] = entry
+            while len(self._entries) > self._capacity:
+                _, evicted = self._entries.popitem(last=False)
+                evicted.wipe()
+        return (pi_0, pi_1)
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.itervalues():
+                entry.wipe()
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+if __name__ == '__main__':
+    import time
+    from pake2plus import password_to_secret_A
+
+    for kdf in ["hkdf", "slow"]:
+        cache = SecretCache(16)
+        start = time.time()
+        uncached = password_to_secret_A(b"hello world", kdf=kdf)
+        miss_time = time.time() - start
+        password_to_secret_A(b"hello world", kdf=kdf, cache=cache)
+        start = time.time()
+        for _ in xrange(1000):
+            cached = password_to_secret_A(b"hello world", kdf=kdf, cache=cache)
+        hit_time = (time.time() - start) / 1000
+        assert cached == uncached
+        print "{}: miss {:.6f}s hit {:.6f}s".format(kdf, miss_time, hit_time)
+
+    cache = SecretCache(2)
+    for pw in [b"a", b"b", b"c"]:
+        password_to_secret_A(pw, cache=cache)
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+    print "Passes"
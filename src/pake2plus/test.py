@@ -21,3 +21,53 @@ msg_inA = msg_outB
 msg_inB = msg_outA
 
 print SA.finish(msg_inA) == SB.finish(msg_inB)
+
+
+# Key confirmation: the server's MAC travels with its SPAKE2+ message, so the
+# client learns whether the login succeeded in the same round trip.
+import time
+
+def login(client_password, server_password):
+    start = time.time()
+    SA = SPAKE2PLUS_A(password_to_secret_A(client_password))
+    u = SA.start()
+    SB = SPAKE2PLUS_B(password_to_secret_B(server_password))
+    v = SB.start()
+    SB.finish(u)
+    confirmation_B = SB.confirmation()
+    SA.finish(v)
+    ok = SA.verify_confirmation(confirmation_B)
+    if ok:
+        assert SB.verify_confirmation(SA.confirmation())
+    return ok, time.time() - start
+
+assert login(b"hello world", b"hello world")[0]
+assert not login(b"hello world", b"goodbye world")[0]
+
+for name, server_password in [("successful", b"hello world"),
+                              ("failed", b"goodbye world")]:
+    times = sorted(login(b"hello world", server_password)[1]
+                   for _ in range(20))
+    print "%s login: median %.1f ms" % (name, 1000 * times[len(times) // 2])
+
+
+# Rejected logins through the batched server path the application client
+# uses: a wrong password fails the server's confirmation MAC, and a malformed
+# client message is rejected outright.
+def batched_login(client_password, server_password, u=None):
+    SA = SPAKE2PLUS_A(password_to_secret_A(client_password))
+    if u is None:
+        u = SA.start()
+    [(v, SB)] = SPAKE2PLUS_B.respond_many(
+        [(password_to_secret_B(server_password), u)])
+    if SB is None:
+        return None
+    SA.finish(v)
+    if not SA.verify_confirmation(SB.confirmation()):
+        return False
+    return SB.verify_confirmation(SA.confirmation())
+
+assert batched_login(b"hello world", b"hello world")
+assert batched_login(b"hello world", b"goodbye world") is False
+assert batched_login(b"hello world", b"hello world", u=b"\x00" * 33) is None
+print "rejected logins: ok"
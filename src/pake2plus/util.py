@@ -2,6 +2,10 @@ from __future__ import division
 import os, binascii, math
 import six
 
+# Set SPAKE2PLUS_VERIFY_PARAMS=1 to recompute precomputed group constants
+# (M, N, generator orders) on first use instead of trusting them.
+VERIFY_PARAMS = bool(os.environ.get("SPAKE2PLUS_VERIFY_PARAMS"))
+
 def size_bits(maxval):
     if hasattr(maxval, "bit_length"): # python-2.7 or 3.x
         return maxval.bit_length() or 1
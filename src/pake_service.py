@@ -0,0 +1,37 @@
+from pake2plus.pake2plus import SPAKE2PLUS_B
+
+
+class PakeService(object):
+    def __init__(self, max_batch_size):
+        """Queues server side SPAKE2+ responses and computes them in batches
+        with SPAKE2PLUS_B.respond_many.
+
+        Args:
+            max_batch_size (int): flush as soon as this many are queued
+        """
+        self._max_batch_size = max_batch_size
+        self._pending = []  # List[(secret, u, callback)]
+
+    def respond(self, secret, u, callback):
+        """Queue one login. callback(v, pake) is called on flush with the
+        server's SPAKE2+ message and the finished SPAKE2PLUS_B (None if u
+        was rejected).
+
+        Args:
+            secret ((long, string)): (pi_0, c) recovered from the servers
+            u (string): client's SPAKE2+ message
+            callback (function)
+        """
+        self._pending.append((secret, u, callback))
+        if len(self._pending) >= self._max_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Computes responses for every queued login."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        results = SPAKE2PLUS_B.respond_many(
+            [(secret, u) for secret, u, _ in pending])
+        for (_, _, callback), (v, pake) in zip(pending, results):
+            callback(v, pake)
@@ -0,0 +1,109 @@
+import json
+from collections import OrderedDict
+
+from message import Message
+
+
+class Recovery(object):
+    def __init__(self, write_ahead_log):
+        """Transactions that were open in the write-ahead log when the server
+        stopped, with their messages in log order.
+
+        Indexing only splits the log records by transaction, so the server
+        can take traffic again right away. Messages are parsed when their
+        transaction is taken for replay: on demand, when new traffic for it
+        arrives, or oldest first in the background.
+
+        Args:
+            write_ahead_log (WriteAheadLog)
+        """
+        self._transactions = OrderedDict()  # transaction -> [message JSON]
+        self.messages = 0
+        for transaction, msg in write_ahead_log.records():
+            self._transactions.setdefault(transaction, []).append(msg)
+            self.messages += 1
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def __contains__(self, transaction):
+        return transaction in self._transactions
+
+    @property
+    def transactions(self):
+        """Transactions not replayed yet, oldest first"""
+        return list(self._transactions)
+
+    def take(self, transaction):
+        """Removes transaction and returns its messages.
+
+        Returns:
+            list[Message]
+        """
+        return [Message.from_json(json.loads(msg))
+                for msg in self._transactions.pop(transaction)]
+
+    def discard(self, transaction):
+        """Removes transaction without replaying it"""
+        self._transactions.pop(transaction, None)
+
+    def oldest(self, count):
+        """Returns up to count transactions, oldest first"""
+        oldest = []
+        for transaction in self._transactions:
+            if len(oldest) == count:
+                break
+            oldest.append(transaction)
+        return oldest
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    from message import GetMessage, PutMessage
+    from write_ahead_log import WriteAheadLog
+
+    parser = argparse.ArgumentParser(
+        description="Measures time-to-ready after a crash: how long until a "
+                    "server with a log of open transactions takes traffic.")
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    # Five messages per transaction, about a client message and the replica
+    # messages that quote it
+    directory = tempfile.mkdtemp()
+    try:
+        wal = WriteAheadLog(os.path.join(directory, "server"))
+        signature = "s" * 344  # base 64 RSA-2048
+        for i in xrange(args.messages):
+            if i % 2:
+                msg = PutMessage("user{}".format(i // 10), os.urandom(32),
+                                 100, signature=signature,
+                                 timestamp=str(i // 10))
+                transaction = (msg.key, msg.timestamp, "PUT")
+            else:
+                msg = GetMessage("user{}".format(i // 10), 100,
+                                 signature=signature, timestamp=str(i // 10))
+                transaction = (msg.key, msg.timestamp, "GET")
+            wal.log(msg, transaction)
+        wal.close()
+
+        start = time.time()
+        wal = WriteAheadLog(os.path.join(directory, "server"))
+        recovery = Recovery(wal)
+        ready = time.time() - start
+        print "ready: {:.3f}s ({} transactions, {} messages)".format(
+            ready, len(recovery), recovery.messages)
+
+        start = time.time()
+        for transaction in recovery.transactions:
+            recovery.take(transaction)
+        print "background replay: {:.3f}s, {:.3f}s if parsed before " \
+              "taking traffic".format(
+                  time.time() - start, ready + time.time() - start)
+    finally:
+        shutil.rmtree(directory)
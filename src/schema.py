@@ -0,0 +1,123 @@
+import glob
+import sqlite3
+
+# Bump SCHEMA_VERSION and add a step to MIGRATIONS to change a table.
+# Databases record their version in PRAGMA user_version; the original tables
+# had no primary key and are version 0.
+SCHEMA_VERSION = 3
+
+TABLES = {
+    "secrets": """CREATE TABLE secrets
+                  (key TEXT PRIMARY KEY, pi_0_U BLOB, pi_0_V BLOB, c_U BLOB,
+                   c_V BLOB, client_id TEXT, timestamp TEXT) WITHOUT ROWID""",
+    "lame_secrets": """CREATE TABLE lame_secrets
+                       (key TEXT PRIMARY KEY, value BLOB) WITHOUT ROWID""",
+}
+
+# Column names of TABLES, for CSV exports, which base64 encode the binary
+# ones
+COLUMNS = {
+    "secrets": ["key", "pi_0_U", "pi_0_V", "c_U", "c_V", "client_id",
+                "timestamp"],
+    "lame_secrets": ["key", "value"],
+}
+BINARY_COLUMNS = {"pi_0_U", "pi_0_V", "c_U", "c_V", "value"}
+
+# Rows of these end with the client_id and timestamp of the put that wrote
+# them
+VERSIONED_TABLES = ["secrets"]
+
+INDEXES = {
+    # Catch-up reads a client's puts since a timestamp
+    "secrets": ["""CREATE INDEX secrets_by_time
+                   ON secrets (client_id, timestamp)"""],
+    "lame_secrets": [],
+}
+
+
+# The tables as of version 1, which later migrations start from
+_TABLES_V1 = {
+    "secrets": """CREATE TABLE secrets
+                  (key TEXT PRIMARY KEY, pi_0_U BLOB, pi_0_V BLOB, c_U BLOB,
+                   c_V BLOB) WITHOUT ROWID""",
+    "lame_secrets": TABLES["lame_secrets"],
+}
+
+
+def _add_primary_key(conn, table):
+    """Rebuilds table with key as its primary key. Of duplicate rows from
+    repeated enrolls, the last one inserted wins, as it would have with
+    upserts."""
+    conn.execute("ALTER TABLE {0} RENAME TO {0}_v0".format(table))
+    conn.execute(_TABLES_V1[table])
+    conn.execute("INSERT OR REPLACE INTO {0} SELECT * FROM {0}_v0 "
+                 "ORDER BY rowid".format(table))
+    conn.execute("DROP TABLE {}_v0".format(table))
+
+
+def _add_put_versions(conn, table):
+    """Records the client and timestamp of the put that wrote each secret.
+    Rows written before are NULL, as if older than any put."""
+    if table != "secrets":
+        return
+    conn.execute("ALTER TABLE secrets ADD COLUMN client_id TEXT")
+    conn.execute("ALTER TABLE secrets ADD COLUMN timestamp TEXT")
+
+
+def _add_timestamp_index(conn, table):
+    for index in INDEXES[table]:
+        conn.execute(index)
+
+
+# MIGRATIONS[v] upgrades version v to v + 1
+MIGRATIONS = [_add_primary_key, _add_put_versions, _add_timestamp_index]
+
+
+def ensure_schema(conn, table):
+    """Creates table, or migrates it to SCHEMA_VERSION, in one transaction.
+
+    Args:
+        conn (sqlite3.Connection)
+        table (string): "secrets" or "lame_secrets"
+    """
+    version, = conn.execute("PRAGMA user_version").fetchone()
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+        (table,)).fetchone()
+    if exists and version == SCHEMA_VERSION:
+        return
+
+    # sqlite3 commits before DDL statements unless transactions are managed
+    # by hand, and a half migrated table would lose rows
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN")
+        try:
+            if not exists:
+                conn.execute(TABLES[table])
+                for index in INDEXES[table]:
+                    conn.execute(index)
+            else:
+                for migration in MIGRATIONS[version:]:
+                    migration(conn, table)
+            conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.isolation_level = isolation_level
+
+
+if __name__ == '__main__':
+    # Migrates the databases in databases/
+    for filename in sorted(glob.glob("databases/*db")):
+        table = "lame_secrets" if "lame" in filename else "secrets"
+        conn = sqlite3.connect(filename)
+        version, = conn.execute("PRAGMA user_version").fetchone()
+        ensure_schema(conn, table)
+        count, = conn.execute("SELECT COUNT(*) FROM " + table).fetchone()
+        print "{}: version {} -> {}, {} rows".format(
+            filename, version, SCHEMA_VERSION, count)
+        conn.close()
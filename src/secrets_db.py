@@ -1,54 +1,247 @@
-import sqlite3
+from itertools import islice
+from ciphertext_cache import CiphertextCache
+from group_commit import GroupCommitter
+from merkle_tree import MerkleTree
+from secrets_store import get_secrets_store
 from tpke import serialize, deserialize1
 
 
+def _utf8(key):
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    return key
+
+
+def _version(row):
+    """(client_id, timestamp) of the put that wrote row, or None"""
+    if len(row) < 6 or not row[5]:
+        return None
+    return row[4], row[5]
+
+
 class SecretsDB(object):
-    def __init__(self, db_filename):
-        """Writes to db_filename somehow."""
-        self._conn = sqlite3.connect(db_filename)
-        self._conn.text_factory = str
-        self._cursor = self._conn.cursor()
+    def __init__(self, db_filename, commit_interval=0, commit_rows=1,
+                 cache_bytes=0, merkle_tree=False):
+        """Writes to db_filename somehow.
+
+        Args:
+            db_filename (string)
+            commit_interval (float): seconds puts may wait to be committed
+                together, 0 commits every put
+            commit_rows (int): commit once this many puts are waiting
+            cache_bytes (int): memory for deserialized ciphertexts, 0
+                disables the cache
+            merkle_tree (bool): keep a MerkleTree of the stored versions for
+                anti-entropy, see build_tree
+        """
+        self._store = get_secrets_store()(db_filename, "secrets")
+        self._committer = GroupCommitter(
+            self._store, commit_interval, commit_rows)
+        self._cache = None
+        if cache_bytes > 0:
+            self._cache = CiphertextCache(cache_bytes)
+        self._tree = None
+        self._tree_ready = False
+        # Last key added to the tree while it is built, UTF-8 encoded so
+        # that it compares in the store's key order
+        self._tree_position = ""
+        if merkle_tree:
+            self._tree = MerkleTree()
 
     def get(self, key):
-        self._cursor.execute("SELECT * FROM secrets WHERE key=?", (key,))
-        key, pi_0_U, pi_0_V, c_U, c_V = self._cursor.fetchone()
+        if self._cache is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+
+        row = self._store.get(key)
+        if row is None:
+            raise KeyError(key)
+        pi_0_U, pi_0_V, c_U, c_V = row[:4]
+        size = len(pi_0_U) + len(pi_0_V) + len(c_U) + len(c_V)
 
         pi_0_U = deserialize1(pi_0_U)
         c_U = deserialize1(c_U)
 
-        return ((pi_0_U, pi_0_V, None), (c_U, c_V, None))
+        value = ((pi_0_U, pi_0_V, None), (c_U, c_V, None))
+        if self._cache is not None:
+            self._cache.put(key, value, size)
+        return value
+
+    def put(self, key, threshold_secret, callback=None, client_id=None,
+            timestamp=None):
+        """Stores threshold_secret under key. callback runs once the put is
+        durable, see GroupCommitter; until then it is only visible to this
+        SecretsDB.
 
-    def put(self, key, threshold_secret):
+        Args:
+            client_id (int): client that sent the put
+            timestamp (string): timestamp of the PutMessage
+        """
         pi_0_U, pi_0_V, _ = threshold_secret[0]
         c_U, c_V, _ = threshold_secret[1]
 
         pi_0_U = serialize(pi_0_U)
         c_U = serialize(c_U)
 
-        self._cursor.execute("INSERT INTO secrets VALUES (?,?,?,?,?)", (key, pi_0_U, pi_0_V, c_U, c_V))
-        self._conn.commit()
+        row = (pi_0_U, pi_0_V, c_U, c_V,
+               "" if client_id is None else str(client_id), timestamp or "")
+        if self._in_tree(key):
+            self._tree.update(key, self.versions([key]).get(key),
+                              _version(row))
+        # A re-enroll replaces the user's secret
+        self._store.put(key, row)
+        if self._cache is not None:
+            self._cache.invalidate(key)
+        self._committer.written(callback)
+
+    def versions(self, keys):
+        """Returns {key: (client_id, timestamp) of the put that wrote it} for
+        the keys that are stored with a timestamp."""
+        stored = {}
+        for key in keys:
+            row = self._store.get(key)
+            if row is not None and _version(row) is not None:
+                stored[key] = _version(row)
+        return stored
+
+    def timestamps(self, keys):
+        """Returns {key: timestamp of the put that wrote it} for the keys that
+        are stored with a timestamp."""
+        return dict((key, timestamp) for key, (_, timestamp)
+                    in self.versions(keys).iteritems())
+
+    def rows(self, keys):
+        """Returns [(key, row)] of the stored keys, rows as stored"""
+        rows = []
+        for key in keys:
+            row = self._store.get(key)
+            if row is not None:
+                rows.append((key, row))
+        return rows
+
+    def poll(self):
+        """Commits waiting puts that are due. Call periodically."""
+        self._committer.poll()
+
+    @property
+    def committer(self):
+        return self._committer
+
+    @property
+    def store(self):
+        return self._store
 
-    def select(self, timestamps):
-        """Selects all entries such that entry.timestamp >=
-        timestamps[entry.client] - window_size
+    @property
+    def cache(self):
+        """CiphertextCache, or None"""
+        return self._cache
+
+    @property
+    def tree(self):
+        """MerkleTree, or None. Only covers every row once build_tree
+        returned True."""
+        return self._tree
+
+    def build_tree(self, limit=10000):
+        """Adds the next limit rows in key order to the tree. Reading every
+        row takes a while, so the tree is built a page at a time between
+        other operations; call until it returns True.
+
+        Returns:
+            bool: whether the tree covers every row
+        """
+        if self._tree_ready:
+            return True
+        read = 0
+        for key, row in islice(
+                self._store.scan(self._tree_position + "\0"), limit):
+            read += 1
+            self._tree.update(key, None, _version(row))
+            self._tree_position = _utf8(key)
+        if read < limit:
+            self._tree_ready = True
+        return self._tree_ready
+
+    def _in_tree(self, key):
+        """Whether writes to key have to update the tree. Rows past the
+        build's position are added when it gets to them."""
+        return self._tree is not None and (
+            self._tree_ready or _utf8(key) <= self._tree_position)
+
+    def bucket_versions(self, buckets, after=None, limit=10000):
+        """Reads up to limit rows in key order and returns the versions of
+        those in buckets of the tree. Buckets are by key hash, so finding
+        their keys takes a scan; paging it keeps each read short.
+
+        Args:
+            buckets (set[int]): raises ValueError if they aren't buckets of
+                the tree
+            after (string): last key read by the previous page, None for the
+                first page
+
+        Returns:
+            (list[(key, client_id, timestamp)], key to continue after or None
+            at the end of the table)
+        """
+        self._tree.check(self._tree.depth, buckets)
+        versions = []
+        key = None
+        read = 0
+        for key, row in islice(self._store.scan(after or ""), limit):
+            read += 1
+            if key == after:
+                continue
+            version = _version(row)
+            if version is not None and self._tree.bucket(key) in buckets:
+                versions.append((key,) + version)
+        if read < limit:
+            return versions, None
+        return versions, key
+
+    def select(self, timestamps, after=None, limit=1000):
+        """Selects a page of the entries such that entry.timestamp >=
+        timestamps[entry.client], for catch-up. Entries are stored rows, so
+        they are not deserialized.
 
         Args:
             timestamps ({client id: timestamp})
+            after ((client id, timestamp, key)): position of the last entry
+                of the previous page, None for the first page
+            limit (int)
+
+        Returns:
+            (list[(key, row)], position of the last entry or None if there
+            are no more)
+        """
+        entries = self._store.select(
+            timestamps, tuple(after or ("", "", "")), limit)
+        if len(entries) < limit:
+            return entries, None
+        key, row = entries[-1]
+        return entries, (row[-2], row[-1], key)
+
+    def high_water(self):
+        """Returns {client id: timestamp of its latest stored put}"""
+        return self._store.high_water()
+
+    def apply(self, entries, callback=None):
+        """Stores the entries that are newer than what is stored under their
+        key, in one transaction, and calls callback() once it is durable,
+        see GroupCommitter.
+
+        Args:
+            entries (list[(key, row)]): from another replica's select
         """
-        pass
-
-
-if __name__ == '__main__':
-    for i in xrange(7):
-        conn = sqlite3.connect('databases/secrets' + str(i) + 'db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE secrets
-                    (key TEXT, pi_0_U BLOB, pi_0_V BLOB, c_U BLOB, c_V BLOB)''')
-
-    # db = SecretsDB('testdb')
-    # db.put("brendon", "eats food")
-    # print db.get("brendon")
-    # db.put("kenneth", 1234)
-    # print db.get("brendon")
-    # print db.get("kenneth")
-    # print db.get("not there")
\ No newline at end of file
+        stored = self.versions([key for key, _ in entries])
+        newer = [("put", key, tuple(row)) for key, row in entries
+                 if row[-1] > stored.get(key, ("", ""))[1]]
+        self._store.batch(newer)
+        for _, key, row in newer:
+            if self._cache is not None:
+                self._cache.invalidate(key)
+            if self._in_tree(key):
+                self._tree.update(key, stored.get(key), _version(row))
+        # Commits the group committer's waiting puts along with them
+        self._committer.written(callback)
+        self._committer.commit()
@@ -0,0 +1,525 @@
+import os
+import sqlite3
+import struct
+from itertools import islice
+
+from group_commit import configure_connection
+from schema import ensure_schema, INDEXES, SCHEMA_VERSION, TABLES
+from schema import VERSIONED_TABLES
+from utils import CONSTANTS
+try:
+    import lmdb
+except ImportError:  # py-lmdb is only needed for the "lmdb" engine
+    lmdb = None
+
+
+class SecretsStore(object):
+    """Key -> row storage under SecretsDB and LameSecretsDB. A row is a tuple
+    of byte strings, the non-key columns of the table.
+
+    Writes go into an open transaction that commit() makes durable, so
+    GroupCommitter can commit a store like a sqlite3 connection. Reads see
+    uncommitted writes.
+    """
+    def __init__(self, filename, table):
+        raise NotImplementedError
+
+    def get(self, key):
+        """Returns the row stored under key, or None.
+
+        Args:
+            key (string)
+
+        Returns:
+            tuple[string]
+        """
+        raise NotImplementedError
+
+    def put(self, key, row):
+        """Inserts or replaces the row stored under key.
+
+        Args:
+            key (string)
+            row (tuple[string])
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def scan(self, start=""):
+        """Yields (key, row) in key order, from the first key >= start."""
+        raise NotImplementedError
+
+    def select(self, since, after=("", "", ""), limit=1000):
+        """Reads the rows of a versioned table (see schema.VERSIONED_TABLES)
+        from the timestamp index: those whose put is at least as recent as
+        since[client_id], or any put for clients not in since. Rows are in
+        (client_id, timestamp, key) order, so a caller reads all of them in
+        pages by passing the last one's position as after.
+
+        Args:
+            since ({client_id: timestamp})
+            after ((string, string, string)): (client_id, timestamp, key) to
+                continue after
+            limit (int)
+
+        Returns:
+            list[(string, tuple[string])]: (key, row)
+        """
+        raise NotImplementedError
+
+    def high_water(self):
+        """Returns {client_id: timestamp of its latest stored put} of a
+        versioned table."""
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Yields (key, row) of the committed rows in key order, as of one
+        point in time. Reads in a transaction of its own, so writes to the
+        store, from this process or another, carry on meanwhile."""
+        raise NotImplementedError
+
+    @classmethod
+    def bulk_load(cls, filename, table, rows, batch_rows=100000):
+        """Creates a store of table holding rows, much faster than putting
+        them: rows go in batch_rows per transaction, nothing is synced until
+        the end and indexes are built once all rows are in. A failed load
+        leaves no store behind.
+
+        Args:
+            filename (string): store that doesn't exist yet
+            table (string)
+            rows (iterable[(string, tuple[string])]): (key, row), fastest in
+                key order. Of repeated keys the last one wins.
+            batch_rows (int)
+
+        Returns:
+            int: number of rows read
+        """
+        raise NotImplementedError
+
+    def batch(self, operations):
+        """Applies puts and deletes in the same transaction.
+
+        Args:
+            operations (list[(string, string, tuple[string])]): ("put", key,
+                row) or ("delete", key, None)
+        """
+        for operation, key, row in operations:
+            if operation == "put":
+                self.put(key, row)
+            elif operation == "delete":
+                self.delete(key)
+            else:
+                raise ValueError("Unknown operation {}".format(operation))
+
+    def commit(self):
+        raise NotImplementedError
+
+
+class SQLiteStore(SecretsStore):
+    def __init__(self, filename, table):
+        """One table of the schema in schema.py.
+
+        Args:
+            filename (string)
+            table (string): "secrets" or "lame_secrets"
+        """
+        self._conn = sqlite3.connect(filename)
+        self._conn.text_factory = str
+        configure_connection(self._conn)
+        ensure_schema(self._conn, table)
+        self._cursor = self._conn.cursor()
+        self._filename = filename
+        self._table = table
+
+    @property
+    def connection(self):
+        return self._conn
+
+    def get(self, key):
+        self._cursor.execute(
+            "SELECT * FROM {} WHERE key=?".format(self._table), (key,))
+        row = self._cursor.fetchone()
+        if row is None:
+            return None
+        return row[1:]
+
+    def put(self, key, row):
+        self._cursor.execute("INSERT OR REPLACE INTO {} VALUES ({})".format(
+            self._table, ",".join("?" * (len(row) + 1))), (key,) + tuple(row))
+
+    def delete(self, key):
+        self._cursor.execute(
+            "DELETE FROM {} WHERE key=?".format(self._table), (key,))
+
+    def scan(self, start=""):
+        # Own cursor, so that gets during the scan don't reset it
+        cursor = self._conn.execute(
+            "SELECT * FROM {} WHERE key >= ? ORDER BY key".format(self._table),
+            (start,))
+        for row in cursor:
+            yield row[0], row[1:]
+
+    def _next_client(self, client):
+        """Returns the first client_id after client in the index, or None"""
+        return self._conn.execute(
+            "SELECT MIN(client_id) FROM {} WHERE client_id > ?".format(
+                self._table), (client,)).fetchone()[0]
+
+    def select(self, since, after=("", "", ""), limit=1000):
+        client, after_timestamp, after_key = after
+        if not client:
+            client = self._next_client("")
+        selected = []
+        while client is not None:
+            selected.extend((row[0], row[1:]) for row in self._conn.execute(
+                "SELECT * FROM {} WHERE client_id = ? AND timestamp >= ? "
+                "AND timestamp != '' AND (timestamp > ? OR "
+                "(timestamp = ? AND key > ?)) "
+                "ORDER BY timestamp, key LIMIT ?".format(self._table),
+                # The larger lower bound, so that the index seeks to it
+                (client, max(since.get(client, ""), after_timestamp),
+                 after_timestamp, after_timestamp, after_key,
+                 limit - len(selected))))
+            if len(selected) == limit:
+                break
+            client = self._next_client(client)
+            after_timestamp, after_key = "", ""
+        return selected
+
+    def high_water(self):
+        return dict(self._conn.execute(
+            "SELECT client_id, MAX(timestamp) FROM {} "
+            "WHERE client_id IS NOT NULL GROUP BY client_id".format(
+                self._table)))
+
+    def batch(self, operations):
+        puts = [(key,) + tuple(row) for operation, key, row in operations
+                if operation == "put"]
+        if len(puts) < len(operations):
+            return SecretsStore.batch(self, operations)
+        if puts:
+            self._cursor.executemany(
+                "INSERT OR REPLACE INTO {} VALUES ({})".format(
+                    self._table, ",".join("?" * len(puts[0]))), puts)
+
+    def snapshot(self):
+        # A connection of its own, whose read transaction WAL keeps
+        # consistent while other connections commit
+        conn = sqlite3.connect(self._filename, isolation_level=None)
+        conn.text_factory = str
+        try:
+            conn.execute("BEGIN")
+            for row in conn.execute(
+                    "SELECT * FROM {} ORDER BY key".format(self._table)):
+                yield row[0], row[1:]
+        finally:
+            conn.close()
+
+    @classmethod
+    def bulk_load(cls, filename, table, rows, batch_rows=100000):
+        if os.path.exists(filename):
+            raise ValueError("{} exists".format(filename))
+        loading = filename + ".loading"
+        _remove(loading)
+        conn = sqlite3.connect(loading, isolation_level=None)
+        conn.text_factory = str
+        loaded = 0
+        try:
+            # A failed load is deleted, so there is nothing to roll back to
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(TABLES[table])
+            for batch in _batches(rows, batch_rows):
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT OR REPLACE INTO {} VALUES ({})".format(
+                        table, ",".join("?" * (len(batch[0][1]) + 1))),
+                    ((key,) + tuple(row) for key, row in batch))
+                conn.execute("COMMIT")
+                loaded += len(batch)
+            # One sort per index instead of an index update per row
+            for index in INDEXES[table]:
+                conn.execute(index)
+            conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            conn.close()
+            _fsync(loading)
+        except BaseException:
+            conn.close()
+            _remove(loading)
+            raise
+        os.rename(loading, filename)
+        return loaded
+
+    def commit(self):
+        self._conn.commit()
+
+
+def encode_row(row):
+    """Length prefixed columns"""
+    return "".join(struct.pack("!I", len(column)) + column for column in row)
+
+
+def decode_row(data):
+    row = []
+    offset = 0
+    while offset < len(data):
+        length, = struct.unpack_from("!I", data, offset)
+        offset += 4
+        row.append(str(data[offset:offset + length]))
+        offset += length
+    return tuple(row)
+
+
+def _batches(iterable, size):
+    """Yields lists of size items of iterable, the last one shorter"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _remove(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def _fsync(filename):
+    with open(filename, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _bytes(string):
+    """LMDB keys are byte strings; keys from JSON messages are unicode"""
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return string
+
+
+class LMDBStore(SecretsStore):
+    def __init__(self, filename, table):
+        """Memory-mapped B+tree (LMDB). A get is a lookup in the mapped file,
+        so a login whose row is in the page cache does no read system call,
+        and the row is decoded straight out of the mapping.
+
+        Commits fsync the data but not the meta page, which like
+        synchronous=NORMAL can lose the last commits on power loss but never
+        corrupts the database.
+
+        Versioned tables keep their timestamp index in a second database,
+        table_by_time, of client_id NUL timestamp NUL key -> "".
+
+        Args:
+            filename (string): created as filename-lmdb
+            table (string): named database within the environment
+        """
+        if lmdb is None:
+            raise ValueError("The lmdb storage engine requires py-lmdb")
+        self._env = lmdb.open(
+            filename + "-lmdb", map_size=CONSTANTS.LMDB_MAP_SIZE,
+            subdir=False, max_dbs=4, metasync=False)
+        self._db = self._env.open_db(table)
+        self._index = None
+        if table in VERSIONED_TABLES:
+            self._index = self._env.open_db(table + "_by_time")
+        self._write_txn = None
+
+    def _writer(self):
+        if self._write_txn is None:
+            self._write_txn = self._env.begin(
+                db=self._db, write=True, buffers=True)
+        return self._write_txn
+
+    def _reader(self):
+        """Returns (transaction, whether the caller must abort it)"""
+        if self._write_txn is not None:
+            return self._write_txn, False
+        return self._env.begin(db=self._db, buffers=True), True
+
+    @staticmethod
+    def _index_key(key, row):
+        """Key in the timestamp index, or None for a row without a put
+        version"""
+        if len(row) < 2 or not row[-1]:
+            return None
+        return "\0".join([row[-2], row[-1], key])
+
+    def get(self, key):
+        key = _bytes(key)
+        if self._write_txn is not None:
+            data = self._write_txn.get(key)
+            return None if data is None else decode_row(data)
+        with self._env.begin(db=self._db, buffers=True) as txn:
+            data = txn.get(key)
+            # The buffer points into the mapping and is only valid in txn
+            return None if data is None else decode_row(data)
+
+    def put(self, key, row):
+        key = _bytes(key)
+        if self._index is not None:
+            self._unindex(key)
+            index_key = self._index_key(key, row)
+            if index_key is not None:
+                self._writer().put(index_key, "", db=self._index)
+        self._writer().put(key, encode_row(row))
+
+    def delete(self, key):
+        key = _bytes(key)
+        if self._index is not None:
+            self._unindex(key)
+        self._writer().delete(key)
+
+    def _unindex(self, key):
+        old = self.get(key)
+        if old is not None:
+            index_key = self._index_key(key, old)
+            if index_key is not None:
+                self._writer().delete(index_key, db=self._index)
+
+    def scan(self, start=""):
+        txn, own_txn = self._reader()
+        try:
+            cursor = txn.cursor()
+            if cursor.set_range(_bytes(start)):
+                for key, data in cursor:
+                    yield str(key), decode_row(data)
+        finally:
+            if own_txn:
+                txn.abort()
+
+    def select(self, since, after=("", "", ""), limit=1000):
+        since = dict((_bytes(client), _bytes(timestamp))
+                     for client, timestamp in since.iteritems())
+        after = "\0".join(_bytes(part) for part in after)
+        txn, own_txn = self._reader()
+        try:
+            cursor = txn.cursor(db=self._index)
+            selected = []
+            position = cursor.set_range(after)
+            while position and len(selected) < limit:
+                index_key = str(cursor.key())
+                if index_key == after:
+                    position = cursor.next()
+                    continue
+                client, timestamp, key = index_key.split("\0", 2)
+                if timestamp < since.get(client, ""):
+                    # Skip this client's older puts
+                    position = cursor.set_range(
+                        "\0".join([client, since[client]]))
+                    continue
+                selected.append(
+                    (key, decode_row(txn.get(key, db=self._db))))
+                position = cursor.next()
+            return selected
+        finally:
+            if own_txn:
+                txn.abort()
+
+    def high_water(self):
+        txn, own_txn = self._reader()
+        try:
+            cursor = txn.cursor(db=self._index)
+            latest = {}
+            position = cursor.first()
+            while position:
+                client = str(cursor.key()).split("\0", 1)[0]
+                # Jump to the client's last entry
+                if cursor.set_range(client + "\1"):
+                    cursor.prev()
+                else:
+                    cursor.last()
+                latest[client] = str(cursor.key()).split("\0", 2)[1]
+                position = cursor.next()
+            return latest
+        finally:
+            if own_txn:
+                txn.abort()
+
+    def snapshot(self):
+        # A read transaction sees the database as of its start, and doesn't
+        # hold up writers
+        with self._env.begin(db=self._db, buffers=True) as txn:
+            for key, data in txn.cursor():
+                yield str(key), decode_row(data)
+
+    @classmethod
+    def bulk_load(cls, filename, table, rows, batch_rows=100000):
+        if lmdb is None:
+            raise ValueError("The lmdb storage engine requires py-lmdb")
+        if os.path.exists(filename + "-lmdb"):
+            raise ValueError("{}-lmdb exists".format(filename))
+        loading = filename + ".loading-lmdb"
+        _remove(loading)
+        _remove(loading + "-lock")
+        env = lmdb.open(loading, map_size=CONSTANTS.LMDB_MAP_SIZE,
+                        subdir=False, max_dbs=4, sync=False)
+        loaded = 0
+        index_keys = {}  # key -> index key of the row loaded last
+        try:
+            db = env.open_db(table)
+            last = None
+            for batch in _batches(rows, batch_rows):
+                items = [(_bytes(key), encode_row(row)) for key, row in batch]
+                if table in VERSIONED_TABLES:
+                    index_keys.update(
+                        (key, cls._index_key(key, row)) for (key, _), (_, row)
+                        in zip(items, batch))
+                keys = [key for key, _ in items]
+                # Appending skips the B+tree search, for a batch in key order
+                # after the last one
+                append = ((last is None or keys[0] > last) and
+                          all(a < b for a, b in zip(keys, keys[1:])))
+                with env.begin(db=db, write=True) as txn:
+                    txn.cursor().putmulti(items, append=append)
+                last = max(last, max(keys))
+                loaded += len(batch)
+            if table in VERSIONED_TABLES:
+                cls._build_index(env, env.open_db(table + "_by_time"),
+                                 index_keys, batch_rows)
+            env.sync(True)
+        except BaseException:
+            env.close()
+            _remove(loading)
+            _remove(loading + "-lock")
+            raise
+        env.close()
+        os.rename(loading, filename + "-lmdb")
+        _remove(loading + "-lock")
+        return loaded
+
+    @staticmethod
+    def _build_index(env, index, index_keys, batch_rows):
+        """Fills the timestamp index of a loaded table in index order.
+
+        Args:
+            index_keys ({string: string}): key -> index key, None for rows
+                without a put version
+        """
+        index_keys = sorted(index_key for index_key in index_keys.itervalues()
+                            if index_key is not None)
+        for start in xrange(0, len(index_keys), batch_rows):
+            with env.begin(db=index, write=True) as txn:
+                txn.cursor().putmulti(
+                    ((index_key, "") for index_key
+                     in index_keys[start:start + batch_rows]), append=True)
+
+    def commit(self):
+        if self._write_txn is not None:
+            self._write_txn.commit()
+            self._write_txn = None
+
+
+STORAGE_ENGINES = {
+    "sqlite": SQLiteStore,
+    "lmdb": LMDBStore,
+}
+
+
+def get_secrets_store():
+    if CONSTANTS.STORAGE_ENGINE not in STORAGE_ENGINES:
+        raise ValueError("Unsupported storage engine")
+    return STORAGE_ENGINES[CONSTANTS.STORAGE_ENGINE]
@@ -1,12 +1,27 @@
 import asyncore
+import time
+from collections import OrderedDict
 from signature_service import get_signature_service
+from signature_service import CachingSignatureService
+from batch_signature_service import MerkleBatchSignatureService
 from threshold_encryption_service import ThresholdEncryptionService
+from threshold_signature_service import ThresholdSignatureService
 from secrets_db import SecretsDB
+from db_executor import DBExecutor
+from link_authentication import MACService
+from write_ahead_log import WriteAheadLog
+from recovery import Recovery
 
 from message import GetMessage
 from message import DecryptionShareMessage
 from message import PutMessage
 from message import PutAcceptMessage
+from message import CatchUpRequestMessage
+from message import CatchUpResponseMessage
+from message import AntiEntropyRequestMessage
+from message import AntiEntropyResponseMessage
+from state_machine import AntiEntropyStateMachine
+from state_machine import CatchupStateMachine
 from state_machine import GetStateMachine
 from state_machine import PutStateMachine
 from utils import CONSTANTS
@@ -21,36 +36,242 @@ class Server(object):
         """
         self._id = uid
         self._signature_service = get_signature_service()(uid)
+        if CONSTANTS.SIGNATURE_CACHE_SIZE > 0:
+            self._signature_service = CachingSignatureService(
+                self._signature_service, CONSTANTS.SIGNATURE_CACHE_SIZE)
+        self._batch_signature_service = None
+        if CONSTANTS.SIGNATURE_BATCH_WINDOW > 0:
+            self._batch_signature_service = MerkleBatchSignatureService(
+                self._signature_service, CONSTANTS.SIGNATURE_BATCH_WINDOW,
+                CONSTANTS.SIGNATURE_BATCH_SIZE)
+            self._signature_service = self._batch_signature_service
         self._threshold_encryption_service = ThresholdEncryptionService(
             'thenc8_2.keys', uid)
-        self._secrets_db = SecretsDB('databases/secrets' + str(uid) + 'db')
+        self._threshold_signature_service = None
+        if CONSTANTS.THRESHOLD_SIGNATURES:
+            self._threshold_signature_service = ThresholdSignatureService(
+                'thsig8_2.keys', uid)
+        # Reads and writes run on their own thread, see DBExecutor
+        self._secrets_db = DBExecutor(lambda: SecretsDB(
+            'databases/secrets' + str(uid) + 'db',
+            CONSTANTS.DB_COMMIT_INTERVAL, CONSTANTS.DB_COMMIT_ROWS,
+            CONSTANTS.CIPHERTEXT_CACHE_BYTES,
+            merkle_tree=CONSTANTS.ANTI_ENTROPY_INTERVAL > 0))
+        self._write_ahead_log = None
+        if CONSTANTS.WRITE_AHEAD_LOG:
+            self._write_ahead_log = WriteAheadLog(
+                'logs/server' + str(uid), CONSTANTS.WAL_SEGMENT_BYTES,
+                CONSTANTS.WAL_SYNC_INTERVAL)
         self._N = CONSTANTS.N
         self._f = CONSTANTS.f
         self._state_machines = {}
+        # Late messages of these aren't logged, or the transaction would be
+        # open in the log again. Kept until the log deletes the segment each
+        # completed in, see _forget_completed_transactions.
+        self._completed_transactions = OrderedDict()  # key -> segment
+        # Logged transactions that are not complete yet, oldest first, with
+        # when they started, see _expire_transactions
+        self._open_transactions = OrderedDict()
+        self._catchup_state_machine = CatchupStateMachine(self)
+        self._anti_entropy = None
+        if CONSTANTS.ANTI_ENTROPY_INTERVAL > 0:
+            self._anti_entropy = AntiEntropyStateMachine(self)
+        self._recovery = None
+        self._replaying = False  # Set once stored puts have been skipped
+        if self._write_ahead_log is not None:
+            self._recover()
+
+        # Replica to replica messages are signed, or only MACed per link
+        self._mac_service = None
+        if CONSTANTS.REPLICA_AUTHENTICATION == "mac":
+            self._mac_service = MACService(uid)
 
         PORTS = xrange(8001, 8001 + CONSTANTS.N)
         from messaging_service import MessagingService, Address
         ADDRESSES = [Address(port - 8001, port, 'localhost', True) for
                      port in PORTS]
         ADDRESSES += [Address(100, 8101, 'localhost', False)]
-        self._messaging_service = MessagingService(ADDRESSES, self)
-        asyncore.loop()
+        self._messaging_service = MessagingService(
+            ADDRESSES, self, self._mac_service)
+        if CONSTANTS.CATCH_UP_ON_START:
+            self._catchup_state_machine.catch_up()
+        if (self._batch_signature_service is None and
+                self._write_ahead_log is None and
+                self._anti_entropy is None and
+                not self._catchup_state_machine.waiting):
+            asyncore.loop()
+        else:
+            while asyncore.socket_map:
+                # Wake up at least once per window to sign the waiting batch,
+                # per anti-entropy interval and per transaction timeout, and
+                # keep replaying between events while recovering
+                timeouts = [30.0]
+                if self._replaying:
+                    timeouts.append(0)
+                if self._write_ahead_log is not None:
+                    timeouts.append(CONSTANTS.TRANSACTION_TIMEOUT)
+                if self._batch_signature_service is not None:
+                    timeouts.append(CONSTANTS.SIGNATURE_BATCH_WINDOW)
+                if self._anti_entropy is not None:
+                    timeouts.append(CONSTANTS.ANTI_ENTROPY_INTERVAL)
+                if self._catchup_state_machine.waiting:
+                    timeouts.append(1.0)  # for peers to connect
+                asyncore.loop(timeout=min(timeouts), count=1)
+                if self._batch_signature_service is not None:
+                    self._batch_signature_service.poll()
+                if self._replaying:
+                    self._replay_some()
+                if self._write_ahead_log is not None:
+                    self._expire_transactions()
+                if self._anti_entropy is not None:
+                    self._anti_entropy.poll()
+                self._catchup_state_machine.poll()
+
+    def _recover(self):
+        """Picks up the transactions that were in flight when the server
+        stopped. Traffic is served as soon as the log is indexed; puts that
+        already reached the secrets db are completed without replay, and the
+        rest are replayed lazily, see _replay and _replay_some."""
+        start = time.time()
+        recovery = Recovery(self._write_ahead_log)
+        if not recovery:
+            return
+        self._recovery = recovery
+        print "Recovered {} transactions ({} messages) in {:.3f}s".format(
+            len(recovery), recovery.messages, time.time() - start)
+
+        puts = [key for key in recovery.transactions if key[2] == "PUT"]
+        self._secrets_db.timestamps(
+            [key[0] for key in puts],
+            lambda stored: self._skip_stored_puts(puts, stored))
+
+    def _skip_stored_puts(self, puts, stored):
+        """Completes the recovered puts whose secret, or a later one, is
+        already stored, then starts the background replay."""
+        if isinstance(stored, Exception):
+            stored = {}  # Replays them all
+        for key in puts:
+            if (key in self._recovery and key[0] in stored and
+                    stored[key[0]] >= key[1]):
+                self._recovery.discard(key)
+                self._complete_transaction(key)
+        self._replaying = True
+
+    def _replay(self, key):
+        """Feeds a recovered transaction's messages to its state machine.
+        They were verified before they were logged."""
+        for msg in self._recovery.take(key):
+            self._dispatch(msg, key)
+
+    def _replay_some(self):
+        for key in self._recovery.oldest(CONSTANTS.WAL_REPLAY_BATCH):
+            self._replay(key)
+        if not self._recovery:
+            self._recovery = None
+            self._replaying = False
 
     def handle_message(self, msg):
-        if not msg.verify_signatures(self._signature_service):
+        if (isinstance(msg, CatchUpRequestMessage) or
+                isinstance(msg, CatchUpResponseMessage)):
+            # Catch-up entries are stored as they arrive, so they aren't
+            # logged
+            if msg.verify_signatures(self.replica_authenticator):
+                self._catchup_state_machine.handle_message(msg)
+            return
+        if (isinstance(msg, AntiEntropyRequestMessage) or
+                isinstance(msg, AntiEntropyResponseMessage)):
+            if (self._anti_entropy is not None and
+                    msg.verify_signatures(self.replica_authenticator)):
+                self._anti_entropy.handle_message(msg)
+            return
+        if (isinstance(msg, PutAcceptMessage) or
+                isinstance(msg, DecryptionShareMessage)):
+            verified = msg.verify_signatures(
+                self._signature_service, self.replica_authenticator)
+        else:
+            verified = msg.verify_signatures(self._signature_service)
+        if not verified:
             return
 
+        key = self._transaction_key(msg)
+        if key is None:
+            return
+        if self._recovery is not None and key in self._recovery:
+            # Its earlier messages go to the state machine first
+            self._replay(key)
+        if (self._write_ahead_log is None or
+                key in self._completed_transactions):
+            self._dispatch(msg, key)
+        else:
+            # Only act on the message once it would survive a crash
+            self._write_ahead_log.log(
+                msg, key, lambda error=None: self._dispatch_logged(
+                    msg, key, error))
+
+    def _transaction_key(self, msg):
+        """Key of the state machine that handles msg, or None"""
         if (isinstance(msg, GetMessage) or
                 isinstance(msg, DecryptionShareMessage)):
-            key = (msg.key, msg.timestamp, "GET")
-            if key not in self._state_machines:
-                self._state_machines[key] = GetStateMachine(msg, self)
-            self._state_machines[key].handle_message(msg)
+            return (msg.key, msg.timestamp, "GET")
         elif isinstance(msg, PutMessage) or isinstance(msg, PutAcceptMessage):
-            key = (msg.key, msg.timestamp, "PUT")
-            if key not in self._state_machines:
+            return (msg.key, msg.timestamp, "PUT")
+        return None
+
+    def _dispatch_logged(self, msg, key, error):
+        if error is not None:
+            # The log stopped: the message would not survive a crash
+            return
+        self._dispatch(msg, key)
+
+    def _dispatch(self, msg, key):
+        if key not in self._state_machines:
+            if (self._write_ahead_log is not None and
+                    key not in self._completed_transactions):
+                self._open_transactions[key] = time.time()
+            if key[2] == "GET":
+                self._state_machines[key] = GetStateMachine(msg, self)
+            else:
                 self._state_machines[key] = PutStateMachine(msg, self)
-            self._state_machines[key].handle_message(msg)
+        self._state_machines[key].handle_message(msg)
+
+    def complete_transaction(self, client_msg):
+        """Called by a state machine once it has responded to the client, so
+        that its messages are not replayed.
+
+        Args:
+            client_msg (GetMessage | PutMessage)
+        """
+        self._complete_transaction(self._transaction_key(client_msg))
+
+    def _complete_transaction(self, key):
+        self._open_transactions.pop(key, None)
+        if self._write_ahead_log is not None:
+            self._completed_transactions[key] = self._write_ahead_log.segment
+            self._write_ahead_log.complete(key)
+            self._forget_completed_transactions()
+
+    def _forget_completed_transactions(self):
+        """Drops the completed transactions whose segment the log deleted.
+        All of their records are gone with it, so a late message only opens
+        the transaction again until it expires."""
+        first_segment = self._write_ahead_log.first_segment
+        while self._completed_transactions:
+            key, segment = next(self._completed_transactions.iteritems())
+            if segment >= first_segment:
+                return
+            del self._completed_transactions[key]
+
+    def _expire_transactions(self):
+        """Completes the transactions still open after TRANSACTION_TIMEOUT
+        seconds, e.g. ones that never got a quorum, so that the write-ahead
+        log can truncate their segments"""
+        deadline = time.time() - CONSTANTS.TRANSACTION_TIMEOUT
+        while self._open_transactions:
+            key, started = next(self._open_transactions.iteritems())
+            if started > deadline:
+                return
+            print "Expiring unfinished transaction {}".format(key)
+            self._complete_transaction(key)
 
     @property
     def id(self):
@@ -72,13 +293,23 @@ class Server(object):
     def threshold_encryption_service(self):
         return self._threshold_encryption_service
 
+    @property
+    def threshold_signature_service(self):
+        return self._threshold_signature_service
+
     @property
     def signature_service(self):
         return self._signature_service
 
+    @property
+    def replica_authenticator(self):
+        """Signs / validates messages that only other replicas read"""
+        return self._mac_service or self._signature_service
+
     @property
     def write_ahead_log(self):
-        pass
+        """WriteAheadLog, or None"""
+        return self._write_ahead_log
 
     @property
     def secrets_db(self):
@@ -86,7 +317,7 @@ class Server(object):
 
     @property
     def catchup_state_machine(self):
-        pass
+        return self._catchup_state_machine
 
     @property
     def f(self):
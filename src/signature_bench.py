@@ -0,0 +1,163 @@
+import argparse
+import os
+import time
+
+from message import GetMessage
+from message import GetResponseMessage
+from message import PutAcceptMessage
+from message import PutCompleteMessage
+from message import PutMessage
+from signature_service import SIGNATURE_SERVICES
+from utils import CONSTANTS
+from utils import set_constants
+try:
+    from threshold_signature_service import ThresholdSignatureService
+except ImportError:  # charm is only needed for the threshold case
+    ThresholdSignatureService = None
+
+CLIENT_ID = 100
+SIGNER_ID = 0
+VERIFIER_ID = 1
+PERCENTILES = [50, 90, 99]
+
+
+class ThresholdShares(object):
+    def __init__(self, server_id):
+        """Threshold BLS signature shares, behind the sign / validate
+        interface of a SignatureService, as the "threshold" case.
+
+        Args:
+            server_id (int)
+        """
+        self._service = ThresholdSignatureService('thsig8_2.keys', server_id)
+
+    def sign(self, msg):
+        return self._service.sign_share(msg)
+
+    def validate(self, msg, sender, signature):
+        return self._service.verify_share(msg, signature, sender)
+
+
+def message_payloads(signature_service):
+    """Returns {message type: data} for the messages a server or client
+    signs. Embedded client signatures come from signature_service, so their
+    size matches the scheme.
+    """
+    secret = os.urandom(64)  # pi_0 and c
+    put = PutMessage("user0", secret, CLIENT_ID, signature_service)
+    get = GetMessage("user0", CLIENT_ID, signature_service)
+    return {
+        "PUT": put.data,
+        "GET": get.data,
+        "PUT_ACCEPT": PutAcceptMessage(put, SIGNER_ID).data,
+        "PUT_COMPLETE": PutCompleteMessage(put, SIGNER_ID).data,
+        "RESPONSE": GetResponseMessage(get, secret, SIGNER_ID).data,
+    }
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def bench(operation, payloads, count):
+    """Runs operation(payload) count times per payload, round robin.
+
+    Returns:
+        (list[float], {message type: list[float]}): cumulative seconds after
+            each call, and sorted latencies per message type
+    """
+    latencies = dict((name, []) for name in payloads)
+    cumulative = []
+    start = time.time()
+    for _ in xrange(count):
+        for name, payload in sorted(payloads.iteritems()):
+            before = time.time()
+            operation(payload)
+            after = time.time()
+            latencies[name].append(after - before)
+            cumulative.append(after - start)
+    for name in latencies:
+        latencies[name].sort()
+    return cumulative, latencies
+
+
+def report(service_name, operation_name, cumulative, latencies):
+    print "{} {}: {:.0f} ops/s".format(
+        service_name, operation_name, len(cumulative) / cumulative[-1])
+    for name, times in sorted(latencies.iteritems()):
+        print "    {:<13} p50 {:>8.1f}us p99 {:>8.1f}us".format(
+            name, percentile(times, 0.5) * 1e6, percentile(times, 0.99) * 1e6)
+
+
+def write_times(filename, cumulative, latencies):
+    """Writes "count, seconds" lines like the times/ files: the cumulative
+    time after every 100 operations to filename + "-times", and the latency
+    percentiles over all message types to filename + "-percentiles"."""
+    with open(filename + "-times", "w") as f:
+        for count in xrange(100, len(cumulative) + 1, 100):
+            f.write("{}, {}\n".format(count, cumulative[count - 1]))
+    latencies = sorted(sum(latencies.values(), []))
+    with open(filename + "-percentiles", "w") as f:
+        for p in PERCENTILES:
+            f.write("{}, {}\n".format(p, percentile(latencies, p / 100.0)))
+
+
+if __name__ == "__main__":
+    # Runs without a cluster, but needs the key directory from
+    # `python key_directory.py`, and for the threshold case charm and
+    # thsig8_2.keys. Writes e.g. times/rsa-sign-times and
+    # times/rsa-sign-percentiles, see write_times.
+    services = dict(SIGNATURE_SERVICES)
+    if ThresholdSignatureService is not None:
+        services["threshold"] = ThresholdShares
+    parser = argparse.ArgumentParser(
+        description="Measures sign / verify throughput and latency of the "
+                    "signature services on real message payloads.")
+    parser.add_argument("--services", nargs="+",
+                        default=sorted(SIGNATURE_SERVICES.keys()) +
+                        ["threshold"])
+    parser.add_argument("--count", type=int, default=200,
+                        help="operations per message type")
+    parser.add_argument("--out-dir", default="times")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE", help="override a CONSTANTS "
+                        "value, e.g. ECDSA_NONCE_POOL_SIZE=1000")
+    args = parser.parse_args()
+    set_constants(args.set)
+
+    for service_name in args.services:
+        if service_name == "threshold" and ThresholdSignatureService is None:
+            print "Skipping threshold: charm is not installed"
+            continue
+        try:
+            signer = services[service_name](SIGNER_ID)
+            verifier = services[service_name](VERIFIER_ID)
+        except (ValueError, IOError) as e:  # e.g. PyNaCl or keys missing
+            print "Skipping {}: {}".format(service_name, e)
+            continue
+
+        nonce_pool = getattr(signer, "nonce_pool", None)
+        if nonce_pool is not None:
+            # A running server has had time to fill its pool
+            while (nonce_pool.metrics()["pool_depth"] <
+                   CONSTANTS.ECDSA_NONCE_POOL_SIZE):
+                time.sleep(0.1)
+
+        payloads = message_payloads(signer)
+        signed = dict((payload, signer.sign(payload))
+                      for payload in payloads.itervalues())
+
+        def verify(payload):
+            assert verifier.validate(payload, SIGNER_ID, signed[payload])
+
+        sign_times, sign_latencies = bench(signer.sign, payloads, args.count)
+        verify_times, verify_latencies = bench(verify, payloads, args.count)
+
+        report(service_name, "sign", sign_times, sign_latencies)
+        if nonce_pool is not None:
+            print "    nonce pool: {}".format(nonce_pool.metrics())
+        report(service_name, "verify", verify_times, verify_latencies)
+        write_times(os.path.join(args.out_dir, service_name + "-sign"),
+                    sign_times, sign_latencies)
+        write_times(os.path.join(args.out_dir, service_name + "-verify"),
+                    verify_times, verify_latencies)
@@ -1,16 +1,21 @@
-from os import path, listdir
+import binascii
+import hashlib
+from collections import OrderedDict
 from ecdsa import SigningKey, VerifyingKey, BadSignatureError
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
+from Crypto.Signature import PKCS1_PSS
+from ecdsa_nonce_pool import ECDSANoncePool
+from key_directory import get_key_directory, private_key_filename
+try:
+    from nacl.exceptions import BadSignatureError as NaclBadSignatureError
+    from nacl.signing import SigningKey as Ed25519SigningKey
+    from nacl.signing import VerifyKey as Ed25519VerifyKey
+except ImportError:  # PyNaCl is only needed for the "ed25519" service
+    Ed25519SigningKey = None
 from utils import CONSTANTS
 
 
-CONFIG_DIR = "config"
-CONFIG_SUFFIX = "_signature.config"
-VK_STR_LEN = 48
-SK_STR_LEN = 24
-
-
 class SignatureService(object):
     def __init__(self, server_id):
         raise NotImplementedError
@@ -40,30 +45,87 @@ class SignatureService(object):
         # If we do not have the sender on file, look for their config file
         raise NotImplementedError
 
+    def sign_many(self, msgs):
+        """Sign a batch of messages
+
+        Args:
+            msgs (list[string])
+
+        Returns:
+            list[string]
+        """
+        return [self.sign(msg) for msg in msgs]
+
+    def validate_many(self, items):
+        """Validate a batch of signatures
+
+        Args:
+            items (list[(string, int, string)]): (msg, sender_id, signature)
+
+        Returns:
+            list[bool]
+        """
+        return [self.validate(msg, sender, signature)
+                for msg, sender, signature in items]
+
+    def sign_later(self, message, callback):
+        """Sign a Message and pass it to callback, e.g. to send it. Services
+        that batch signatures may call back only once the batch is flushed.
+
+        Args:
+            message (Message): built without a signature
+            callback (Message -> None)
+        """
+        message.set_signature(self)
+        callback(message)
+
 
 class RSASignatureService(SignatureService):
-    def __init__(self, server_id):
-        all_config_filename = path.join(CONFIG_DIR, "rsakeys.pem")
-        if not path.isfile(all_config_filename):
-            # TODO all servers use the same private public key which is
-            # fine for timing but is very insecure.
-            key = RSA.generate(2048)
-            f = open(all_config_filename, 'w')
-            f.write(key.exportKey('PEM'))
-            f.close()
-
-        f = open(all_config_filename, 'r')
-        self.key = RSA.importKey(f.read())
+    def __init__(self, server_id, key=None):
+        """RSASSA-PSS with SHA-256.
+
+        Args:
+            server_id (int)
+            key (RSA key): if given, sign with it and accept it for every
+                sender instead of using the key directory (for benchmarks)
+        """
+        self.server_id = server_id
+        # Build the signer and the public key verifiers once instead of per
+        # message.
+        self._verifiers = {}  # sender_id -> PSS verifier
+        self._default_verifier = None
+        if key is None:
+            with open(private_key_filename("rsa", server_id)) as f:
+                key = RSA.importKey(f.read())
+            for sender, public_key in get_key_directory().public_keys(
+                    "rsa").iteritems():
+                self._verifiers[sender] = PKCS1_PSS.new(
+                    RSA.importKey(public_key))
+        else:
+            self._default_verifier = PKCS1_PSS.new(key.publickey())
+
+        self.key = key
+        self._signer = PKCS1_PSS.new(key)
+
+    @staticmethod
+    def generate_keypair():
+        key = RSA.generate(2048)
+        return key.exportKey('PEM'), key.publickey().exportKey('DER')
 
     def sign(self, msg):
-        digest = SHA256.new(msg).digest()
-        signature = self.key.sign(digest, '')[0]
-        return str(signature)
+        signature = self._signer.sign(SHA256.new(msg))
+        return signature.encode('base64')
 
     def validate(self, msg, sender, signature):
-        signature = (long(signature),)
-        digest = SHA256.new(msg).digest()
-        return self.key.publickey().verify(digest, signature)
+        verifier = self._verifiers.get(sender, self._default_verifier)
+        if verifier is None:
+            print ("Server %r has no RSA key for %r" % (self.server_id, sender))
+            return False
+        try:
+            signature = signature.decode('base64')
+        except (binascii.Error, ValueError):
+            return False
+        return verifier.verify(SHA256.new(msg), signature)
 
 
 class NoSignatureService(SignatureService):
@@ -78,69 +140,165 @@ class NoSignatureService(SignatureService):
 
 
 class ECDSASignatureService(SignatureService):
-    sk = None
-
     def __init__(self, server_id):
         self.server_id = server_id
-        own_config_filename = path.join(CONFIG_DIR, str(server_id) + CONFIG_SUFFIX)
-        if not path.isfile(own_config_filename):
-            sk = SigningKey.generate()
-            vk = sk.get_verifying_key()
-            with open(own_config_filename, "w") as config_file:
-                config_file.write(vk.to_string())
-                config_file.write(sk.to_string())
-
-        # Look for all config files in the directory
-        self.vks = {}
-        for filename in listdir(CONFIG_DIR):
-            if filename.endswith(CONFIG_SUFFIX):
-                other_server_id = int(filename[0:len(filename) - len(CONFIG_SUFFIX)])
-                with open(path.join(CONFIG_DIR, filename)) as config_file:
-                    self.vks[other_server_id] = VerifyingKey.from_string(
-                                                    config_file.read(VK_STR_LEN))
-                    # Remember your own secret key
-                    if other_server_id == server_id:
-                        self.sk = SigningKey.from_string(
-                                    config_file.read(SK_STR_LEN))
-
-        assert self.sk # Make sure that you know your own secret key
+        with open(private_key_filename("ecdsa", server_id)) as f:
+            self.sk = SigningKey.from_string(f.read())
+        # Nonces are precomputed off the event loop when the pool is enabled
+        self.nonce_pool = None
+        if CONSTANTS.ECDSA_NONCE_POOL_SIZE > 0:
+            self.nonce_pool = ECDSANoncePool(
+                self.sk.curve, CONSTANTS.ECDSA_NONCE_POOL_SIZE)
+
+        self.vks = dict(
+            (sender, VerifyingKey.from_string(public_key))
+            for sender, public_key in get_key_directory().public_keys(
+                "ecdsa").iteritems())
+
+    @staticmethod
+    def generate_keypair():
+        sk = SigningKey.generate()
+        return sk.to_string(), sk.get_verifying_key().to_string()
 
     def sign(self, msg):
+        if self.nonce_pool is not None:
+            return self.nonce_pool.sign(self.sk, msg).encode('base64')
         return self.sk.sign(msg).encode('base64')
 
     def validate(self, msg, sender, signature):
-        signature = signature.decode('base64')
-        if sender not in self.vks:
-            sender_config_filename = path.join(CONFIG_DIR, str(sender) + CONFIG_SUFFIX)
-            if path.isfile(sender_config_filename):
-                with open(sender_config_filename) as config_file:
-                    self.vks[sender] = VerifyingKey.from_string(
-                                            config_file.read(VK_STR_LEN))
-            else:
-                print ("Server %r cannot find server %r in signature config files."
-                        %(self.server_id, sender))
-                return False
-
-        # Perform validation
-        vk = self.vks[sender]
+        vk = self.vks.get(sender)
+        if vk is None:
+            print ("Server %r has no ECDSA key for %r" % (self.server_id, sender))
+            return False
+
+        try:
+            vk.verify(signature.decode('base64'), msg)
+        except (BadSignatureError, ValueError, binascii.Error):
+            return False
+        return True
+
+
+class Ed25519SignatureService(SignatureService):
+    def __init__(self, server_id):
+        """Ed25519 through libsodium (PyNaCl).
+
+        validate_many verifies one signature at a time. Batch verification
+        checks a random linear combination of the signatures with one
+        multi-scalar multiplication. libsodium has no multi-scalar
+        multiplication, and with one scalar multiplication per term the
+        check costs more than verifying each signature on its own.
+        """
+        if Ed25519SigningKey is None:
+            raise ValueError("The ed25519 signature service requires PyNaCl")
+        self.server_id = server_id
+        with open(private_key_filename("ed25519", server_id)) as f:
+            self.sk = Ed25519SigningKey(f.read())
+
+        self.vks = dict(
+            (sender, Ed25519VerifyKey(public_key))
+            for sender, public_key in get_key_directory().public_keys(
+                "ed25519").iteritems())
+
+    @staticmethod
+    def generate_keypair():
+        sk = Ed25519SigningKey.generate()
+        return sk.encode(), sk.verify_key.encode()
+
+    def sign(self, msg):
+        return self.sk.sign(msg).signature.encode('base64')
+
+    def validate(self, msg, sender, signature):
+        vk = self.vks.get(sender)
+        if vk is None:
+            print ("Server %r has no Ed25519 key for %r" % (self.server_id, sender))
+            return False
+
         try:
-            vk.verify(signature, msg)
-        except BadSignatureError:
+            vk.verify(msg, signature.decode('base64'))
+        except (NaclBadSignatureError, ValueError, binascii.Error):
             return False
         return True
 
 
+class CachingSignatureService(SignatureService):
+    def __init__(self, signature_service, capacity):
+        """Remembers signatures that validated, so that a client signature
+        embedded in every PutAcceptMessage / DecryptionShareMessage of a
+        round is only verified once per replica. Bounded LRU; only successful
+        validations are cached.
+
+        Args:
+            signature_service (SignatureService): does the actual work
+            capacity (int): maximum number of cached signatures
+        """
+        self._signature_service = signature_service
+        self._capacity = capacity
+        self._verified = OrderedDict()  # (sender, digest, signature) -> True
+        self.hits = 0
+        self.misses = 0
+
+    def sign(self, msg):
+        return self._signature_service.sign(msg)
+
+    def sign_many(self, msgs):
+        return self._signature_service.sign_many(msgs)
+
+    def validate(self, msg, sender, signature):
+        key = (sender, hashlib.sha256(msg).digest(), signature)
+        if key in self._verified:
+            self.hits += 1
+            # Move to the most recently used end
+            del self._verified[key]
+            self._verified[key] = True
+            return True
+
+        self.misses += 1
+        if not self._signature_service.validate(msg, sender, signature):
+            return False
+        self._verified[key] = True
+        if len(self._verified) > self._capacity:
+            self._verified.popitem(last=False)
+        return True
+
+
+KEY_GENERATORS = {
+    "rsa": RSASignatureService.generate_keypair,
+    "ecdsa": ECDSASignatureService.generate_keypair,
+}
+if Ed25519SigningKey is not None:
+    KEY_GENERATORS["ed25519"] = Ed25519SignatureService.generate_keypair
+
+
+SIGNATURE_SERVICES = {
+    "rsa": RSASignatureService,
+    "ecdsa": ECDSASignatureService,
+    "ed25519": Ed25519SignatureService,
+    "none": NoSignatureService,
+}
+
+
 def get_signature_service():
-    if CONSTANTS.SIGNATURE_SERVICE == "rsa":
-        return RSASignatureService
-    elif CONSTANTS.SIGNATURE_SERVICE == "ecdsa":
-        return ECDSASignatureService
-    elif CONSTANTS.SIGNATURE_SERVICE == "none":
-        return NoSignatureService
-    else:
+    if CONSTANTS.SIGNATURE_SERVICE not in SIGNATURE_SERVICES:
         raise ValueError("Unsupported signature service")
+    return SIGNATURE_SERVICES[CONSTANTS.SIGNATURE_SERVICE]
 
 if __name__ == '__main__':
+    import time
+
+    for bits in [2048, 3072]:
+        ss = RSASignatureService(0, key=RSA.generate(bits))
+        msgs = [str(i) * 64 for i in xrange(200)]
+        start = time.time()
+        signatures = ss.sign_many(msgs)
+        sign_time = time.time() - start
+        start = time.time()
+        assert all(ss.validate_many(
+            [(msg, 0, sig) for msg, sig in zip(msgs, signatures)]))
+        verify_time = time.time() - start
+        print "RSA-{}: {:.0f} signs/s, {:.0f} verifies/s".format(
+            bits, len(msgs) / sign_time, len(msgs) / verify_time)
+
+    # Needs config/ from `python key_directory.py`
     ss1 = RSASignatureService(1)
     signature1 = ss1.sign("hello world")
     assert ss1.validate("hello world", 1, signature1)
@@ -150,6 +308,7 @@ if __name__ == '__main__':
     assert ss1.validate("yellow red", 2, signature2)
     assert not ss1.validate("yellow", 2, signature2)
     assert not ss1.validate("yellow red", 2, signature1)
-    assert ss2.validate("hello world", 2, signature1)
+    assert ss2.validate("hello world", 1, signature1)
+    assert not ss2.validate("hello world", 2, signature1)
 
     print "Passes"
@@ -0,0 +1,353 @@
+import base64
+import csv
+import hashlib
+import json
+import os
+import struct
+import zlib
+from datetime import datetime
+from itertools import islice
+
+from schema import BINARY_COLUMNS, COLUMNS, SCHEMA_VERSION
+from secrets_store import STORAGE_ENGINES
+from utils import CONSTANTS
+
+MAGIC = "secrets snapshot\n"
+# Chunk: payload length, CRC32 of kind + payload, kind, payload
+CHUNK = struct.Struct("!IIB")
+MANIFEST = 0  # payload: JSON {"table", "schema_version", "created"}
+ROWS = 1  # payload: see _encode_rows
+END = 2  # payload: JSON {"rows", "sha256" of the uncompressed ROWS}
+# ROWS payload: row count, length of the compressed part
+ROWS_HEADER = struct.Struct("!II")
+
+
+class CorruptSnapshot(IOError):
+    pass
+
+
+def _crc(kind, payload):
+    return zlib.crc32(payload, zlib.crc32(chr(kind))) & 0xffffffff
+
+
+def _chunk(kind, payload):
+    return CHUNK.pack(len(payload), _crc(kind, payload), kind) + payload
+
+
+def _columns(row):
+    """Columns as byte strings. Rows from before puts recorded their version
+    have NULL ones, which are stored as the "" a put without a version
+    writes."""
+    return tuple("" if column is None else str(column) for column in row)
+
+
+def _binary(table):
+    """Whether each column of table, key first, is binary"""
+    return [column in BINARY_COLUMNS for column in COLUMNS[table]]
+
+
+def _encode_rows(rows, binary, level):
+    """Stores rows by column: the lengths of all values and the text columns
+    zlib compressed, then the binary columns as they are. Those are
+    ciphertexts, which are random, so compressing them would cost more time
+    than anything else in a snapshot and save nothing.
+
+    Returns:
+        (string, list[string]): payload, uncompressed parts for the SHA-256
+    """
+    columns = zip(*[(key,) + _columns(row) for key, row in rows])
+    lengths = [len(value) for column in columns for value in column]
+    text = struct.pack("!{}I".format(len(lengths)), *lengths) + "".join(
+        "".join(column) for column, is_binary in zip(columns, binary)
+        if not is_binary)
+    data = "".join("".join(column) for column, is_binary
+                   in zip(columns, binary) if is_binary)
+    compressed = zlib.compress(text, level)
+    return (ROWS_HEADER.pack(len(rows), len(compressed)) + compressed + data,
+            [text, data])
+
+
+def _decode_rows(payload, binary):
+    """Returns ([(key, row)], uncompressed parts) of a ROWS payload"""
+    count, compressed = ROWS_HEADER.unpack_from(payload)
+    text = zlib.decompress(
+        payload[ROWS_HEADER.size:ROWS_HEADER.size + compressed])
+    data = payload[ROWS_HEADER.size + compressed:]
+    lengths = struct.unpack_from("!{}I".format(count * len(binary)), text)
+    offsets = {False: 4 * len(lengths), True: 0}
+    columns = []
+    for i, is_binary in enumerate(binary):
+        source = data if is_binary else text
+        offset = offsets[is_binary]
+        column = []
+        for length in lengths[i * count:(i + 1) * count]:
+            column.append(source[offset:offset + length])
+            offset += length
+        offsets[is_binary] = offset
+        columns.append(column)
+    return [(row[0], row[1:]) for row in zip(*columns)], [text, data]
+
+
+def write_snapshot(rows, table, filename, chunk_rows=1000, level=1):
+    """Writes rows to filename as a snapshot: a manifest, chunks of
+    chunk_rows rows (see _encode_rows), then the row count and a SHA-256 of
+    all of them. Each chunk has a CRC32 too, so corruption is found where
+    it is. The file is written under another name and renamed once synced,
+    so a snapshot is never partial.
+
+    Args:
+        rows (iterable[(string, tuple[string])]): (key, row)
+        table (string)
+        filename (string)
+
+    Returns:
+        int: rows written
+    """
+    binary = _binary(table)
+    writing = filename + ".writing"
+    digest = hashlib.sha256()
+    count = 0
+    try:
+        with open(writing, "wb") as f:
+            f.write(MAGIC)
+            f.write(_chunk(MANIFEST, json.dumps({
+                "table": table, "schema_version": SCHEMA_VERSION,
+                "created": datetime.now().isoformat()})))
+            rows = iter(rows)
+            while True:
+                chunk = list(islice(rows, chunk_rows))
+                if not chunk:
+                    break
+                payload, parts = _encode_rows(chunk, binary, level)
+                f.write(_chunk(ROWS, payload))
+                for part in parts:
+                    digest.update(part)
+                count += len(chunk)
+            f.write(_chunk(END, json.dumps(
+                {"rows": count, "sha256": digest.hexdigest()})))
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(writing):
+            os.remove(writing)
+        raise
+    os.rename(writing, filename)
+    return count
+
+
+def create_snapshot(db_filename, table, filename, engine=None):
+    """Snapshots a replica's store while the replica keeps serving: the
+    store is read in a transaction of its own (see SecretsStore.snapshot),
+    from this process. A replica loaded from the snapshot gets the puts
+    made since from its peers by catch-up and anti-entropy.
+
+    Returns:
+        int: rows written
+    """
+    store = STORAGE_ENGINES[engine or CONSTANTS.STORAGE_ENGINE](
+        db_filename, table)
+    return write_snapshot(store.snapshot(), table, filename)
+
+
+class Snapshot(object):
+    def __init__(self, filename):
+        """Snapshot file written by write_snapshot. Reads its manifest.
+
+        Args:
+            filename (string)
+        """
+        self._filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise CorruptSnapshot("{} is not a snapshot".format(filename))
+            kind, payload = self._read_chunk(f)
+        if kind != MANIFEST:
+            raise CorruptSnapshot("{} has no manifest".format(filename))
+        manifest = json.loads(payload)
+        self.table = str(manifest["table"])
+        self.schema_version = manifest["schema_version"]
+        self.created = manifest["created"]
+
+    def _read_chunk(self, f):
+        """Returns (kind, payload) of the chunk at f's position"""
+        offset = f.tell()
+        header = f.read(CHUNK.size)
+        if len(header) < CHUNK.size:
+            raise CorruptSnapshot("{} ends at offset {} without its row "
+                                  "count".format(self._filename, offset))
+        length, crc, kind = CHUNK.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or _crc(kind, payload) != crc:
+            raise CorruptSnapshot("Corrupt chunk in {} at offset {}".format(
+                self._filename, offset))
+        return kind, payload
+
+    def rows(self):
+        """Yields (key, row) in key order. Raises CorruptSnapshot after the
+        rows read so far if a chunk is corrupt, or the rows don't add up to
+        the row count and SHA-256 at the end, so whatever was loaded from
+        them has to be thrown away.
+        """
+        if self.schema_version != SCHEMA_VERSION:
+            raise ValueError("{} has schema version {}, not {}".format(
+                self._filename, self.schema_version, SCHEMA_VERSION))
+        binary = _binary(self.table)
+        digest = hashlib.sha256()
+        count = 0
+        with open(self._filename, "rb") as f:
+            f.seek(len(MAGIC))
+            self._read_chunk(f)
+            while True:
+                kind, payload = self._read_chunk(f)
+                if kind == END:
+                    break
+                rows, parts = _decode_rows(payload, binary)
+                for part in parts:
+                    digest.update(part)
+                count += len(rows)
+                for key_row in rows:
+                    yield key_row
+        end = json.loads(payload)
+        if end["rows"] != count or end["sha256"] != digest.hexdigest():
+            raise CorruptSnapshot(
+                "{} has {} rows, SHA-256 {}; its end says {} rows, {}".format(
+                    self._filename, count, digest.hexdigest(), end["rows"],
+                    end["sha256"]))
+
+
+def is_snapshot(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def export_csv(rows, table, filename):
+    """Writes rows as CSV: a header of the table's column names, then a line
+    per row with the binary columns base64 encoded.
+
+    Returns:
+        int: rows written
+    """
+    columns = COLUMNS[table]
+    binary = _binary(table)[1:]
+    count = 0
+    with open(filename, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for key, row in rows:
+            writer.writerow([key] + [
+                base64.b64encode(column) if encode else column
+                for column, encode in zip(_columns(row), binary)])
+            count += 1
+    return count
+
+
+def csv_table(filename):
+    """Returns the table whose columns are the header of a CSV export"""
+    with open(filename, "rb") as f:
+        header = next(csv.reader(f), None)
+    for table, columns in COLUMNS.iteritems():
+        if header == columns:
+            return table
+    raise ValueError("{} doesn't have the columns of a table: {}".format(
+        filename, header))
+
+
+def csv_rows(filename):
+    """Yields (key, row) of a CSV export, in file order"""
+    table = csv_table(filename)
+    columns = COLUMNS[table]
+    binary = _binary(table)[1:]
+    with open(filename, "rb") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for line in reader:
+            if len(line) != len(columns):
+                raise ValueError("{} line {}: {} columns, not {}".format(
+                    filename, reader.line_num, len(line), len(columns)))
+            yield line[0], tuple(
+                base64.b64decode(column) if decode else column
+                for column, decode in zip(line[1:], binary))
+
+
+def load(filename, db_filename, engine=None, batch_rows=100000):
+    """Bootstraps a store from a snapshot or CSV export with
+    SecretsStore.bulk_load.
+
+    Returns:
+        (string, int): table and rows loaded
+    """
+    if is_snapshot(filename):
+        snapshot = Snapshot(filename)
+        table, rows = snapshot.table, snapshot.rows()
+    else:
+        table, rows = csv_table(filename), csv_rows(filename)
+    store_class = STORAGE_ENGINES[engine or CONSTANTS.STORAGE_ENGINE]
+    return table, store_class.bulk_load(db_filename, table, rows, batch_rows)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Creates, snapshots and bulk loads secrets databases.")
+    parser.add_argument("--engine", choices=sorted(STORAGE_ENGINES),
+                        default=CONSTANTS.STORAGE_ENGINE)
+    subparsers = parser.add_subparsers(dest="command")
+    init_parser = subparsers.add_parser(
+        "init", help="create empty databases, e.g. databases/secrets{0..6}db")
+    init_parser.add_argument("databases", nargs="+")
+    init_parser.add_argument("--table", choices=sorted(COLUMNS),
+                             default="secrets")
+    create_parser = subparsers.add_parser(
+        "create", help="snapshot a database, also while it is serving")
+    create_parser.add_argument("database")
+    create_parser.add_argument("snapshot")
+    create_parser.add_argument("--table", choices=sorted(COLUMNS),
+                               default="secrets")
+    verify_parser = subparsers.add_parser(
+        "verify", help="check a snapshot's checksums")
+    verify_parser.add_argument("snapshot")
+    export_parser = subparsers.add_parser(
+        "export", help="write a database or snapshot as CSV")
+    export_parser.add_argument("source", help="database or snapshot")
+    export_parser.add_argument("csv")
+    export_parser.add_argument("--table", choices=sorted(COLUMNS),
+                               default="secrets")
+    load_parser = subparsers.add_parser(
+        "load", help="create a database from a snapshot or CSV export")
+    load_parser.add_argument("source", help="snapshot or CSV export")
+    load_parser.add_argument("database", help="must not exist yet")
+    load_parser.add_argument("--batch-rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == "init":
+        for filename in args.databases:
+            STORAGE_ENGINES[args.engine](filename, args.table).commit()
+            print "{}: empty {} table".format(filename, args.table)
+    elif args.command == "create":
+        count = create_snapshot(
+            args.database, args.table, args.snapshot, args.engine)
+        print "{}: {} rows, {:.1f} MB in {:.1f}s".format(
+            args.snapshot, count, os.path.getsize(args.snapshot) / 2.0 ** 20,
+            time.time() - start)
+    elif args.command == "verify":
+        count = sum(1 for _ in Snapshot(args.snapshot).rows())
+        print "{}: {} rows, checksums match".format(args.snapshot, count)
+    elif args.command == "export":
+        if os.path.exists(args.source) and is_snapshot(args.source):
+            snapshot = Snapshot(args.source)
+            table, rows = snapshot.table, snapshot.rows()
+        else:
+            table = args.table
+            rows = STORAGE_ENGINES[args.engine](
+                args.source, table).snapshot()
+        count = export_csv(rows, table, args.csv)
+        print "{}: {} rows in {:.1f}s".format(
+            args.csv, count, time.time() - start)
+    else:
+        table, count = load(
+            args.source, args.database, args.engine, args.batch_rows)
+        print "{}: {} {} rows in {:.1f}s".format(
+            args.database, count, table, time.time() - start)
@@ -1,5 +1,12 @@
 import abc
-
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from message import AntiEntropyRequestMessage
+from message import AntiEntropyResponseMessage
+from message import CatchUpRequestMessage
+from message import CatchUpResponseMessage
 from message import DecryptionShareMessage
 from message import GetMessage
 from message import PutMessage
@@ -8,12 +15,13 @@ from message import PutCompleteMessage
 from message import GetResponseMessage
 from message import LoginRequest
 from message import LoginResponse
+from message import LoginConfirm
 from message import EnrollRequest
 from message import EnrollResponse
 from lamedb import LameSecretsDB
-from pake2plus.pake2plus import SPAKE2PLUS_B
 from pake2plus.pake2plus import password_to_secret_B
 from pake2plus.util import number_to_bytes, bytes_to_number
+from utils import CONSTANTS
 
 
 class StateMachine(object):
@@ -31,7 +39,9 @@ class ClientPutStateMachine(object):
         self._enroll_request = enroll_request
 
         # Generate Serverside Pake2+ secret
-        pi_0, c = password_to_secret_B(enroll_request.password.encode('utf-8'))
+        pi_0, c = password_to_secret_B(
+            enroll_request.password.encode('utf-8'),
+            kdf=CONSTANTS.PASSWORD_KDF, cache=server.secret_cache)
 
         pi_0_str = str(number_to_bytes(pi_0, 2 ** (256) - 1))
         pi_0_str += c
@@ -40,7 +50,19 @@ class ClientPutStateMachine(object):
             enroll_request.username, pi_0_str, server.id, server.signature_service, timestamp=enroll_request.timestamp)
         server.messaging_service.broadcast(put)
         self._sent = False
+        self._shares = {}  # sender_id -> threshold signature share
+        self._certificate = None
+
+    def _quorum_reached(self, message):
+        threshold_signature_service = self._server.threshold_signature_service
+        if threshold_signature_service is None:
+            return len(self._responses) >= self._server.f + 1
 
+        if message.share is not None:
+            self._shares[message.sender_id] = message.share
+        self._certificate = threshold_signature_service.certify(
+            message.certificate_data, self._shares)
+        return self._certificate is not None
 
     def handle_message(self, message):
         assert isinstance(message, PutCompleteMessage)
@@ -48,13 +70,24 @@ class ClientPutStateMachine(object):
         if message.sender_id not in self._responses:
             self._responses.append(message.sender_id)
 
-            if not self._sent and len(self._responses) >= self._server.f + 1:
+            if not self._sent and self._quorum_reached(message):
                 enroll_response = EnrollResponse(
                     self._enroll_request.username,
                     self._enroll_request.timestamp)
                 self._server.messaging_service.send(
                         enroll_response, self._enroll_request.user_id)
                 self._sent = True
+                self._server.finish_request(self._enroll_request)
+
+    @property
+    def done(self):
+        """True once no more PutCompleteMessages are needed"""
+        return self._sent
+
+    @property
+    def certificate(self):
+        """f + 1 servers' combined signature on the completed put, or None."""
+        return self._certificate
 
 
 class ClientGetStateMachine(object):
@@ -67,33 +100,93 @@ class ClientGetStateMachine(object):
             timestamp=login_request.timestamp)
         server.messaging_service.broadcast(get)
         self._sent = False
+        self._pake = None
+        self._confirmed = None  # True / False once the user's MAC arrives
+        # Shares grouped by the statement they sign, so only servers that
+        # returned the same secret are combined
+        self._shares = {}  # certificate_data -> {sender_id: share}
+        self._certificate = None
+
+    def _quorum_secret(self, message):
+        """Returns the secret once f + 1 servers agree on it, else None."""
+        threshold_signature_service = self._server.threshold_signature_service
+        if threshold_signature_service is None:
+            # TODO: Check f + 1 SAME
+            if len(self._responses) >= self._server.f + 1:
+                return self._responses.values()[0].secret
+            return None
+
+        shares = self._shares.setdefault(message.certificate_data, {})
+        if message.share is not None:
+            shares[message.sender_id] = message.share
+        self._certificate = threshold_signature_service.certify(
+            message.certificate_data, shares)
+        if self._certificate is None:
+            return None
+        return message.secret
 
     def handle_message(self, message):
+        if isinstance(message, LoginConfirm):
+            self._handle_login_confirm(message)
+            return
+
         assert isinstance(message, GetResponseMessage)
 
         if message.sender_id not in self._responses:
             self._responses[message.sender_id] = message
 
-
-            # TODO: Check f + 1 SAME
-            if not self._sent and len(self._responses) >= self._server.f + 1:
-                # TODO: do PAKE
-                pi_0_str = self._responses.values()[0].secret
+            if self._sent:
+                return
+            pi_0_str = self._quorum_secret(message)
+            if pi_0_str == "":
+                # No such user
+                self._send_login_response(None, None)
+                self._sent = True
+            elif pi_0_str is not None:
                 pi_0 = bytes_to_number(pi_0_str[:32])
                 c = pi_0_str[32:]
-                encrypted = "lol" # to check if keys are correct
-
-                SB = SPAKE2PLUS_B((pi_0, c))
-                v = SB.start()
 
-                key = SB.finish(self._login_request.u)
-                login_response = LoginResponse(
-                    self._login_request.username, v,
-                    encrypted, self._login_request.timestamp)
-                self._server.messaging_service.send(
-                        login_response, self._login_request.user_id)
+                self._server.pake_service.respond(
+                    (pi_0, c), self._login_request.u, self._send_login_response)
                 self._sent = True
 
+    def _send_login_response(self, v, pake):
+        if pake is None:
+            # Unknown user, or the user's SPAKE2+ message was invalid
+            login_response = LoginResponse.failure(
+                self._login_request.username, self._login_request.timestamp)
+        else:
+            self._pake = pake
+            login_response = LoginResponse(
+                self._login_request.username, v,
+                pake.confirmation(), self._login_request.timestamp)
+        self._server.messaging_service.send(
+                login_response, self._login_request.user_id)
+        if pake is None:
+            self._server.finish_request(self._login_request)
+
+    def _handle_login_confirm(self, message):
+        if self._pake is None or self._confirmed is not None:
+            return
+        self._confirmed = self._pake.verify_confirmation(message.confirmation)
+        if not self._confirmed:
+            print "Failed login for {}".format(self._login_request.username)
+        self._server.finish_request(self._login_request)
+
+    @property
+    def confirmed(self):
+        return self._confirmed
+
+    @property
+    def done(self):
+        """True once no more GetResponseMessages are needed"""
+        return self._sent
+
+    @property
+    def certificate(self):
+        """f + 1 servers' combined signature on the secret, or None."""
+        return self._certificate
+
 
 class LameClientPutStateMachine(object):
     def __init__(self, enroll_request, server):
@@ -102,18 +195,24 @@ class LameClientPutStateMachine(object):
         self._enroll_request = enroll_request
 
         # Generate Serverside Pake2+ secret
-        pi_0, c = password_to_secret_B(enroll_request.password.encode('utf-8'))
+        pi_0, c = password_to_secret_B(
+            enroll_request.password.encode('utf-8'),
+            kdf=CONSTANTS.PASSWORD_KDF, cache=server.secret_cache)
 
         pi_0_str = str(number_to_bytes(pi_0, 2 ** (256) - 1))
         pi_0_str += c
 
-        server.datastore.put(enroll_request.username, pi_0_str)
+        # Only answer once the secret is durable
+        server.datastore.put(
+            enroll_request.username, pi_0_str, self._send_enroll_response)
 
+    def _send_enroll_response(self, error=None):
         enroll_response = EnrollResponse(
             self._enroll_request.username,
-            self._enroll_request.timestamp)
+            self._enroll_request.timestamp, failed=error is not None)
         self._server.messaging_service.send(
             enroll_response, self._enroll_request.user_id)
+        self._server.finish_request(self._enroll_request)
 
     def handle_message(self, message):
         raise NotImplementedError
@@ -125,25 +224,50 @@ class LameClientGetStateMachine(object):
         self._server = server
         self._login_request = login_request
 
-        value = server.datastore.get(login_request.username)
+        self._pake = None
+        self._confirmed = None
+        server.datastore.get(login_request.username, self._respond)
 
+    def _respond(self, value):
+        """Runs when the datastore read completes"""
+        if isinstance(value, Exception):
+            # Unknown user, or the read failed
+            self._send_login_response(None, None)
+            return
         pi_0_str = value
         pi_0 = bytes_to_number(pi_0_str[:32])
         c = pi_0_str[32:]
-        encrypted = "lol"  # to check if keys are correct
 
-        SB = SPAKE2PLUS_B((pi_0, c))
-        v = SB.start()
-
-        key = SB.finish(self._login_request.u)
-        login_response = LoginResponse(
-            self._login_request.username, v,
-            encrypted, self._login_request.timestamp)
+        self._server.pake_service.respond(
+            (pi_0, c), self._login_request.u, self._send_login_response)
+
+    def _send_login_response(self, v, pake):
+        if pake is None:
+            # Unknown user, or the user's SPAKE2+ message was invalid
+            login_response = LoginResponse.failure(
+                self._login_request.username, self._login_request.timestamp)
+        else:
+            self._pake = pake
+            login_response = LoginResponse(
+                self._login_request.username, v,
+                pake.confirmation(), self._login_request.timestamp)
         self._server.messaging_service.send(
             login_response, self._login_request.user_id)
+        if pake is None:
+            self._server.finish_request(self._login_request)
 
     def handle_message(self, message):
-        raise NotImplementedError
+        assert isinstance(message, LoginConfirm)
+        if self._pake is None or self._confirmed is not None:
+            return
+        self._confirmed = self._pake.verify_confirmation(message.confirmation)
+        if not self._confirmed:
+            print "Failed login for {}".format(self._login_request.username)
+        self._server.finish_request(self._login_request)
+
+    @property
+    def confirmed(self):
+        return self._confirmed
 
 
 class PutStateMachine(object):
@@ -165,32 +289,42 @@ class PutStateMachine(object):
         self._sent_response = False
 
     def _broadcast_put_accept(self):
-        put_accept_msg = PutAcceptMessage(
-            self._client_msg,
-            self._server.id,
-            self._server.signature_service
-        )
-        self._server.messaging_service.broadcast(put_accept_msg)
+        put_accept_msg = PutAcceptMessage(self._client_msg, self._server.id)
+        self._server.replica_authenticator.sign_later(
+            put_accept_msg, self._server.messaging_service.broadcast)
 
     def _enough_accepts(self):
         return len(self._acceptances) >= (2 * self._server.f + 1)
 
     def _store_secret(self):
+        """Sends the PutCompleteMessage once the secret is durable"""
         encrypted = self._server.threshold_encryption_service.encrypt(
             self._client_msg.secret
         )
-        self._server.secrets_db.put(self._client_msg.key, encrypted)
-
-    def _send_put_complete(self):
+        self._server.secrets_db.put(
+            self._client_msg.key, encrypted, self._send_put_complete,
+            client_id=self._client_msg.client_id,
+            timestamp=self._client_msg.timestamp)
+
+    def _send_put_complete(self, error=None):
+        if error is not None:
+            # Not durable, so not acknowledged: the client hears from the
+            # other servers. Completed so the write-ahead log can let go of it.
+            self._server.complete_transaction(self._client_msg)
+            return
         put_complete_msg = PutCompleteMessage(
             self._client_msg,
             self._server.id,
-            self._server.signature_service
-        )
-        self._server.messaging_service.send(
-            put_complete_msg,
-            self._client_msg.client_id
+            threshold_signature_service=self._server.threshold_signature_service
         )
+        self._server.signature_service.sign_later(
+            put_complete_msg, self._send_to_client)
+
+    def _send_to_client(self, msg):
+        """Runs once msg is signed. Until it is sent, recovery replays the
+        transaction."""
+        self._server.messaging_service.send(msg, self._client_msg.client_id)
+        self._server.complete_transaction(self._client_msg)
 
     def handle_message(self, message):
         assert type(message) is PutMessage or type(message) is PutAcceptMessage
@@ -208,7 +342,6 @@ class PutStateMachine(object):
 
             if not self._sent_response and self._enough_accepts():
                 self._store_secret()
-                self._send_put_complete()
                 self._sent_response = True
 
             # TODO Send ACK
@@ -232,115 +365,540 @@ class GetStateMachine(object):
         self._server = server
         self._heard_servers = []  # List of server_ids heard from
         self._decryption_shares = []  # List of decryption_shares
+        self._encrypted = None  # Set once the secrets db read completes
         self._sent_response = False
 
-    def _broadcast_decryption_share(self):
-        self._encrypted = self._server.secrets_db.get(self._client_msg.key)
+    def _broadcast_decryption_share(self, encrypted):
+        """Runs when the secrets db read completes"""
+        if isinstance(encrypted, KeyError):
+            self._send_response_message("")
+            self._sent_response = True
+            return
+        if isinstance(encrypted, Exception):
+            # The other servers answer
+            self._server.complete_transaction(self._client_msg)
+            return
+        self._encrypted = encrypted
         self._decryption_share = self._server.threshold_encryption_service.decrypt(
             self._encrypted
         )
         decryption_share_msg = DecryptionShareMessage(
             self._decryption_share,
             self._server.id,
-            self._client_msg,
-            self._server.signature_service
+            self._client_msg
         )
-        self._server.messaging_service.broadcast(decryption_share_msg)
+        self._server.replica_authenticator.sign_later(
+            decryption_share_msg, self._server.messaging_service.broadcast)
+
+        # Add own share to share list
+        self._decryption_shares.append(self._decryption_share)
+        self._heard_servers.append(self._server.id)
+        self._maybe_send_response()
 
     def _enough_shares(self):
         return len(self._decryption_shares) >= (2 * self._server.f + 1)
 
-    def _send_response_message(self):
-        secret = self._server.threshold_encryption_service.combine_shares(
-            self._encrypted,
-            self._decryption_shares,
-            self._heard_servers
-        )
-
+    def _maybe_send_response(self):
+        # Other servers' shares can arrive before our own read completes
+        if (not self._sent_response and self._encrypted is not None and
+                self._enough_shares()):
+            self._send_response_message(
+                self._server.threshold_encryption_service.combine_shares(
+                    self._encrypted,
+                    self._decryption_shares,
+                    self._heard_servers
+                ))
+            self._sent_response = True
+            # TODO Cleanup
+
+    def _send_response_message(self, secret):
+        """Sends the client the secret, or "" if there is none under the
+        key"""
         response_message = GetResponseMessage(
             self._client_msg,
             secret,
             self._server.id,
-            self._server.signature_service
+            threshold_signature_service=self._server.threshold_signature_service
         )
 
-        self._server.messaging_service.send(
-            response_message,
-            self._client_msg.client_id
-        )
+        self._server.signature_service.sign_later(
+            response_message, self._send_to_client)
+
+    def _send_to_client(self, msg):
+        """Runs once msg is signed. Until it is sent, recovery replays the
+        transaction."""
+        self._server.messaging_service.send(msg, self._client_msg.client_id)
+        self._server.complete_transaction(self._client_msg)
 
     def handle_message(self, message):
         assert (type(message) is GetMessage or
                 type(message) is DecryptionShareMessage)
 
         if not self._sent_share:
-            self._broadcast_decryption_share()
+            self._server.secrets_db.get(
+                self._client_msg.key, self._broadcast_decryption_share)
             self._sent_share = True
 
-            # Add own share to share list
-            self._decryption_shares.append(self._decryption_share)
-            self._heard_servers.append(self._server.id)
-
         if isinstance(message, DecryptionShareMessage):
             if message.sender_id not in self._heard_servers:
                 self._decryption_shares.append(message.decryption_share)
                 self._heard_servers.append(message.sender_id)
-
-                if not self._sent_response and self._enough_shares():
-                    self._send_response_message()
-                    self._sent_response = True
-                    # TODO Cleanup
+                self._maybe_send_response()
                 # TODO Ack message
 
 
+def _unless_failed(callback):
+    """Wraps a DBExecutor callback to skip failed operations, which the db
+    thread has logged"""
+    def wrapped(result):
+        if not isinstance(result, Exception):
+            callback(result)
+    return wrapped
+
+
+def _rewind(timestamp, seconds):
+    """Returns the ISO 8601 timestamp seconds earlier, or "" (before any
+    timestamp) if it can't be parsed"""
+    for timestamp_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            parsed = datetime.strptime(timestamp, timestamp_format)
+        except ValueError:
+            continue
+        return (parsed - timedelta(seconds=seconds)).isoformat()
+    return ""
+
+
+class _VersionQuorum(object):
+    def __init__(self, quorum):
+        """Counts the servers that sent each version of a key in catch-up
+        and anti-entropy entries. A faulty server could make up puts, or
+        replace secrets with a future timestamp, so an entry is only stored
+        once quorum servers sent the same version, (key, client_id,
+        timestamp). The rows themselves differ between servers, which each
+        encrypt a secret with their own randomness, so the first one sent is
+        stored.
+
+        Args:
+            quorum (int): f + 1, so that a correct server is among them
+        """
+        self._quorum = quorum
+        self._votes = {}  # version -> [sender ids, row until agreed]
+
+    def add(self, sender_id, entries, voters):
+        """Counts sender_id's entries and returns those that reached the
+        quorum with them.
+
+        Args:
+            sender_id (int)
+            entries (list[(key, row)]): rows end with the client_id and
+                timestamp of their put
+            voters (int): servers that will send entries; a version is
+                forgotten once they all have
+        """
+        agreed = []
+        for key, row in entries:
+            version = (key, row[-2], row[-1])
+            senders, stored = self._votes.setdefault(version, [set(), row])
+            if sender_id in senders:
+                continue
+            senders.add(sender_id)
+            if stored is not None and len(senders) >= self._quorum:
+                agreed.append((key, stored))
+                self._votes[version][1] = None
+            if len(senders) >= voters:
+                del self._votes[version]
+        return agreed
+
+
 class CatchupStateMachine(object):
     def __init__(self, server):
-        """State for catching up on messages that haven't been seen before
+        """State for catching up on puts that haven't been seen before, e.g.
+        while the server was down.
+
+        The server sends its latest put timestamp per client to all other
+        servers and pages through the entries of every one that answers. An
+        entry is only stored once f + 1 of them sent the same version of it,
+        see _VersionQuorum. Each server is asked for its next page before
+        the current one is stored, so the other servers read and send pages
+        while this one stores. Pages are bounded by CATCHUP_PAGE_SIZE and
+        served from the timestamp index, so live traffic is not held up
+        behind a transfer on either side.
 
         Args:
             server (Server)
         """
-        self._catching_up = False  # Can False when you hear from 2f + 1
-        self._entries = []
-        self._servers = []
+        self._server = server
+        self._waiting = False  # to start, for peers to connect
+        self._catching_up = False
+        self._asked = []  # servers sent the first page request
+        self._sources = {}  # server id -> True once it sent its last page
+        self._quorum = None  # _VersionQuorum of the entries received
+        self._timestamps = None  # {client_id: timestamp} asked for
+        self._entries = 0
+        self._pages_storing = 0
+        self._start = None
+
+    @property
+    def catching_up(self):
+        return self._catching_up
+
+    @property
+    def waiting(self):
+        """True while catch_up waits for peers to connect"""
+        return self._waiting
 
     def catch_up(self):
-        pass
+        """Catches up once 2f + 1 other servers are connected, so that f + 1
+        correct ones are among them to agree on every entry. Call poll until
+        then."""
+        if self._catching_up:
+            return
+        self._waiting = True
+        self.poll()
+
+    def poll(self):
+        """Starts catching up once enough peers are connected"""
+        if (not self._waiting or
+                len(self._peers()) < 2 * self._server.f + 1):
+            return
+        self._waiting = False
+        self._catching_up = True
+        self._start = time.time()
+        self._asked = []
+        self._sources = {}
+        self._quorum = _VersionQuorum(self._server.f + 1)
+        self._entries = 0
+        self._server.secrets_db.high_water(self._request_first_page)
+
+    def _peers(self):
+        """Other servers with a connection up"""
+        messaging_service = self._server.messaging_service
+        return [uid for uid in xrange(self._server.N)
+                if uid != self._server.id and messaging_service.connected(uid)]
+
+    def _send(self, msg, destinations):
+        """Sends msg from a db or signing callback, where an exception would
+        not reach the caller. Returns the number sent."""
+        sent = 0
+        for destination in destinations:
+            try:
+                self._server.messaging_service.send(msg, destination)
+                sent += 1
+            except Exception:
+                print "Sending {} to {} failed".format(msg, destination)
+                traceback.print_exc()
+        return sent
+
+    def _request_first_page(self, high_water):
+        if isinstance(high_water, Exception):
+            self._catching_up = False
+            return
+        # Puts aren't necessarily stored in timestamp order, so a put a bit
+        # older than the latest stored one may still be missing
+        self._timestamps = dict(
+            (client, _rewind(timestamp, CONSTANTS.CATCHUP_WINDOW))
+            for client, timestamp in high_water.iteritems())
+        request = CatchUpRequestMessage(self._timestamps, self._server.id)
+        self._server.replica_authenticator.sign_later(
+            request, self._broadcast_first_page_request)
+
+    def _broadcast_first_page_request(self, request):
+        self._asked = self._peers()
+        self._asked = [peer for peer in list(self._asked)
+                       if self._send(request, [peer])]
+        if len(self._asked) < 2 * self._server.f + 1:
+            # Try again once peers are back
+            self._catching_up = False
+            self._waiting = True
+
+    def _request_page(self, source, after):
+        request = CatchUpRequestMessage(
+            self._timestamps, self._server.id, after=after)
+        self._server.replica_authenticator.sign_later(
+            request, lambda msg: self._send(msg, [source]))
+
+    def _serve(self, request):
+        self._server.secrets_db.select(
+            request.timestamps, request.after, CONSTANTS.CATCHUP_PAGE_SIZE,
+            _unless_failed(
+                lambda page: self._send_page(request.sender_id, *page)))
+
+    def _send_page(self, destination, entries, position):
+        response = CatchUpResponseMessage(
+            entries, self._server.id, position=position)
+        self._server.replica_authenticator.sign_later(
+            response, lambda msg: self._send(msg, [destination]))
+
+    def _receive(self, response):
+        source = response.sender_id
+        if (not self._catching_up or source not in self._asked or
+                self._sources.get(source)):
+            return
+        self._sources[source] = response.position is None
+        agreed = self._quorum.add(
+            source, response.entries, len(self._asked))
+        if agreed:
+            self._entries += len(agreed)
+            self._pages_storing += 1
+            self._server.secrets_db.apply(agreed, self._page_stored)
+        if response.position is not None:
+            self._request_page(source, response.position)
+        self._maybe_finish()
+
+    def _page_stored(self, error=None):
+        self._pages_storing -= 1
+        if error is not None and self._catching_up:
+            # Ignores the rest of the pages
+            self._catching_up = False
+            print "Catch-up failed"
+        self._maybe_finish()
+
+    def _maybe_finish(self):
+        """Done once every server that answered sent its last page, and at
+        most f of those asked didn't answer"""
+        if (self._catching_up and self._pages_storing == 0 and
+                len(self._sources) >= len(self._asked) - self._server.f and
+                all(self._sources.values())):
+            self._catching_up = False
+            self._quorum = None
+            print "Caught up on {} entries from {} servers in {:.3f}s".format(
+                self._entries, len(self._sources), time.time() - self._start)
 
     def handle_message(self, message):
-        pass
-
-
-if __name__ == '__main__':
-    from stubs import *
-    from pake2plus.util import number_to_bytes, bytes_to_number
-    servers = [StubServer(i) for i in [0, 1, 2, 3, 4, 5]]
+        if isinstance(message, CatchUpRequestMessage):
+            self._serve(message)
+        elif isinstance(message, CatchUpResponseMessage):
+            self._receive(message)
 
-    secret = 4720180751612715235271090812360374322170044808629075413983095821158821133441
-    secret = str(number_to_bytes(secret, 2 ** 256 - 1))
-    secret += secret
 
-    encrypted = servers[0].threshold_encryption_service.encrypt(secret)
-
-    client_msg = PutMessage("brendon", secret, 5, servers[5].signature_service)
-    put_state_machine = PutStateMachine(client_msg, servers[0])
-
-    for i in xrange(1, 6):
-        put_accept_msg = PutAcceptMessage(
-            client_msg, i, servers[i].signature_service
-        )
-        put_state_machine.handle_message(put_accept_msg)
+class AntiEntropyStateMachine(object):
+    HASHES = AntiEntropyRequestMessage.HASHES
+    VERSIONS = AntiEntropyRequestMessage.VERSIONS
+    ENTRIES = AntiEntropyRequestMessage.ENTRIES
 
-    client_msg = GetMessage("brendon", 5, servers[5].signature_service)
+    def __init__(self, server):
+        """Background anti-entropy. Every ANTI_ENTROPY_INTERVAL seconds, it
+        compares this server's secrets with the next other server's and
+        fetches the puts this one is missing or has an older version of. The
+        other server fetches the ones it is missing in its own rounds.
+
+        A round walks down both servers' MerkleTrees from the root, only into
+        nodes whose hashes differ, lists the other server's versions in the
+        differing buckets, and fetches the rows that are newer than the
+        stored ones from every connected server. A row is only stored once
+        f + 1 servers sent the same version of it, see _VersionQuorum. The db thread reads the trees and tables in pages, so a
+        round does not hold up live traffic. The tree is built the same way
+        after startup; until it is done, no rounds are started or answered.
 
-    get_state_machine = GetStateMachine(client_msg, servers[0])
+        Args:
+            server (Server): its secrets_db keeps a MerkleTree
+        """
+        self._server = server
+        self._peer = None  # compared with in the current round
+        self._last_peer = server.id
+        self._round = 0  # ignores the answers of abandoned rounds
+        # The first round waits an interval, for the peers to connect
+        self._round_start = time.time()
+        self._outstanding = 0  # requests and db reads in the round
+        self._quorum = None  # _VersionQuorum of the fetched entries
+        self._entry_peers = None  # servers asked for entries in the round
+        self._buckets = 0
+        self._fetched = 0
+        self._serving = {}  # server id -> buckets it is paging through
+        self._tree_ready = False
+        self._build_tree()
+
+    def _build_tree(self):
+        self._server.secrets_db.run(
+            lambda db: db.build_tree(CONSTANTS.ANTI_ENTROPY_PAGE_ROWS),
+            self._tree_built)
+
+    def _tree_built(self, ready):
+        if isinstance(ready, Exception):
+            return  # Anti-entropy stays off
+        if ready:
+            self._tree_ready = True
+        else:
+            self._build_tree()
+
+    @property
+    def tree_ready(self):
+        return self._tree_ready
+
+    def poll(self):
+        """Starts a round when one is due. Call periodically."""
+        if not self._tree_ready:
+            return
+        now = time.time()
+        if self._peer is not None:
+            if now - self._round_start < CONSTANTS.ANTI_ENTROPY_TIMEOUT:
+                return
+            self._peer = None  # Stopped answering
+        if now - self._round_start >= CONSTANTS.ANTI_ENTROPY_INTERVAL:
+            self.start_round()
+
+    def start_round(self):
+        """Starts a round with the next other server that is connected, if
+        there is one"""
+        self._round_start = time.time()
+        messaging_service = self._server.messaging_service
+        for _ in xrange(self._server.N):
+            self._last_peer = (self._last_peer + 1) % self._server.N
+            if (self._last_peer != self._server.id and
+                    messaging_service.connected(self._last_peer)):
+                break
+        else:
+            return
+        self._peer = self._last_peer
+        self._round += 1
+        self._outstanding = 0
+        self._quorum = _VersionQuorum(self._server.f + 1)
+        self._entry_peers = None
+        self._buckets = 0
+        self._fetched = 0
+        self._request(self.HASHES, [0], level=0)
+
+    @property
+    def in_round(self):
+        return self._peer is not None
+
+    def _request(self, kind, items, level=None, after=None, peer=None):
+        """Asks peer, by default the server compared with"""
+        self._outstanding += 1
+        request = AntiEntropyRequestMessage(
+            kind, items, self._server.id, level=level, after=after)
+        if peer is None:
+            peer = self._peer
+        self._server.replica_authenticator.sign_later(
+            request, lambda msg: self._server.messaging_service.send(
+                msg, peer))
+
+    def _read(self, operation, callback):
+        """Runs operation(db) on the db thread as part of the round"""
+        self._outstanding += 1
+        current_round = self._round
+
+        def done(result):
+            if current_round == self._round and self._peer is not None:
+                if isinstance(result, Exception):
+                    self._peer = None  # Abandons the round
+                    return
+                self._outstanding -= 1
+                callback(result)
+                self._maybe_finish()
+        self._server.secrets_db.run(operation, done)
+
+    def _maybe_finish(self):
+        if self._outstanding > 0:
+            return
+        if self._buckets:
+            print ("Anti-entropy with {}: {} buckets differed, fetched {} "
+                   "entries in {:.3f}s").format(
+                self._peer, self._buckets, self._fetched,
+                time.time() - self._round_start)
+        self._peer = None
+
+    def _respond(self, request, kind, items, level=None, position=None):
+        response = AntiEntropyResponseMessage(
+            kind, items, self._server.id, level=level, position=position)
+        self._server.replica_authenticator.sign_later(
+            response, lambda msg: self._server.messaging_service.send(
+                msg, request.sender_id))
+
+    def _serve(self, request):
+        if not self._tree_ready:
+            return  # The other server's round times out
+        if request.kind == self.HASHES:
+            level, indices = request.level, request.items
+            self._server.secrets_db.run(
+                lambda db: db.tree.hashes(level, indices),
+                _unless_failed(lambda hashes: self._respond(
+                    request, self.HASHES, hashes, level=level)))
+        elif request.kind == self.VERSIONS:
+            if request.items is not None:
+                self._serving[request.sender_id] = set(request.items)
+            buckets = self._serving.get(request.sender_id)
+            if buckets is None:
+                return
+            self._server.secrets_db.run(
+                lambda db: db.bucket_versions(
+                    buckets, request.after, CONSTANTS.ANTI_ENTROPY_PAGE_ROWS),
+                _unless_failed(
+                    lambda page: self._send_versions(request, *page)))
+        elif request.kind == self.ENTRIES:
+            keys = request.items
+            self._server.secrets_db.run(
+                lambda db: db.rows(keys),
+                _unless_failed(
+                    lambda rows: self._respond(request, self.ENTRIES, rows)))
+
+    def _send_versions(self, request, versions, position):
+        if position is None:
+            self._serving.pop(request.sender_id, None)
+        self._respond(request, self.VERSIONS, versions, position=position)
+
+    def _receive(self, response):
+        if self._peer is None:
+            return
+        if response.kind == self.ENTRIES:
+            if response.sender_id not in self._entry_peers:
+                return
+        elif response.sender_id != self._peer:
+            return
+        self._outstanding -= 1
+        if response.kind == self.HASHES:
+            level, theirs = response.level, response.items
+
+            def compare(db):
+                differing = [index for index, node_hash
+                             in sorted(db.tree.hashes(level, theirs).items())
+                             if node_hash != theirs[index]]
+                if level < db.tree.depth:
+                    return differing, db.tree.children(level, differing)
+                return differing, None
+            self._read(compare, lambda result: self._descend(level, *result))
+        elif response.kind == self.VERSIONS:
+            if response.position is not None:
+                self._request(self.VERSIONS, None, after=response.position)
+            theirs = response.items
+            self._read(
+                lambda db: db.versions([key for key, _, _ in theirs]),
+                lambda mine: self._fetch_newer(theirs, mine))
+        elif response.kind == self.ENTRIES:
+            agreed = self._quorum.add(
+                response.sender_id, response.items, len(self._entry_peers))
+            if agreed:
+                self._fetched += len(agreed)
+                self._read(lambda db: db.apply(agreed), lambda _: None)
+        self._maybe_finish()
+
+    def _descend(self, level, differing, children):
+        if not differing:
+            return
+        if children is not None:
+            self._request(self.HASHES, children, level=level + 1)
+        else:
+            self._buckets = len(differing)
+            self._request(self.VERSIONS, differing)
+
+    def _fetch_newer(self, theirs, mine):
+        newer = [key for key, _, timestamp in theirs
+                 if timestamp > mine.get(key, ("", ""))[1]]
+        if self._entry_peers is None:
+            messaging_service = self._server.messaging_service
+            self._entry_peers = [self._peer] + [
+                uid for uid in xrange(self._server.N)
+                if uid not in (self._server.id, self._peer) and
+                messaging_service.connected(uid)]
+        for start in xrange(0, len(newer), CONSTANTS.CATCHUP_PAGE_SIZE):
+            for peer in self._entry_peers:
+                self._request(
+                    self.ENTRIES,
+                    newer[start:start + CONSTANTS.CATCHUP_PAGE_SIZE],
+                    peer=peer)
 
-    for i in xrange(6):
-        decryption_share = servers[i].threshold_encryption_service.decrypt(encrypted)
-        decryption_share_msg = DecryptionShareMessage(
-            decryption_share,
-            servers[i].id,
-            client_msg,
-            servers[i].signature_service
-        )
-        get_state_machine.handle_message(decryption_share_msg)
+    def handle_message(self, message):
+        if isinstance(message, AntiEntropyRequestMessage):
+            self._serve(message)
+        elif isinstance(message, AntiEntropyResponseMessage):
+            self._receive(message)
@@ -1,6 +1,7 @@
 from signature_service import SignatureService
 from threshold_encryption_service import ThresholdEncryptionService
 from secrets_db import SecretsDB
+from db_executor import DBExecutor
 
 
 class StubServer(object):
@@ -8,7 +9,8 @@ class StubServer(object):
         self._id = uid
         self._threshold = ThresholdEncryptionService('thenc8_2.keys', uid)
         self._signature_service = SignatureService(uid)
-        self._secrets_db = SecretsDB('databases/secrets' + str(uid) + 'db')
+        self._secrets_db = DBExecutor(
+            lambda: SecretsDB('databases/secrets' + str(uid) + 'db'))
 
     @property
     def id(self):
@@ -34,10 +36,21 @@ class StubServer(object):
     def signature_service(self):
         return self._signature_service
 
+    @property
+    def threshold_signature_service(self):
+        pass
+
+    @property
+    def replica_authenticator(self):
+        return self._signature_service
+
     @property
     def write_ahead_log(self):
         pass
 
+    def complete_transaction(self, client_msg):
+        pass
+
     @property
     def secrets_db(self):
         return self._secrets_db
@@ -62,6 +75,10 @@ class StubSignatureService(object):
     def validate(self, msg, sender, signature):
         return True
 
+    def sign_later(self, message, callback):
+        message.set_signature(self)
+        callback(message)
+
 
 class StubThresholdEncryptionService():
     def encrypt(self, msg):
@@ -0,0 +1,92 @@
+# From HoneyBadgerBFT (commoncoin/boldyreva.py)
+
+import pickle
+import random
+from charm.toolbox.pairinggroup import ZR, G1, pair
+from tpke import group, g2, ONE, serialize, deserialize0, deserialize1
+
+# Threshold BLS signatures (Boldyreva). Any k of the l signature shares on the
+# same message combine into one signature that verifies under the single
+# group verification key VK, with one pairing check.
+
+# Dependencies: Charm, http://jhuisi.github.io/charm/
+#         a wrapper for PBC (Pairing based crypto)
+
+
+def initiateThresholdSig(contents_file):
+    contents = open(contents_file, 'r').read()
+    (l, k, sVK, sVKs, SKs) = pickle.loads(contents)
+    sigPK, sigSKs = TBLSPublicKey(l, k, deserialize1(sVK), [deserialize1(sVKp) for sVKp in sVKs]), \
+           [TBLSPrivateKey(l, k, deserialize1(sVK), [deserialize1(sVKp) for sVKp in sVKs], \
+                           deserialize0(SKp[1]), SKp[0]) for SKp in SKs]
+    return (sigPK, sigSKs)
+
+
+class TBLSPublicKey(object):
+    def __init__(self, l, k, VK, VKs):
+        self.l = l
+        self.k = k
+        self.VK = VK
+        self.VKs = VKs
+
+    def lagrange(self, S, j):
+        # Assert S is a subset of range(0,self.l)
+        assert len(S) == self.k
+        assert type(S) is set
+        assert S.issubset(range(0,self.l))
+        S = sorted(S)
+
+        assert j in S
+        assert 0 <= j < self.l
+        mul = lambda a,b: a*b
+        num = reduce(mul, [0 - jj - 1 for jj in S if jj != j], ONE)
+        den = reduce(mul, [j - jj     for jj in S if jj != j], ONE)
+        return num / den
+
+    def hash_message(self, m):
+        return group.hash(m, G1)
+
+    def verify_share(self, sig, i, h):
+        assert 0 <= i < self.l
+        B = self.VKs[i]
+        return pair(sig, g2) == pair(h, B)
+
+    def verify_signature(self, sig, h):
+        return pair(sig, g2) == pair(h, self.VK)
+
+    def combine_shares(self, sigs):
+        # sigs: a mapping from idx -> sig
+        S = set(sigs.keys())
+        assert S.issubset(range(self.l))
+
+        mul = lambda a,b: a*b
+        res = reduce(mul,
+                     [sig ** self.lagrange(S, j)
+                      for j,sig in sigs.iteritems()], ONE)
+        return res
+
+
+class TBLSPrivateKey(TBLSPublicKey):
+    def __init__(self, l, k, VK, VKs, SK, i):
+        super(TBLSPrivateKey,self).__init__(l, k, VK, VKs)
+        assert 0 <= i < self.l
+        self.i = i
+        self.SK = SK
+
+    def sign(self, h):
+        return h ** self.SK
+
+
+if __name__ == '__main__':
+    sigPK, sigSKs = initiateThresholdSig('thsig8_2.keys')
+    h = sigPK.hash_message("hello world")
+    sigs = [sk.sign(h) for sk in sigSKs]
+    for i, sig in enumerate(sigs):
+        assert sigPK.verify_share(sig, i, h)
+
+    SS = range(sigPK.l)
+    random.shuffle(SS)
+    S = set(SS[:sigPK.k])
+    combined = sigPK.combine_shares(dict((s, sigs[s]) for s in S))
+    assert sigPK.verify_signature(combined, h)
+    assert deserialize1(serialize(combined)) == combined
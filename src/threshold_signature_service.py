@@ -0,0 +1,100 @@
+import tbls
+from tpke import serialize, deserialize1
+
+
+class ThresholdSignatureService(object):
+    def __init__(self, keys_file, server_id=None):
+        """
+        Args:
+            keys_file (string): filename of file with threshold signature
+                keys (thsig<N>_<t>.keys from docker/start.sh)
+            server_id (int): id of the server, None for clients, which can
+                only verify
+        """
+        self._server_id = server_id
+        sigPK, sigSKs = tbls.initiateThresholdSig(keys_file)
+        self._public_key = sigPK
+        self._secret_key = None
+        if server_id is not None:
+            self._secret_key = sigSKs[server_id]
+
+    @property
+    def k(self):
+        """Number of shares needed for a certificate."""
+        return self._public_key.k
+
+    def sign_share(self, msg):
+        """Signature share on msg.
+
+        Args:
+            msg (string)
+
+        Returns:
+            string
+        """
+        h = self._public_key.hash_message(msg)
+        return serialize(self._secret_key.sign(h)).encode('base-64')
+
+    @staticmethod
+    def _deserialize(share):
+        """The group element in a share or certificate, or None if it is
+        malformed. charm raises its own Exception subclass for bytes that
+        are not an element."""
+        try:
+            return deserialize1(share.decode('base-64'))
+        except Exception:
+            return None
+
+    def verify_share(self, msg, share, server_id):
+        element = self._deserialize(share)
+        if element is None:
+            return False
+        h = self._public_key.hash_message(msg)
+        return self._public_key.verify_share(element, server_id, h)
+
+    def certify(self, msg, shares):
+        """Combines k shares on msg into a certificate, checked with a single
+        pairing comparison however many servers there are. Shares that do
+        not deserialize are removed from shares and skipped. If the combined
+        signature does not verify, the bad shares are found one by one and
+        removed from shares, and None is returned so the caller can wait for
+        more.
+
+        Args:
+            msg (string)
+            shares ({server_id: share})
+
+        Returns:
+            string or None
+        """
+        if len(shares) < self.k:
+            return None
+        chosen = {}
+        for server_id, share in sorted(shares.items()):
+            if len(chosen) == self.k:
+                break
+            element = self._deserialize(share)
+            if element is None:
+                del shares[server_id]
+            else:
+                chosen[server_id] = element
+        if len(chosen) < self.k:
+            return None
+        certificate = self._public_key.combine_shares(chosen)
+        if self._public_key.verify_signature(
+                certificate, self._public_key.hash_message(msg)):
+            return serialize(certificate).encode('base-64')
+
+        for server_id in chosen:
+            if not self.verify_share(msg, shares[server_id], server_id):
+                del shares[server_id]
+        return None
+
+    def verify_certificate(self, msg, certificate):
+        """Checks a certificate produced by certify, e.g. one forwarded by
+        another client."""
+        element = self._deserialize(certificate)
+        if element is None:
+            return False
+        return self._public_key.verify_signature(
+            element, self._public_key.hash_message(msg))
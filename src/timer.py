@@ -10,7 +10,7 @@ class Timer(object):
         self._calls = []
         self._filename = filename
 
-    def call(self, msg):
+    def call(self, msg, key=None):
         self._num_calls -= 1
         self._calls.append(time.time() - self._start)
         if self._num_calls == 0:
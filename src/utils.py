@@ -1,5 +1,66 @@
+import ast
+
+
 class CONSTANTS(object):
     N = 7
     f = 2
-    SIGNATURE_SERVICE = "rsa"
+    SIGNATURE_SERVICE = "rsa"  # "rsa", "ecdsa", "ed25519" or "none"
+    SIGNATURE_CACHE_SIZE = 0  # 0 disables the verified-signature cache
+    # Seconds to collect outbound replica messages and sign only their Merkle
+    # root, 0 signs every message on its own
+    SIGNATURE_BATCH_WINDOW = 0
+    SIGNATURE_BATCH_SIZE = 64  # flush a batch early at this many messages
+    ECDSA_NONCE_POOL_SIZE = 0  # precomputed ECDSA nonces, 0 disables
+    REPLICA_AUTHENTICATION = "signature"  # or "mac" for HMAC-ed replica links
     LAME_CLIENT = False
+    THRESHOLD_SIGNATURES = False  # certify put/get quorums with threshold BLS
+    PASSWORD_KDF = "hkdf"  # "hkdf" or "slow"
+    # Puts are committed together every DB_COMMIT_INTERVAL seconds or
+    # DB_COMMIT_ROWS puts; 0 commits every put on its own
+    DB_COMMIT_INTERVAL = 0.005
+    DB_COMMIT_ROWS = 64
+    STORAGE_ENGINE = "sqlite"  # "sqlite" or "lmdb"
+    LMDB_MAP_SIZE = 2 ** 34  # address space reserved for an LMDB file
+    # Log verified protocol messages before acting on them, to rebuild
+    # unfinished transactions after a crash
+    WRITE_AHEAD_LOG = False
+    WAL_SEGMENT_BYTES = 64 * 2 ** 20  # rotate to a new log file at this size
+    WAL_SYNC_INTERVAL = 0  # seconds to gather records before each fsync
+    # Recovered transactions replayed per event loop iteration after restart
+    WAL_REPLAY_BATCH = 64
+    # Seconds before a transaction without a quorum is completed in the log,
+    # so that its segment can be truncated
+    TRANSACTION_TIMEOUT = 60
+    CATCH_UP_ON_START = False  # fetch the puts missed while down on startup
+    CATCHUP_PAGE_SIZE = 250  # entries per catch-up response
+    CATCHUP_WINDOW = 1.0  # seconds before the latest stored put to ask from
+    # Seconds between comparing the secrets db with the next other server's
+    # and fetching what it is missing, 0 disables anti-entropy
+    ANTI_ENTROPY_INTERVAL = 0
+    ANTI_ENTROPY_TIMEOUT = 60  # abandon a round after this many seconds
+    ANTI_ENTROPY_PAGE_ROWS = 10000  # rows read per page of bucket versions
+    CIPHERTEXT_CACHE_BYTES = 0  # 0 disables the cache
+    SECRET_CACHE_SIZE = 0  # 0 disables the password -> secret cache
+    PAKE_BATCH_SIZE = 32
+    # Seconds before the application client drops a login or enroll that is
+    # still waiting for the servers or for the user's confirmation
+    REQUEST_TIMEOUT = 30
+
+
+def set_constants(assignments):
+    """Overrides CONSTANTS, e.g. with the --set options a process was
+    launched with.
+
+    Args:
+        assignments (list[string]): "NAME=VALUE", VALUE a Python literal or
+            else a string
+    """
+    for assignment in assignments:
+        name, value = assignment.split("=", 1)
+        if not hasattr(CONSTANTS, name):
+            raise ValueError("Unknown constant: {}".format(name))
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(CONSTANTS, name, value)
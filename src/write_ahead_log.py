@@ -1,26 +1,351 @@
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import traceback
+import zlib
+from collections import OrderedDict
+
+from completion_queue import CompletionQueue
+from message import Message
+
+# Record: payload length, CRC32 of kind + payload, kind, payload
+HEADER = struct.Struct("!IIB")
+MESSAGE = 0  # payload: transaction JSON, newline, message JSON
+COMPLETE = 1  # payload: transaction JSON
+
+
+class CorruptLog(IOError):
+    pass
+
+
+def _crc(kind, payload):
+    return zlib.crc32(payload, zlib.crc32(chr(kind))) & 0xffffffff
+
+
+def encode_record(kind, payload):
+    crc = _crc(kind, payload)
+    return HEADER.pack(len(payload), crc, kind) + payload
+
+
+def read_records(filename):
+    """Yields (kind, payload, end offset) for the valid records of a segment
+    and stops at the first torn or corrupt one."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc, kind = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or _crc(kind, payload) != crc:
+            return
+        offset = start + length
+        yield kind, payload, offset
+
+
 class WriteAheadLog(object):
-    def __init__(self, log_filename):
+    def __init__(self, log_filename, segment_bytes=64 * 2 ** 20,
+                 sync_interval=0):
+        """Append-only log of protocol messages, so that the state machines
+        of unfinished transactions can be rebuilt after a crash.
+
+        The log is a sequence of segment files, log_filename.00000001 and
+        so on, of CRC-checked, length-prefixed records. A background thread
+        writes and fsyncs whatever was logged since its last fsync in one
+        go (group commit), then rotates to a new segment once the current
+        one exceeds segment_bytes. Oldest segments are deleted once every
+        transaction with a record in them is complete. If a write or fsync
+        fails, the callbacks of the records that may not be durable get the
+        error, and so does every later one: nothing more is written.
+
+        Args:
+            log_filename (string): prefix of the segment files
+            segment_bytes (int)
+            sync_interval (float): seconds to wait for more records before
+                each fsync, 0 syncs as soon as the previous fsync is done
         """
+        self._prefix = log_filename
+        self._segment_bytes = segment_bytes
+        self._sync_interval = sync_interval
+        directory = os.path.dirname(log_filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Segment number -> transactions with a record in it that are not
+        # complete. Only the sync thread touches it after recovery.
+        self._segments = OrderedDict()
+        self._recover()
+        self._first_segment = next(iter(self._segments))
+        self._last_segment = next(reversed(self._segments))
+
+        self._cond = threading.Condition()
+        self._pending = []  # (record, kind, transaction, callback)
+        self._logged = 0  # records handed to log / complete
+        self._synced = 0  # of which durable
+        self._syncs = 0
+        self._closed = False
+        self._error = None  # of the write or fsync that stopped the log
+        self._completions = CompletionQueue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _segment_filename(self, number):
+        return "{}.{:08d}".format(self._prefix, number)
+
+    def _recover(self):
+        """Rebuilds the open transactions of each segment and cuts off a
+        torn record at the end of the last segment."""
+        numbers = sorted(int(filename.rsplit(".", 1)[1]) for filename
+                         in glob.glob(self._prefix + ".[0-9]*"))
+        for number in numbers:
+            filename = self._segment_filename(number)
+            self._segments[number] = set()
+            end = 0
+            for kind, payload, end in read_records(filename):
+                self._apply(kind, payload.split("\n", 1)[0])
+            if end != os.path.getsize(filename):
+                if number != numbers[-1]:
+                    raise CorruptLog("Corrupt record in {} at offset {}".format(
+                        filename, end))
+                with open(filename, "r+b") as f:
+                    f.truncate(end)
+
+        if not numbers:
+            self._segments[1] = set()
+        self._file = open(self._segment_filename(
+            next(reversed(self._segments))), "ab")
+
+    def _apply(self, kind, transaction):
+        """Updates the open transactions for a record in the last segment.
+
         Args:
-            logfile (string): filename of log
+            kind (int): MESSAGE or COMPLETE
+            transaction (string): JSON
         """
-        pass
+        if kind == MESSAGE:
+            next(reversed(self._segments.values())).add(transaction)
+        else:
+            for transactions in self._segments.itervalues():
+                transactions.discard(transaction)
 
-    def log(self, msg):
-        """Append message to log
+    def log(self, msg, transaction, callback=None):
+        """Appends msg to the log.
 
         Args:
             msg (Message)
+            transaction (tuple): the state machine msg belongs to
+            callback ((error=None) -> None): runs on the event loop thread
+                once msg is durable, or with the error if it can't be
         """
-        pass
+        transaction = json.dumps(transaction)
+        self._append(encode_record(
+            MESSAGE, transaction + "\n" + msg.to_json()), MESSAGE,
+            transaction, callback)
+
+    def complete(self, transaction, callback=None):
+        """Records that transaction is done, so it is not replayed and its
+        records can be truncated."""
+        transaction = json.dumps(transaction)
+        self._append(encode_record(COMPLETE, transaction), COMPLETE,
+                     transaction, callback)
+
+    def _append(self, record, kind, transaction, callback):
+        with self._cond:
+            if self._error is not None:
+                if callback is not None:
+                    self._completions.put(callback, self._error)
+                return
+            self._pending.append((record, kind, transaction, callback))
+            self._logged += 1
+            self._cond.notify_all()
+
+    def flush(self):
+        """Blocks until everything logged so far is durable, or raises the
+        error that stopped the log."""
+        with self._cond:
+            target = self._logged
+            while self._synced < target and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        """Syncs what was logged and stops the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            if self._sync_interval > 0:
+                time.sleep(self._sync_interval)
+            with self._cond:
+                pending, self._pending = self._pending, []
+
+            try:
+                self._file.write(
+                    "".join(record for record, _, _, _ in pending))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as error:
+                traceback.print_exc()
+                self._fail(pending, error)
+                return
+            self._syncs += 1
+            for _, kind, transaction, _ in pending:
+                self._apply(kind, transaction)
+
+            with self._cond:
+                self._synced += len(pending)
+                self._cond.notify_all()
+            for _, _, _, callback in pending:
+                if callback is not None:
+                    self._completions.put(callback)
+
+            try:
+                if self._file.tell() >= self._segment_bytes:
+                    self._rotate()
+                self.truncate()
+            except Exception as error:
+                traceback.print_exc()
+                self._fail([], error)
+                return
+
+    def _fail(self, pending, error):
+        """Stops the log after error: pending and everything appended since
+        get the error instead of being written"""
+        with self._cond:
+            self._error = error
+            pending += self._pending
+            self._pending = []
+            for _, _, _, callback in pending:
+                if callback is not None:
+                    self._completions.put(callback, error)
+            self._cond.notify_all()
+
+    def _rotate(self):
+        self._file.close()
+        number = next(reversed(self._segments)) + 1
+        self._segments[number] = set()
+        self._file = open(self._segment_filename(number), "ab")
+        self._last_segment = number
 
     def truncate(self):
         """Runs periodically in the background. Deletes any completed
         transactions.
+
+        Segments are only deleted oldest first: a later segment may hold the
+        COMPLETE record for a transaction logged in an earlier one.
         """
-        pass
+        while len(self._segments) > 1:
+            number, transactions = next(self._segments.iteritems())
+            if transactions:
+                return
+            os.remove(self._segment_filename(number))
+            del self._segments[number]
+            self._first_segment = next(iter(self._segments))
+
+    @property
+    def segment(self):
+        """Number of the segment records are appended to"""
+        return self._last_segment
+
+    @property
+    def first_segment(self):
+        """Number of the oldest segment that is not deleted yet"""
+        return self._first_segment
+
+    def records(self):
+        """Yields (transaction, message JSON) for every logged message of a
+        transaction that is not complete, oldest first. For replay, before
+        anything new is logged."""
+        open_transactions = {}  # JSON -> tuple, each parsed once
+        for transactions in self._segments.itervalues():
+            open_transactions.update(
+                (transaction, None) for transaction in transactions)
+        for number in list(self._segments):
+            for kind, payload, _ in read_records(
+                    self._segment_filename(number)):
+                if kind != MESSAGE:
+                    continue
+                transaction, msg = payload.split("\n", 1)
+                if transaction not in open_transactions:
+                    continue
+                key = open_transactions[transaction]
+                if key is None:
+                    key = open_transactions[transaction] = tuple(
+                        json.loads(transaction))
+                yield key, msg
 
     @property
     def messages(self):
         """Yields messages in the log."""
-        pass
+        for _, msg in self.records():
+            yield Message.from_json(json.loads(msg))
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(
+        description="Measures append throughput and replay speed.")
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--message-bytes", type=int, default=256)
+    args = parser.parse_args()
+
+    class _Message(object):
+        def __init__(self, data):
+            self._data = data
+
+        def to_json(self):
+            return self._data
+
+    directory = tempfile.mkdtemp()
+    try:
+        wal = WriteAheadLog(os.path.join(directory, "wal"))
+        wal.close()  # Reopened below with the log in the page cache
+        wal = WriteAheadLog(os.path.join(directory, "wal"))
+        msg = _Message("x" * args.message_bytes)
+        start = time.time()
+        for i in xrange(args.records):
+            wal.log(msg, ["user{}".format(i), "PUT"])
+        wal.flush()
+        elapsed = time.time() - start
+        size = sum(os.path.getsize(f) for f in glob.glob(
+            os.path.join(directory, "wal.*")))
+        print ("append: {:.0f} records/s, {:.0f} MB/s, {} segments, "
+               "{} records per fsync").format(
+            args.records / elapsed, size / elapsed / 2 ** 20,
+            len(wal._segments), args.records / max(1, wal._syncs))
+
+        # Replay from a fresh process' point of view
+        start = time.time()
+        replayed = sum(1 for _ in WriteAheadLog(
+            os.path.join(directory, "wal")).records())
+        elapsed = time.time() - start
+        assert replayed == args.records
+        print "replay: {:.0f} records/s ({:.2f}s for {})".format(
+            replayed / elapsed, elapsed, replayed)
+
+        start = time.time()
+        for i in xrange(args.records):
+            wal.complete(["user{}".format(i), "PUT"])
+        wal.flush()
+        print "complete + truncate: {:.2f}s, {} segment(s) left".format(
+            time.time() - start, len(glob.glob(
+                os.path.join(directory, "wal.*"))))
+    finally:
+        shutil.rmtree(directory)